@@ -7,6 +7,7 @@ in the models document for the database table model.
 
 from django.contrib import admin
 from django.conf import settings
+from django.db.models import Count, Q
 from django.shortcuts import HttpResponseRedirect
 from django.utils.safestring import mark_safe
 #from adminsortable2.admin import SortableAdminMixin
@@ -155,6 +156,11 @@ class TifInline(admin.TabularInline):
     can_delete = False
     formset = TifInlineFormset
     template = 'admin/brain/tabular_tifs.html'
+
+    def __init__(self, parent_model, admin_site):
+        super().__init__(parent_model, admin_site)
+        # animal -> {section ID: index}, the inline is created again for every request
+        self.section_indexes = {}
     
     def section_number(self, obj) -> str:
         """
@@ -176,17 +182,20 @@ class TifInline(admin.TabularInline):
         6. Returns the index as a zero-padded string with a ".tif" extension.
         """
         animal = obj.slide.scan_run.prep_id
-        histology = Histology.objects.get(prep_id=animal)
-        orderby = histology.side_sectioned_first
+        if animal not in self.section_indexes:
+            histology = Histology.objects.get(prep_id=animal)
+            orderby = histology.side_sectioned_first
 
-        if orderby == 'Right':
-            sections =  Section.objects.filter(prep_id__exact=animal).filter(channel=1)\
-                .order_by('-slide_physical_id', '-scene_number')
-        else:
-            sections = Section.objects.filter(prep_id__exact=animal).filter(channel=1)\
-                .order_by('slide_physical_id', 'scene_number')
+            if orderby == 'Right':
+                sections =  Section.objects.filter(prep_id__exact=animal).filter(channel=1)\
+                    .order_by('-slide_physical_id', '-scene_number')
+            else:
+                sections = Section.objects.filter(prep_id__exact=animal).filter(channel=1)\
+                    .order_by('slide_physical_id', 'scene_number')
+            # the order of the sections is read once for all the rows of the inline
+            self.section_indexes[animal] = {id: index for index, id in enumerate(sections.values_list('id', flat=True))}
 
-        index = list(sections.values_list('id', flat=True)).index(obj.id)
+        index = self.section_indexes[animal][obj.id]
         return str(index).zfill(3) + ".tif"
 
     section_number.short_description = 'Section' 
@@ -266,7 +275,7 @@ class TifInline(admin.TabularInline):
         :return: a query set
         """
         qs = super(TifInline, self).get_queryset(request)
-        results = qs.filter(channel=1)
+        results = qs.filter(channel=1).select_related('slide__scan_run')
         return results
 
     def has_add_permission(self, request, obj=None):
@@ -469,11 +478,12 @@ class SlideAdmin(AtlasAdminModel, ExportCsvMixin):
         :return: an integer of the number of scenes
         """
 
-        scenes = SlideCziToTif.objects.filter(slide__id=obj.id).filter(channel=1).filter(active=True).values_list('id').distinct()
-        count = len(scenes)
-        return count
+        if hasattr(obj, 'active_scene_count'):
+            return obj.active_scene_count
+        return SlideCziToTif.objects.filter(slide__id=obj.id).filter(channel=1).filter(active=True).count()
 
     scene_count.short_description = "Active Scenes"
+    scene_count.admin_order_field = 'active_scene_count'
 
     def get_queryset(self, request):
         """Description of get_queryset - returns the active slides 
@@ -481,7 +491,9 @@ class SlideAdmin(AtlasAdminModel, ExportCsvMixin):
         :param request: http request
         :return: a query set
         """
-        qs = Slide.objects.filter(active=True)
+        active_scenes = Q(slideczitotif__channel=1, slideczitotif__active=True)
+        qs = Slide.objects.filter(active=True).select_related('scan_run__prep')\
+            .annotate(active_scene_count=Count('slideczitotif', filter=active_scenes, distinct=True))
         return qs
 
     """
@@ -1,5 +1,11 @@
-from rest_framework.pagination import LimitOffsetPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class DataTablePagination(LimitOffsetPagination):
         limit_query_param = 'lengthXXX'
@@ -12,4 +18,84 @@ class LargeResultsSetPagination(LimitOffsetPagination):
 class SlidePagination(PageNumberPagination):
         page_size = 150  # Set your desired page size here
         page_size_query_param = 'limit' # Optional: Allows client to override page size
-        max_page_size = 200 # Optional: Sets an upper limit for client-requested page size
\ No newline at end of file
+        max_page_size = 200 # Optional: Sets an upper limit for client-requested page size
+
+
+class UpdatedKeysetPagination(BasePagination):
+        """Keyset pagination on (updated, id), newest first. The cursor is the updated
+        timestamp and the id of the last row of the page, so every page is one range
+        query on the K__NS_updated_id index whatever its position. Unlike an offset, rows
+        added while a client pages through the list do not shift the pages, so no row is
+        repeated. A row saved during the walk moves ahead of the cursor and is not
+        returned again: it is skipped if its page had not been reached yet.
+        """
+        cursor_query_param = 'cursor'
+        page_size = 100
+        page_size_query_param = 'limit'
+        max_page_size = 1000
+        invalid_cursor_message = 'Invalid cursor'
+
+        def paginate_queryset(self, queryset, request, view=None):
+                self.request = request
+                self.page_size = self.get_page_size(request)
+                queryset = queryset.order_by('-updated', '-id')
+                cursor = self.decode_cursor(request)
+                if cursor is not None:
+                        updated, id = cursor
+                        queryset = queryset.filter(Q(updated__lt=updated) | Q(updated=updated, id__lt=id))
+                rows = list(queryset[:self.page_size + 1])
+                self.has_next = len(rows) > self.page_size
+                self.page = rows[:self.page_size]
+                return self.page
+
+        def get_page_size(self, request):
+                try:
+                        page_size = int(request.query_params[self.page_size_query_param])
+                except (KeyError, ValueError):
+                        return self.page_size
+                return max(1, min(page_size, self.max_page_size))
+
+        def decode_cursor(self, request):
+                encoded = request.query_params.get(self.cursor_query_param)
+                if encoded is None:
+                        return None
+                try:
+                        updated, id = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').rsplit('|', 1)
+                        updated = parse_datetime(updated)
+                        id = int(id)
+                except (TypeError, ValueError, UnicodeError):
+                        raise NotFound(self.invalid_cursor_message)
+                if updated is None:
+                        raise NotFound(self.invalid_cursor_message)
+                return updated, id
+
+        def encode_cursor(self, obj):
+                value = f'{obj.updated.isoformat()}|{obj.id}'
+                return urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+        def get_next_link(self):
+                if not self.has_next:
+                        return None
+                url = self.request.build_absolute_uri()
+                return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+        def get_first_link(self):
+                return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+        def get_paginated_response(self, data):
+                return Response({
+                        'next': self.get_next_link(),
+                        'first': self.get_first_link(),
+                        'results': data,
+                })
+
+        def get_paginated_response_schema(self, schema):
+                return {
+                        'type': 'object',
+                        'required': ['results'],
+                        'properties': {
+                                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                                'first': {'type': 'string', 'format': 'uri'},
+                                'results': schema,
+                        },
+                }
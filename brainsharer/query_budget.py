@@ -0,0 +1,144 @@
+"""Counts the database queries of every request, to find N+1 queries before they
+slow the admin pages down.
+
+:class:`QueryBudgetMiddleware` records the queries run while a view builds its
+response, with ``connection.execute_wrapper``:
+
+* the number of queries and the total time spent in the database,
+* the queries that were run more than once with different parameters, found by
+  their fingerprint, the SQL with its literals replaced by ``?``. Many copies of
+  one fingerprint is what an N+1 looks like.
+
+They are sent back in the ``Server-Timing`` header, shown by the network tab of
+the browser, and logged on the ``brainsharer.queries`` logger. A request running
+more than QUERY_BUDGET queries is logged as a warning with its worst duplicates.
+The queries of a StreamingHttpResponse that run after the view returned are not
+counted.
+
+Tests can declare the budget of an endpoint with :func:`assert_max_queries`::
+
+    with assert_max_queries(10):
+        self.client.get('/admin/neuroglancer/annotationdata/')
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger('brainsharer.queries')
+
+QUERY_BUDGET_ENABLED = getattr(settings, 'QUERY_BUDGET_ENABLED', True)
+QUERY_BUDGET = getattr(settings, 'QUERY_BUDGET', 50)
+# a fingerprint run this many times is reported as a duplicate
+DUPLICATE_THRESHOLD = 2
+
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s)\s*,?)+\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """Returns the SQL with its literals and parameters replaced by ?, so the
+    same query with other values has the same fingerprint."""
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = IN_LIST.sub('IN (...)', sql)
+    sql = sql.replace('%s', '?')
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """An execute wrapper keeping the count, the duration and the fingerprints of
+    the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def get_duplicates(self, threshold=DUPLICATE_THRESHOLD):
+        """Returns (fingerprint, count) of the queries run at least threshold times, most first."""
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count >= threshold]
+
+    @property
+    def duplicate_count(self):
+        """The number of queries that repeat an earlier fingerprint."""
+        return sum(count - 1 for _, count in self.get_duplicates())
+
+    def server_timing(self):
+        milliseconds = self.duration * 1000
+        return (f'db;dur={milliseconds:.1f};desc="{self.count} queries", '
+                f'dbdup;desc="{self.duplicate_count} duplicate queries"')
+
+    def report(self, limit=5):
+        lines = [f'{self.count} queries in {self.duration * 1000:.1f} ms']
+        for sql, count in self.get_duplicates()[:limit]:
+            lines.append(f'{count}x {sql[:300]}')
+        return '\n'.join(lines)
+
+
+@contextmanager
+def record_queries(using=None):
+    """Records the queries run on the database connections inside the block.
+
+    :param using: the alias of one database, all of them by default
+    :return: the QueryRecorder
+    """
+    recorder = QueryRecorder()
+    aliases = [using] if using else list(connections)
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        yield recorder
+
+
+@contextmanager
+def assert_max_queries(budget, using=None):
+    """Fails with the duplicated queries when the block runs more than budget queries.
+
+    :param budget: the maximum number of queries
+    :param using: the alias of one database, all of them by default
+    """
+    with record_queries(using) as recorder:
+        yield recorder
+    if recorder.count > budget:
+        raise AssertionError(f'The query budget of {budget} was exceeded: {recorder.report()}')
+
+
+class QueryBudgetMiddleware:
+    """Adds the Server-Timing header and logs the queries of every request. It is
+    disabled with QUERY_BUDGET_ENABLED = False."""
+
+    def __init__(self, get_response):
+        if not QUERY_BUDGET_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        timing = recorder.server_timing()
+        if response.has_header('Server-Timing'):
+            timing = f"{response['Server-Timing']}, {timing}"
+        response['Server-Timing'] = timing
+        if recorder.count > QUERY_BUDGET:
+            logger.warning('%s %s exceeded the query budget of %d: %s', request.method, request.path,
+                           QUERY_BUDGET, recorder.report())
+        else:
+            logger.info('%s %s: %d queries, %d duplicates, %.1f ms', request.method, request.path,
+                        recorder.count, recorder.duplicate_count, recorder.duration * 1000)
+        return response
@@ -7,21 +7,23 @@ in the models document for the database table model.
 from django.http import HttpResponse
 from django.utils.html import format_html
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import ObjectDoesNotExist
 from django.forms import TextInput
 from django.urls import reverse, path
 from django.template.response import TemplateResponse
 from plotly.offline import plot
 import plotly.express as px
-import pandas as pd
 
 from brain.models import ScanRun
 from brainsharer.admin_extensions import AtlasAdminModel, ExportCsvMixin
-from neuroglancer.annotation_session_manager import M_UM_SCALE
 from neuroglancer.models import AnnotationLabel, AnnotationSession, \
-    NeuroglancerState, Points, AnnotationData, resort_points
+    NeuroglancerState, Points, AnnotationData
 from neuroglancer.dash_view import dash_scatter_view
+from neuroglancer.annotation_export import get_export_formats, iter_frame_rows, iter_session_rows, \
+    render_page, streaming_export
 
 
 
@@ -30,6 +32,23 @@ def datetime_format(dtime):
     """
     return dtime.strftime("%d %b %Y %H:%M")
 
+def get_page_number(request):
+    try:
+        return max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        return 1
+
+
+def get_page_context(page, has_next, export_url_name, id):
+    """Returns the template context of the page links and the export links."""
+    return dict(
+        previous_page=page - 1 if page > 1 else None,
+        next_page=page + 1 if has_next else None,
+        export_urls=[(export_format.upper(), reverse(export_url_name, args=[id, export_format]))
+                     for export_format in get_export_formats()],
+    )
+
+
 def get_points_in_session(id):
     """Shows how many points are in data.
     TODO parse the JSON data and count the points.
@@ -56,7 +75,7 @@ class NeuroglancerStateAdmin(admin.ModelAdmin):
     formfield_overrides = {
         models.CharField: {'widget': TextInput(attrs={'size': '80'})},
     }
-    list_display = ('id', 'show_animal', 'open_neuroglancer', 'public_description', 'public', 'readonly', 'active', 'owner', 'lab', 'created', 'updated')
+    list_display = ('id', 'show_animal', 'open_neuroglancer', 'public_description', 'annotation_layers', 'public', 'readonly', 'active', 'owner', 'lab', 'created', 'updated')
     list_per_page = 25
     ordering = ['-active', 'comments', '-updated']
     list_filter = ['updated', 'created', 'readonly', 'active', 'public']
@@ -67,7 +86,7 @@ class NeuroglancerStateAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         """Returns the query set of points where the layer contains annotations"""
         rows = NeuroglancerState.objects.all()
-        rows = rows.defer('neuroglancer_state')
+        rows = rows.defer('neuroglancer_state').select_related('summary', 'animal', 'owner', 'lab')
         if not request.user.is_superuser:
             labs = [p for p in request.user.labs.all()]
             rows = rows.filter(lab__in=labs)
@@ -91,6 +110,17 @@ class NeuroglancerStateAdmin(admin.ModelAdmin):
         else:
             return obj.description[0:DISPLAY_LENGTH] + '...'
 
+    def annotation_layers(self, obj):
+        """Shows the annotation layers and their number of annotations from the
+        summary table, the JSON state is never loaded.
+        """
+        try:
+            summary = obj.summary
+        except ObjectDoesNotExist:
+            return 'NA'
+        layers = [f'{name} ({sum(summary.counts.get(name, {}).values())})' for name in summary.layers]
+        return ', '.join(layers)
+
     def show_animal(self, obj):
         """Show a warning to the user if the animal is NULL and hence the state is readonly
         """
@@ -109,6 +139,7 @@ class NeuroglancerStateAdmin(admin.ModelAdmin):
 
     open_neuroglancer.short_description = 'Neuroglancer'
     open_neuroglancer.allow_tags = True
+    annotation_layers.short_description = 'Annotation layers'
     show_animal.short_description = 'Animal'
     show_animal.allow_tags = True
 
@@ -140,8 +171,10 @@ class PointsAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         """Returns the query set of points where the layer contains annotations"""
-        points = Points.objects.filter(
-            neuroglancer_state__layers__contains={'type': 'annotation'})
+        # a state without a summary row yet is checked in its JSON, like before the summaries
+        points = Points.objects.filter(Q(summary__layers__0__isnull=False)
+                                       | Q(summary__isnull=True, neuroglancer_state__layers__contains={'type': 'annotation'}))
+        points = points.defer('neuroglancer_state')
         return points
 
     def show_points_links(self, obj):
@@ -160,6 +193,7 @@ class PointsAdmin(admin.ModelAdmin):
             path('points-3D-graph/<id>', self.view_points_3Dgraph,
                  name='points-3D-graph'),
             path('points-data/<id>', self.view_points_data, name='points-data'),
+            path('points-data/<id>/<str:export_format>', self.export_points_data, name='points-data-export'),
         ]
         return custom_urls + urls
 
@@ -173,7 +207,7 @@ class PointsAdmin(admin.ModelAdmin):
         :return: 3dGraph in a django template
         """
         try:
-            neuroglancerState = NeuroglancerState.objects.get(pk=id)
+            neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=id)
         except Exception as exc:
             msg = str(exc)
             return HttpResponse(status=404, content=msg)
@@ -203,27 +237,33 @@ class PointsAdmin(admin.ModelAdmin):
     def view_points_data(self, request, id, *args, **kwargs):
         """Provides the HTML link to the table data"""
         try:
-            neuroglancerState = NeuroglancerState.objects.get(pk=id)
+            neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=id)
         except Exception as exc:
             msg = str(exc)
             return HttpResponse(status=404, content=msg)
 
-        df = neuroglancerState.points
-        result = 'No data'
-        display = False
-        if df is not None and len(df) > 0:
-            display = True
-            result = df.to_html(
-                index=False, classes='table table-striped table-bordered', table_id='tab')
+        page = get_page_number(request)
+        result, has_next = render_page(iter_frame_rows(neuroglancerState.points), page)
         context = dict(
             self.admin_site.each_context(request),
             title=neuroglancerState.comments,
-            chart=result,
-            display=display,
+            chart=result or 'No data',
+            display=result is not None,
             opts=NeuroglancerState._meta,
+            **get_page_context(page, has_next, 'admin:points-data-export', id),
         )
         return TemplateResponse(request, "admin/neuroglancer/points_table.html", context)
 
+    def export_points_data(self, request, id, export_format, *args, **kwargs):
+        """Streams all the points of the state as a file"""
+        try:
+            neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=id)
+        except NeuroglancerState.DoesNotExist as exc:
+            return HttpResponse(status=404, content=str(exc))
+        if export_format not in get_export_formats():
+            return HttpResponse(status=404, content=f'Unknown export format: {export_format}')
+        return streaming_export(iter_frame_rows(neuroglancerState.points), export_format, f'points_{id}')
+
     def has_delete_permission(self, request, obj=None):
         """Returns false as the data is readonly"""
         return False
@@ -262,104 +302,38 @@ class AnnotationDataAdmin(admin.ModelAdmin):
         urls = super().get_urls()
         custom_urls = [
             path('exported-points-data/<id>', self.view_points_data, name='exported-points-data'),
+            path('exported-points-data/<id>/<str:export_format>', self.export_points_data, name='exported-points-data-export'),
         ]
         return custom_urls + urls
 
-    def view_points_data(self, request, id, *args, **kwargs):
-
-        annotation_session = AnnotationSession.objects.get(pk=id)
-        annotations = annotation_session.annotation
-
-
-        dfs = []
-        result = None
-        annotation_type = annotations.get('type')
-        description = annotations.get('description')
+    def get_rows(self, annotation_session):
         scan_run = ScanRun.objects.filter(prep_id=annotation_session.animal).first()
-        xy_resolution = scan_run.resolution
-        z_resolution = scan_run.zresolution
-        if annotation_type == 'point':
-            points = [annotations['point']]
-            df = create_one_dataframe(points, 'point', annotation_type='point', orders=0, description=description, 
-                                        xy_resolution=xy_resolution, z_resolution=z_resolution)
-            df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-            dfs.append(df)
-
-        if annotation_type == 'cloud':
-            subclouds = annotations['childJsons']
-            print(f"len clouds = {len(subclouds)}")
-            points = [row['point'] for row in subclouds]
-            UUID = subclouds[0]['parentAnnotationId']
-            df = create_one_dataframe(points, UUID, annotation_type='cloud', orders=0, description=description, 
-                                        xy_resolution=xy_resolution, z_resolution=z_resolution)
-            df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-            dfs.append(df)
-
-        if annotation_type == 'volume' and 'childJsons' in annotations:
-            polygons = annotations['childJsons']
-            print(f"len polygons = {len(polygons)}")
-            
-            for polygon in polygons:
-                lines = polygon['childJsons']
-                UUID = lines[0]['parentAnnotationId']
-
-                first = [round(x) for x in lines[0]['pointA']]
-                last = [round(x) for x in lines[-1]['pointB']]
-
-                if first != last:
-                    rows = resort_points(rows)
-
-                points = [row['pointA'] for row in lines]
-                orders = [o for o in range(1, len(points) + 1)]
-                df = create_one_dataframe(points, UUID, annotation_type='volume', orders=orders, description=description, 
-                                          xy_resolution=xy_resolution, z_resolution=z_resolution)
-                df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-                dfs.append(df)
-
-        if annotation_type == 'polygon' and 'childJsons' in annotations:
-            polygons = annotations['childJsons']
-        
-            lines = annotations['childJsons']
-            UUID = lines[0]['parentAnnotationId']
-
-            first = [round(x) for x in lines[0]['pointA']]
-            last = [round(x) for x in lines[-1]['pointB']]
-
-            if first != last:
-                rows = resort_points(rows)
-
-            points = [row['pointA'] for row in lines]
-            orders = [o for o in range(1, len(points) + 1)]
-            df = create_one_dataframe(points, UUID, annotation_type='polygon', 
-                                      orders=orders, description=description, 
-                                      xy_resolution=xy_resolution, z_resolution=z_resolution)
-            df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-            dfs.append(df)
-
-        if len(dfs) == 0:
-            result = None
-        elif len(dfs) == 1:
-            result = dfs[0]
-        else:
-            result = pd.concat(dfs)
+        return iter_session_rows(annotation_session.annotation, scan_run.resolution, scan_run.zresolution)
 
-
-        display = False
-        if result is not None:
-            result.sort_values(by=['Layer', 'Type', 'Labels', 'UUID', 'Section', 'Order', 'X', 'Y'], inplace=True)
-            display = True
-            result = result.to_html(
-                index=False, classes='table table-striped table-bordered', table_id='tab')
+    def view_points_data(self, request, id, *args, **kwargs):
+        """Shows one page of the points of the session"""
+        annotation_session = AnnotationSession.objects.get(pk=id)
+        page = get_page_number(request)
+        result, has_next = render_page(self.get_rows(annotation_session), page)
         context = dict(
             self.admin_site.each_context(request),
             title= f"Exported data for annotation session ID={annotation_session.id}",
-            chart=result,
-            display=display,
+            chart=result or 'No data',
+            display=result is not None,
             opts=AnnotationData._meta,
+            **get_page_context(page, has_next, 'admin:exported-points-data-export', id),
         )
         return TemplateResponse(request, "admin/neuroglancer/points_table.html", context)
 
-
+    def export_points_data(self, request, id, export_format, *args, **kwargs):
+        """Streams all the points of the session as a file"""
+        try:
+            annotation_session = AnnotationSession.objects.get(pk=id)
+        except AnnotationSession.DoesNotExist as exc:
+            return HttpResponse(status=404, content=str(exc))
+        if export_format not in get_export_formats():
+            return HttpResponse(status=404, content=f'Unknown export format: {export_format}')
+        return streaming_export(self.get_rows(annotation_session), export_format, f'annotation_session_{id}')
 
     def get_labels(self, obj):
         # for the many to many case 
@@ -369,7 +343,8 @@ class AnnotationDataAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         """Returns the query set of points where the layer contains annotations"""
-        rows = AnnotationData.objects.filter(active=True)
+        rows = AnnotationData.objects.filter(active=True).defer('annotation')\
+            .select_related('animal', 'annotator').prefetch_related('labels')
         return rows
 
     def has_add_permission(self, request, obj=None):
@@ -393,20 +368,3 @@ class AnnotationLabelAdmin(AtlasAdminModel, ExportCsvMixin):
         """Formats the date nicely."""
         return datetime_format(obj.created)
     created_display.short_description = 'Created'
-
-
-def create_one_dataframe(points, UUID, annotation_type='point', orders=0, description="", xy_resolution=1, z_resolution=1):
-    df = pd.DataFrame(points, columns=['Xm', 'Ym', 'Zm'])
-    df['X'] = df['Xm'] * M_UM_SCALE / xy_resolution
-    df['Y'] = df['Ym'] * M_UM_SCALE / xy_resolution
-    df['Section'] = df['Zm'] * M_UM_SCALE / z_resolution
-    df['Layer'] = 'Export'
-    df['Type'] = annotation_type
-    df['UUID'] = UUID
-    df['Order'] = orders
-    df['Labels'] = description
-    df['Xum'] = df['Xm'] * M_UM_SCALE
-    df['Yum'] = df['Ym'] * M_UM_SCALE
-    df['Zum'] = df['Zm'] * M_UM_SCALE
-    df['Section'] = df['Section'].round(1).astype(int)
-    return df
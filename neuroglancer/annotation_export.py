@@ -0,0 +1,204 @@
+"""Streams the annotation points of a session or of a Neuroglancer state as NDJSON,
+CSV or Parquet, and renders them one page at a time as an HTML table.
+
+The admin data pages used to put every row in one DataFrame and one giant HTML
+table. Here the rows come from a generator and are written to a
+StreamingHttpResponse as they are produced, so the size of an export does not
+change the memory used by the worker. The columns are the same as before:
+``points_parser.COLUMNS``.
+
+Parquet needs pyarrow, it is only offered when pyarrow can be imported.
+"""
+import csv
+import io
+import json
+from itertools import islice
+import numpy as np
+from django.http import StreamingHttpResponse
+from django.utils.html import escape
+
+from brainsharer.admin_extensions import Echo
+from neuroglancer.annotation_session_manager import M_UM_SCALE
+from neuroglancer.points_parser import COLUMNS, resort_points
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+PAGE_SIZE = 1000
+PARQUET_BATCH_SIZE = 65536
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def get_export_formats():
+    return [name for name in CONTENT_TYPES if name != 'parquet' or pa is not None]
+
+
+def create_rows(points, UUID, annotation_type, orders, description, xy_resolution, z_resolution):
+    """Yields the rows of a list of points, sorted like the old admin table by section,
+    order, x and y.
+
+    :param points: list of x,y,z coordinates in meters
+    :param orders: the order of every point or 0
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3) * M_UM_SCALE
+    sections = np.round(points[:, 2] / z_resolution, 1).astype(int)
+    orders = np.broadcast_to(np.asarray(orders), len(points))
+    x = points[:, 0] / xy_resolution
+    y = points[:, 1] / xy_resolution
+    for i in np.lexsort((y, x, orders, sections)).tolist():
+        yield {
+            'Layer': 'Export', 'Type': annotation_type, 'Labels': description, 'UUID': UUID,
+            'Order': int(orders[i]), 'X': float(x[i]), 'Y': float(y[i]), 'Section': int(sections[i]),
+            'Xum': float(points[i, 0]), 'Yum': float(points[i, 1]), 'Zum': float(points[i, 2]),
+        }
+
+
+def get_polygon_points(lines):
+    first = [round(x) for x in lines[0]['pointA']]
+    last = [round(x) for x in lines[-1]['pointB']]
+    if first != last:
+        lines = resort_points(lines)
+    return [row['pointA'] for row in lines]
+
+
+def iter_session_rows(annotation, xy_resolution=1, z_resolution=1):
+    """Yields the rows of the annotation JSON of a session: a point, a cloud, a polygon or a volume.
+
+    :param annotation: the annotation JSON
+    :param xy_resolution: the resolution of the scan run in micrometers
+    :param z_resolution: the section thickness in micrometers
+    """
+    annotation_type = annotation.get('type')
+    description = annotation.get('description')
+    if annotation_type == 'point':
+        yield from create_rows([annotation['point']], 'point', 'point', 0, description, xy_resolution, z_resolution)
+
+    if annotation_type == 'cloud' and annotation.get('childJsons'):
+        children = annotation['childJsons']
+        points = [row['point'] for row in children]
+        yield from create_rows(points, children[0]['parentAnnotationId'], 'cloud', 0, description, xy_resolution, z_resolution)
+
+    polygons = []
+    if annotation_type == 'volume' and 'childJsons' in annotation:
+        polygons = [polygon['childJsons'] for polygon in annotation['childJsons'] if polygon.get('childJsons')]
+    if annotation_type == 'polygon' and annotation.get('childJsons'):
+        polygons = [annotation['childJsons']]
+    for lines in sorted(polygons, key=lambda lines: lines[0]['parentAnnotationId']):
+        points = get_polygon_points(lines)
+        orders = np.arange(1, len(points) + 1)
+        yield from create_rows(points, lines[0]['parentAnnotationId'], annotation_type, orders, description,
+                               xy_resolution, z_resolution)
+
+
+def iter_frame_rows(df, chunk_size=PAGE_SIZE):
+    """Yields the rows of a points DataFrame a chunk at a time."""
+    if df is None:
+        return
+    for start in range(0, len(df), chunk_size):
+        yield from df.iloc[start:start + chunk_size][COLUMNS].to_dict('records')
+
+
+def to_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps({key: to_python(row[key]) for key in COLUMNS}) + '\n'
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow([row[key] for key in COLUMNS])
+
+
+class ChunkSink(io.RawIOBase):
+    """A write only file that keeps what is written until it is taken."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(rows):
+    sink = ChunkSink()
+    writer = None
+    while True:
+        batch = list(islice(rows, PARQUET_BATCH_SIZE))
+        if len(batch) == 0:
+            break
+        table = pa.Table.from_pylist([{key: to_python(row[key]) for key in COLUMNS} for row in batch])
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table)
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+    yield sink.take()
+
+
+def streaming_export(rows, export_format, filename):
+    """Returns a StreamingHttpResponse of the rows as a file download.
+
+    :param rows: iterator of row dictionaries
+    :param export_format: one of get_export_formats()
+    :param filename: the name of the file without the extension
+    """
+    if export_format == 'ndjson':
+        content = ndjson_lines(rows)
+    elif export_format == 'csv':
+        content = csv_lines(rows)
+    elif export_format == 'parquet' and pa is not None:
+        content = parquet_chunks(iter(rows))
+    else:
+        raise ValueError(f'Unknown export format: {export_format}')
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
+
+
+def render_page(rows, page, page_size=PAGE_SIZE):
+    """Returns the HTML table of one page of rows and whether there is a next page.
+    Only the rows up to the end of the page are produced.
+
+    :param rows: iterator of row dictionaries
+    :param page: the page number, starting at 1
+    """
+    start = (page - 1) * page_size
+    page_rows = list(islice(rows, start, start + page_size + 1))
+    has_next = len(page_rows) > page_size
+    page_rows = page_rows[:page_size]
+    if len(page_rows) == 0:
+        return None, False
+    lines = ['<table border="1" class="dataframe table table-striped table-bordered" id="tab">', '<thead><tr style="text-align: right;">']
+    lines.extend(f'<th>{column}</th>' for column in COLUMNS)
+    lines.append('</tr></thead><tbody>')
+    for row in page_rows:
+        lines.append('<tr>' + ''.join(f'<td>{escape(to_python(row[column]))}</td>' for column in COLUMNS) + '</tr>')
+    lines.append('</tbody></table>')
+    return '\n'.join(lines), has_next
@@ -1,23 +1,73 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 import shutil
+import tempfile
 import numpy as np
 import os
 from cloudvolume import CloudVolume
 import cv2
 import scipy.interpolate as si
-from skimage.filters import gaussian
-from django.db.models import Count
+from scipy.ndimage import gaussian_filter1d
+from django.conf import settings
 import bisect
 
 from brain.models import ScanRun
 from neuroglancer.contours.ng_segment_maker import NgConverter
-from neuroglancer.models import AnnotationLabel, AnnotationSession
+from neuroglancer.lookup_cache import get_label
+from neuroglancer.models import AnnotationLabel, AnnotationSession, get_label_signature
 from neuroglancer.models import DEBUG
+from neuroglancer.structures_cache import STRUCTURES_PATH
 
 
 M_UM_SCALE = 1000000
 COLOR = 1
 ISOTROPIC = 10  # set volume to be isotropic @ 10um
+BLOCK_SIZE = 64  # sections blurred at a time, the precomputed chunks are 64 voxels deep
+# The sections are resampled and drawn by a pool of 'thread' or 'process' workers, 'serial' runs them in a loop
+SECTION_EXECUTOR = getattr(settings, 'SEGMENTATION_SECTION_EXECUTOR', 'thread')
+SECTION_WORKERS = getattr(settings, 'SEGMENTATION_SECTION_WORKERS', os.cpu_count() or 1)
+# the Allen atlas color of the structures, the other labels get COLOR
+ALLEN_STRUCTURE_COLORS = {
+    'SC': 851,
+    'IC': 811,
+    'AP': 207,
+    'RtTg': 146,
+    'SNR_L': 381,
+    'SNR_R': 381,
+    'PBG_L': 874,
+    'PBG_R': 874,
+    '3N_L': 35,
+    '3N_R': 35,
+    '4N_L': 115,
+    '4N_R': 115,
+    'SNC_L': 374,
+    'SNC_R': 374,
+    'VLL_L': 612,
+    'VLL_R': 612,
+    '5N_L': 621,
+    '5N_R': 621,
+    'LC_L': 147,
+    'LC_R': 147,
+    'DC_L': 96,
+    'DC_R': 96,
+    'Sp5C_L': 429,
+    'Sp5C_R': 429,
+    'Sp5I_L': 437,
+    'Sp5I_R': 437,
+    'Sp5O_L': 445,
+    'Sp5O_R': 445,
+    '6N_L': 653,
+    '6N_R': 653,
+    '7N_L': 661,
+    '7N_R': 661,
+    '7n_L': 798,
+    '7n_R': 798,
+    'Amb_L': 135,
+    'Amb_R': 135,
+    'LRt_L': 235,
+    'LRt_R': 235,
+}
 
 def get_label_ids(label: str):
 
@@ -26,34 +76,28 @@ def get_label_ids(label: str):
     if DEBUG:
         print(f'labels: {labels} type={type(labels)} len={len(labels)}')
 
-    try:
-        label_objects = AnnotationLabel.objects.filter(label__in=labels)
-    except AnnotationLabel.DoesNotExist:
-        return []
+    return get_label_ids_from_labels(labels)
 
-    return [label.id for label in label_objects]
 
+def get_label_ids_from_labels(labels):
+    """Returns the sorted IDs of the labels found in the lookup cache."""
+    label_objects = [get_label(label) for label in labels]
+    return sorted({label.id for label in label_objects if label is not None})
 
-def get_exact_match(model_class, m2m_field, ids):
+
+def get_exact_match(ids):
     """
-    Retrieves instances of the given `model_class` that have an exact match
-    for the provided `ids` in the many-to-many field `m2m_field`.
-    https://stackoverflow.com/questions/5301996/how-to-do-many-to-many-django-query-to-find-book-with-2-given-authors
+    Retrieves the annotation sessions whose labels are exactly the provided label IDs.
+    The sorted label IDs are hashed into the label_signature column, so this is one
+    indexed equality filter whatever the number of labels.
 
     Args:
-        model_class (class): The model class to query.
-        m2m_field (str): The name of the many-to-many field to filter on.
-        ids (list): A list of IDs to match in the many-to-many field.
+        ids (list): A list of label IDs.
 
     Returns:
-        QuerySet: A queryset containing instances of `model_class` that have
-        an exact match for the provided `ids` in the many-to-many field `m2m_field`.
+        QuerySet: A queryset of the annotation sessions having exactly these labels.
     """
-    query = model_class.objects.annotate(count=Count(m2m_field))\
-                .filter(count=len(ids))
-    for _id in ids:
-        query = query.filter(**{m2m_field: _id})
-    return query
+    return AnnotationSession.objects.filter(label_signature=get_label_signature(ids))
 
 def get_session(request_data: dict):
     """
@@ -87,14 +131,9 @@ def get_session(request_data: dict):
         if DEBUG:
             print(f'labels: {labels} type={type(labels)} len={len(labels)}')
 
-        try:
-            label_objects = AnnotationLabel.objects.filter(label__in=labels)
-        except AnnotationLabel.DoesNotExist:
-            print('error')
-
-        label_ids = [label.id for label in label_objects]
+        label_ids = get_label_ids_from_labels(labels)
 
-        matches = get_exact_match(AnnotationSession, 'labels', label_ids)
+        matches = get_exact_match(label_ids)
 
         annotation_session = matches.filter(active=True)\
             .filter(animal=animal)\
@@ -108,6 +147,147 @@ def get_session(request_data: dict):
     return annotation_session
 
 
+@lru_cache(maxsize=128)
+def bspline_basis(count, degree, n):
+    """
+    Returns the sparse n x count matrix that evaluates the clamped B-spline of count
+    control vertices at n evenly spaced points, so bspliner is one matrix product.
+    It is the same knot vector and query range as the splev call bspliner used to make.
+    """
+    degree = int(np.clip(degree, 1, count - 1))
+    kv = np.concatenate(([0] * degree, np.arange(count - degree + 1), [count - degree] * degree)).astype(np.float64)
+    u = np.linspace(0, count - degree, n)
+    return si.BSpline.design_matrix(u, kv, degree).tocsr()
+
+
+def create_section_pool(executor=SECTION_EXECUTOR, workers=SECTION_WORKERS):
+    """
+    Returns the pool that draws the sections, or None to draw them in the calling thread.
+    OpenCV and the numpy copies release the GIL so threads are usually enough.
+    """
+    if executor == 'serial' or workers <= 1:
+        return None
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='section')
+
+
+def map_sections(pool, function, *iterables):
+    """Runs the function on every section with the pool, in order."""
+    if pool is None:
+        return list(map(function, *iterables))
+    chunksize = 8 if isinstance(pool, ProcessPoolExecutor) else 1
+    return list(pool.map(function, *iterables, chunksize=chunksize))
+
+
+def draw_section(block, index, points, origin):
+    """
+    Draws the filled polygon of one section into block[:, :, index]. The block is an
+    x,y,z uint8 array or, for process workers, the (path, shape) of a memory mapped one.
+    """
+    if isinstance(block, tuple):
+        block = np.memmap(block[0], dtype=np.uint8, mode='r+', shape=block[1], order='F')
+    width, height = block.shape[:2]
+    points = (np.array(points) - origin[:2]).astype(np.int32)
+    volume_slice = np.zeros((height, width), dtype=np.uint8)
+    cv2.polylines(volume_slice, [points], isClosed=True, color=1, thickness=1)
+    cv2.fillPoly(volume_slice, pts=[points], color=1)
+    block[:, :, index] = volume_slice.T
+    if isinstance(block, np.memmap):
+        block.flush()
+
+
+class ChunkedVolume:
+    """
+    The blurred segmentation volume of a structure, created one block of sections at a time.
+
+    The polygons of the sections in a block, plus the sections the Gaussian needs on
+    each side of it, are drawn into a preallocated uint8 array in x,y,z order. The
+    arrays are in Fortran order, like CloudVolume uses, so every section is one
+    contiguous plane that the section workers can write on their own. The
+    array is blurred with a separable Gaussian in float32, which is what
+    skimage.filters.gaussian does in float64 (mode nearest, truncated at 4 sigma),
+    and thresholded in place. Iterating over the object yields the finished blocks,
+    so memory depends on the block size and not on the size of the structure.
+
+    Attributes:
+        shape (tuple): The x,y,z shape of the whole volume.
+    """
+
+    def __init__(self, polygons, origin, section_size, color, sigmas, block_size=BLOCK_SIZE, truncate=4.0,
+                 executor=SECTION_EXECUTOR, workers=SECTION_WORKERS):
+        """
+        Args:
+            polygons (dict): A dictionary of the polygon points indexed by section.
+            origin (numpy.ndarray): The x,y,z origin of the volume.
+            section_size (numpy.ndarray): The [height, width] of the sections.
+            color (int): The value of the voxels inside the structure.
+            sigmas (tuple): The standard deviations of the Gaussian in x, y and z.
+            block_size (int): The number of sections in a block, a multiple of the precomputed chunk size.
+            truncate (float): The Gaussian is truncated at this many standard deviations.
+            executor (str): 'thread', 'process' or 'serial', how the sections of a block are drawn.
+            workers (int): The number of workers drawing the sections.
+        """
+        self.sections = [points for _, points in sorted(polygons.items())]
+        self.origin = np.asarray(origin)
+        height, width = (int(i) for i in section_size)
+        self.shape = (width, height, len(self.sections))
+        self.color = color
+        self.sigmas = [float(sigma) for sigma in sigmas]
+        self.block_size = block_size
+        self.truncate = truncate
+        self.halo = int(truncate * self.sigmas[2] + 0.5) if self.sigmas[2] > 0 else 0
+        self.executor = executor
+        self.workers = workers
+
+    def rasterize(self, z_start, z_stop, pool=None):
+        """Draws the polygons of sections z_start to z_stop into a x,y,z uint8 array.
+        Every section is drawn by a worker of the pool straight into the array, process
+        workers write into a memory mapped file.
+        """
+        width, height, _ = self.shape
+        shape = (width, height, z_stop - z_start)
+        indexes = range(z_stop - z_start)
+        sections = self.sections[z_start:z_stop]
+        origins = [self.origin] * len(sections)
+        if not isinstance(pool, ProcessPoolExecutor):
+            block = np.zeros(shape, dtype=np.uint8, order='F')
+            map_sections(pool, draw_section, [block] * len(sections), indexes, sections, origins)
+            return block
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'block.dat')
+            np.memmap(path, dtype=np.uint8, mode='w+', shape=shape, order='F').flush()
+            map_sections(pool, draw_section, [(path, shape)] * len(sections), indexes, sections, origins)
+            return np.array(np.memmap(path, dtype=np.uint8, mode='r', shape=shape, order='F'), order='F')
+
+    def blur(self, block):
+        """Separable Gaussian of a block in float32, axes with a sigma of 0 are not blurred."""
+        block = block.astype(np.float32, order='F')
+        for axis, sigma in enumerate(self.sigmas):
+            if sigma > 0:
+                gaussian_filter1d(block, sigma, axis=axis, output=block, mode='nearest', truncate=self.truncate)
+        return block
+
+    def __iter__(self):
+        """Yields the z start and the finished uint16 block of every block of sections."""
+        depth = self.shape[2]
+        pool = create_section_pool(self.executor, self.workers)
+        try:
+            for z_start in range(0, depth, self.block_size):
+                z_stop = min(z_start + self.block_size, depth)
+                halo_start = max(z_start - self.halo, 0)
+                halo_stop = min(z_stop + self.halo, depth)
+                block = self.blur(self.rasterize(halo_start, halo_stop, pool))
+                block = block[:, :, z_start - halo_start:z_stop - halo_start]
+                result = np.zeros(block.shape, dtype=np.uint16, order='F')
+                result[block > 0] = self.color
+                del block
+                yield z_start, result
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+
 class AnnotationSessionManager():
     """
     A class that manages annotation sessions and provides methods for creating polygons and volumes.
@@ -195,39 +375,34 @@ class AnnotationSessionManager():
         _max = max(polygons.keys())
         section_range = range(_min, _max)
         keys = sorted(polygons.keys())
+        keys_set = set(keys)
         lpoints = max([len(polygons[k]) for k in keys]) * 10
-        # Now either pad or interpolate
+        # Now either pad or interpolate. Every section that is needed is resampled
+        # once, in one batch.
         if interpolate:
             print(f'Interpolating polygons to have at least {lpoints} points each.')
-            for i in section_range:
-                if i not in keys:
-                    # find surrounding keys
-                    idx = bisect.bisect_left(keys, i)
-
-                    # handle bounds safely
-                    if idx == 0:
-                        value = polygons[keys[0]]
-                    elif idx == len(keys):
-                        value = polygons[keys[-1]]
-                    else:
-                        k0, k1 = keys[idx - 1], keys[idx]
-                        v0, v1 = np.array(polygons[k0]), np.array(polygons[k1])
-                        v0 = self.bspliner(v0, lpoints, degree=3)
-                        v1 = self.bspliner(v1, lpoints, degree=3)
-                        # linear interpolation
-                        t = (i - k0) / (k1 - k0)
-                        value = v0 + t * (v1 - v0)
-                    polygons[i] = value
+            missing = [i for i in section_range if i not in keys_set]
+            neighbours = {}
+            for i in missing:
+                # find surrounding keys, the first and last sections are always keys
+                idx = bisect.bisect_left(keys, i)
+                neighbours[i] = (keys[idx - 1], keys[idx])
+            needed = {k for pair in neighbours.values() for k in pair}
+            resampled = self.resample_sections({k: polygons[k] for k in needed}, lpoints, degree=3)
+            for i, (k0, k1) in neighbours.items():
+                v0, v1 = resampled[k0], resampled[k1]
+                # linear interpolation
+                t = (i - k0) / (k1 - k0)
+                polygons[i] = v0 + t * (v1 - v0)
         else:
+            sections = [section for section in section_range if section in keys_set]
+            polygons.update(self.resample_sections({section: polygons[section] for section in sections}, lpoints, degree=3))
+            # a missing section is a resampled copy of the section before it, in order
             for expanded_section in section_range:
-                if expanded_section in keys:
-                    points = self.bspliner(polygons[expanded_section], lpoints, degree=3)
-                    polygons[expanded_section] = points
-                else:
+                if expanded_section not in keys_set:
                     points = self.bspliner(polygons[expanded_section - 1], lpoints, degree=3)
                     polygons[expanded_section] = points
 
-
         return polygons
 
     def create_volume(self, polygons, origin, section_size, stdDevX=1.0, stdDevY=1.0, stdDevZ=1.0):
@@ -241,14 +416,14 @@ class AnnotationSessionManager():
 
             2. Subtract the origin from the points so we create a box the size of the biggest polygon
 
-            3. Create a slice of the volume with the size of the section
+            3. Draw the polygon on the section of the volume with opencv
 
-            4. Draw the polygon on the slice with opencv
+            4. Blur and threshold the volume, one block of sections at a time
 
-            5. Append the slice to the volume (box)
-
-            6. Return an array of integers (0 and 1s)
+            5. Return an array of integers (0 and the color)
 
+        The volume is built by blocks of sections with ChunkedVolume, use that directly
+        to write the blocks without ever having the whole volume in memory.
 
         Args:
             polygons (dict): A dictionary of polygons, where the keys are polygon IDs and the values are lists of points.
@@ -259,21 +434,20 @@ class AnnotationSessionManager():
             numpy.ndarray: The created volume as a 3D numpy array.
 
         """
-        volume = []
-        for _, points in sorted(polygons.items()):
-            points = np.array(points) - origin[:2]
-            points = (points).astype(np.int32)
-            volume_slice = np.zeros(section_size, dtype=np.uint16)
-            volume_slice = cv2.polylines(volume_slice, [points], isClosed=True, color=self.color, thickness=1)
-            volume_slice = cv2.fillPoly(volume_slice, pts=[points], color=self.color)
-            volume.append(volume_slice)
-        volume = np.array(volume)
-        volume = np.swapaxes(volume, 0, 2) # put it in x,y,z format
+        chunked_volume = self.create_chunked_volume(polygons, origin, section_size, stdDevX, stdDevY, stdDevZ)
         if DEBUG:
-            print(f'Volume shape before gaussian: {volume.shape} dtype={volume.dtype} with parameters stdDevX: {stdDevX}, stdDevY: {stdDevY}, stdDevZ: {stdDevZ}')
-        volume = gaussian(volume, [stdDevX, stdDevY, stdDevZ])  # this is a float array
-        volume[volume > 0] = self.color
-        return volume.astype(np.uint16)
+            print(f'Volume shape: {chunked_volume.shape} with parameters stdDevX: {stdDevX}, stdDevY: {stdDevY}, stdDevZ: {stdDevZ}')
+        volume = np.zeros(chunked_volume.shape, dtype=np.uint16, order='F')
+        for z_start, block in chunked_volume:
+            volume[:, :, z_start:z_start + block.shape[2]] = block
+        return volume
+
+    def create_chunked_volume(self, polygons, origin, section_size, stdDevX=1.0, stdDevY=1.0, stdDevZ=1.0):
+        """
+        Returns the volume of the polygons as a ChunkedVolume that creates it one block at a time.
+        create_segmentation_folder writes the blocks straight into the precomputed chunks.
+        """
+        return ChunkedVolume(polygons, origin, section_size, self.color, (stdDevX, stdDevY, stdDevZ))
 
     def get_origin_and_section_size(self, structure_contours):
         """
@@ -306,17 +480,19 @@ class AnnotationSessionManager():
         section_size = np.array([yspan, xspan]).astype(int)
         return origin, section_size
 
-    def create_segmentation_folder(self, volume, animal, label, offset):
+    def create_segmentation_folder(self, volume, animal, label, offset, folder_name=None):
         """
         Creates a segmentation folder for a given volume, animal, label, and offset.
-        If the folder already exists, it will delete it and recreate it. We might
-        want to change this to just return the existing folder_name
+        If the folder already exists, it will delete it and recreate it. The segmentation
+        views pass a content addressed folder name from neuroglancer.structures_cache
+        and only get here when that folder does not exist yet.
 
         Args:
-            volume (str): The volume to be used for segmentation.
+            volume (numpy.ndarray or ChunkedVolume): The volume to be used for segmentation.
             animal (str): The name of the animal.
             label (str): The label for the segmentation.
             offset (tuple): The offset for the segmentation.
+            folder_name (str, optional): The name of the folder. Defaults to {animal}_{label}.
 
         Returns:
             str: The name of the created folder.
@@ -325,11 +501,11 @@ class AnnotationSessionManager():
             label = label.label
 
         label = str(label).replace(' ', '_')
-        folder_name = f'{animal}_{label}'
-        path = '/var/www/brainsharer/structures'
-        output_dir = os.path.join(path, folder_name)
-        if os.path.exists(folder_name):
-            shutil.rmtree(folder_name)
+        if folder_name is None:
+            folder_name = f'{animal}_{label}'
+        output_dir = os.path.join(STRUCTURES_PATH, folder_name)
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
         self.resolution = self.resolution * 1000 * self.downsample_factor  # neuroglancer wants it in nm
         #####TODO rm self.zresolution = self.zresolution * 1000
         scales = [int(self.resolution), int(self.resolution), int(self.isotropic * 1000)]
@@ -357,52 +533,11 @@ class AnnotationSessionManager():
             label (str): The label for which to fetch the color.
 
         Returns:
-            int: The color associated with the label. If the label is not found in the `allen_structures` dictionary,
+            int: The color associated with the label. If the label is not found in ALLEN_STRUCTURE_COLORS,
                  the default color is returned.
 
         """
-        allen_structures = {
-            'SC': 851,
-            'IC': 811,
-            'AP': 207,
-            'RtTg': 146,
-            'SNR_L': 381,
-            'SNR_R': 381,
-            'PBG_L': 874,
-            'PBG_R': 874,
-            '3N_L': 35,
-            '3N_R': 35,
-            '4N_L': 115,
-            '4N_R': 115,
-            'SNC_L': 374,
-            'SNC_R': 374,
-            'VLL_L': 612,
-            'VLL_R': 612,
-            '5N_L': 621,
-            '5N_R': 621,
-            'LC_L': 147,
-            'LC_R': 147,
-            'DC_L': 96,
-            'DC_R': 96,
-            'Sp5C_L': 429,
-            'Sp5C_R': 429,
-            'Sp5I_L': 437,
-            'Sp5I_R': 437,
-            'Sp5O_L': 445,
-            'Sp5O_R': 445,
-            '6N_L': 653,
-            '6N_R': 653,
-            '7N_L': 661,
-            '7N_R': 661,
-            '7n_L': 798,
-            '7n_R': 798,
-            'Amb_L': 135,
-            'Amb_R': 135,
-            'LRt_L': 235,
-            'LRt_R': 235,
-        }   
-        color = 1
-        return allen_structures.get(str(label), color)
+        return ALLEN_STRUCTURE_COLORS.get(str(label), COLOR)
 
     @staticmethod
     def bspliner(cv, n=100, degree=3):
@@ -418,18 +553,45 @@ class AnnotationSessionManager():
         numpy.ndarray: Array of points representing the B-spline curve.
         """
 
-        cv = np.asarray(cv)
+        cv = np.asarray(cv, dtype=np.float64)
         count = len(cv)
-        degree = np.clip(degree,1,count-1)
-
-        # Calculate knot vector
-        kv = np.concatenate(([0]*degree, np.arange(count-degree+1), [count-degree]*degree))
+        if count < 2:
+            # Calculate knot vector
+            degree = np.clip(degree,1,count-1)
+            kv = np.concatenate(([0]*degree, np.arange(count-degree+1), [count-degree]*degree))
+            # Calculate query range
+            u = np.linspace(False,(count-degree),n)
+            return np.array(si.splev(u, (kv,cv.T,degree))).T
 
-        # Calculate query range
-        u = np.linspace(False,(count-degree),n)
-
-        # Calculate result
-        return np.array(si.splev(u, (kv,cv.T,degree))).T   
+        return bspline_basis(count, int(degree), int(n)) @ cv
 
+    @staticmethod
+    def resample_sections(sections, n=100, degree=3):
+        """
+        Resamples the polygons of many sections with B-splines. The sections with the
+        same number of points are stacked side by side and resampled with one product
+        of the basis matrix.
 
+        Parameters:
+        sections (dict): The polygon points indexed by section.
+        n (int, optional): Number of points of every resampled polygon. Default is 100.
+        degree (int, optional): Degree of the B-spline. Default is 3.
 
+        Returns:
+        dict: The resampled n x 2 polygons indexed by section.
+        """
+        by_count = defaultdict(list)
+        for section, points in sections.items():
+            by_count[len(points)].append(section)
+
+        resampled = {}
+        for count, group in by_count.items():
+            if count < 2:
+                for section in group:
+                    resampled[section] = AnnotationSessionManager.bspliner(sections[section], n, degree)
+                continue
+            stacked = np.hstack([np.asarray(sections[section], dtype=np.float64) for section in group])
+            curves = bspline_basis(count, int(degree), int(n)) @ stacked
+            for i, section in enumerate(group):
+                resampled[section] = curves[:, 2 * i:2 * i + 2]
+        return resampled
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class NeuroglancerConfig(AppConfig):
     name = 'neuroglancer'
+
+    def ready(self):
+        # connects the signals keeping the search index up to date
+        from neuroglancer import signals  # noqa: F401
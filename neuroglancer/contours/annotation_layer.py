@@ -1,8 +1,10 @@
 import string
 import random
+from collections.abc import Sequence
 import numpy as np
 from django.http.response import Http404
 from neuroglancer.models import UNMARKED, DEBUG
+from neuroglancer.contours.edge_chain import chain_order
 from timeit import default_timer as timer
 
 default_annotation_layer = dict(
@@ -263,6 +265,228 @@ class AnnotationLayer:
         ...
 
 
+TYPE_CODES = {'point': 0, 'cell': 1, 'com': 2, 'line': 3, 'polygon': 4, 'volume': 5, 'cloud': 6}
+TYPE_NAMES = np.array(list(TYPE_CODES.keys()))
+POINT_TYPES = (TYPE_CODES['point'], TYPE_CODES['cell'], TYPE_CODES['com'])
+NAN_POINT = (np.nan, np.nan, np.nan)
+
+
+class ColumnarAnnotationLayer:
+    """Columnar (struct of arrays) version of AnnotationLayer.
+
+    Instead of one Python object per point or line, the layer is stored as arrays:
+
+    * ids: the UUID of every annotation, with a dictionary from UUID to row index
+    * type_codes: integer type of every annotation, see TYPE_CODES
+    * coords: N x 3 float array of the point, or pointA for lines
+    * coords_end: N x 3 float array of pointB for lines, NaN for the others
+    * parent_index: index of the parent annotation, -1 if there is none
+    * child_offsets, child_index: CSR arrays of the children, the children of
+      annotation i are child_index[child_offsets[i]:child_offsets[i + 1]] in the
+      order of childAnnotationIds
+
+    All the parent and child UUIDs are resolved to row indexes in one pass, so grouping
+    the lines into polygons and the polygons into volumes is a couple of array
+    operations instead of a loop over every annotation object. The Point, Polygon and
+    Volume objects are only created when the old API (annotations, get_volumes()) is
+    used, polygons get their points as an array and the Line objects are only created
+    when polygon.childs is read.
+    """
+
+    def __init__(self, annotation_layer=default_annotation_layer):
+        """Initiates the layer with the neuroglancer json state of one layer
+
+        Args:
+            annotation_layer (dict, optional): The neuroglancer json state of one annotation layer. Defaults to default_annotation_layer.
+        Raises:
+            Http404: django http404 response
+        """
+        if annotation_layer.get('type') != 'annotation':
+            raise Http404
+        self.name = annotation_layer['name']
+        if 'tool' in annotation_layer:
+            self.tool = annotation_layer['tool']
+        self.source = annotation_layer['source']
+        self._type = 'annotation'
+        self._annotations = None
+        self._objects = {}
+        self.parse_annotations(annotation_layer['annotations'])
+
+    def parse_annotations(self, rows):
+        """Fills the arrays with one pass over the annotation rows.
+
+        :param rows: list of neuroglancer annotation dictionaries
+        """
+        start_time = timer()
+        n = len(rows)
+        self.rows = rows
+        self.ids = [row['id'] for row in rows]
+        self.id_to_index = {id: i for i, id in enumerate(self.ids)}
+        if len(self.id_to_index) != n:
+            raise ValueError('Annotation ids must be unique')
+        self.type_codes = np.fromiter((TYPE_CODES.get(row.get('type'), -1) for row in rows), dtype=np.int8, count=n)
+        self.coords = np.array([row.get('point', row.get('pointA', NAN_POINT)) for row in rows], dtype=np.float64).reshape(n, 3)
+        self.coords_end = np.array([row.get('pointB', NAN_POINT) for row in rows], dtype=np.float64).reshape(n, 3)
+
+        self.parent_index = self.index_of([row.get('parentAnnotationId') for row in rows])
+
+        child_lists = [row.get('childAnnotationIds', ()) for row in rows]
+        counts = np.fromiter((len(child_ids) for child_ids in child_lists), dtype=np.int64, count=n)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.child_offsets[1:])
+        self.child_index = self.index_of([child_id for child_ids in child_lists for child_id in child_ids])
+
+        # children that exist are grouped under their parent and are not top level annotations
+        self.is_child = np.zeros(n, dtype=bool)
+        grouping = np.isin(self.type_codes, (TYPE_CODES['polygon'], TYPE_CODES['volume']))
+        grouped_children = self.child_index[np.repeat(grouping, counts)]
+        self.is_child[grouped_children[grouped_children >= 0]] = True
+
+        if DEBUG:
+            end_time = timer()
+            total_elapsed_time = round((end_time - start_time), 2)
+            print(f'Parsing {n} annotations into arrays took {total_elapsed_time} seconds.')
+
+    def index_of(self, ids):
+        """Returns the row indexes of a list of UUIDs, -1 for UUIDs (or None) that are not in the layer.
+
+        :param ids: list of UUID strings
+        """
+        get = self.id_to_index.get
+        return np.fromiter((get(id, -1) for id in ids), dtype=np.int64, count=len(ids))
+
+    def children_of(self, index):
+        """Returns the indexes of the existing children of an annotation, in order."""
+        children = self.child_index[self.child_offsets[index]:self.child_offsets[index + 1]]
+        return children[children >= 0]
+
+    def indexes_of_type(self, _type):
+        """Returns the indexes of the top level annotations of a type."""
+        return np.flatnonzero((self.type_codes == TYPE_CODES[_type]) & ~self.is_child)
+
+    def get_polygon_points(self, index):
+        """Returns the start points of the lines of a polygon as an N x 3 array."""
+        return self.coords[self.children_of(index)]
+
+    def get_volume_contours(self, index):
+        """Returns a list of N x 3 arrays, one for every polygon of a volume."""
+        return [self.get_polygon_points(child) for child in self.children_of(index)]
+
+    def reorder_polygon_points(self):
+        """Puts the lines of every polygon in drawing order, starting at the source of the polygon.
+        Only the child index arrays are changed, so this has to be called before the
+        annotation objects are created.
+        """
+        for index in np.flatnonzero(self.type_codes == TYPE_CODES['polygon']):
+            start, end = self.child_offsets[index], self.child_offsets[index + 1]
+            children = self.child_index[start:end]
+            children = children[children >= 0]
+            if len(children) != end - start:
+                continue
+            order = chain_order(self.coords[children], self.coords_end[children], first_point=self.rows[index]['source'])
+            self.child_index[start:end] = children[order]
+
+    def get_object(self, index):
+        """Creates (once) the annotation object of a row, with its children."""
+        if index in self._objects:
+            return self._objects[index]
+        row = self.rows[index]
+        type_code = self.type_codes[index]
+        if type_code in POINT_TYPES:
+            classes = {TYPE_CODES['com']: COM, TYPE_CODES['point']: Point, TYPE_CODES['cell']: Cell}
+            annotation = classes[type_code](id=row['id'], coord=self.coords[index])
+            if 'description' in row:
+                annotation.description = row['description']
+            if 'category' in row:
+                annotation.category = row['category'] if row['category'] != '' else UNMARKED
+        elif type_code == TYPE_CODES['line']:
+            annotation = Line(self.coords[index], self.coords_end[index], row['id'])
+            if 'parentAnnotationId' in row:
+                annotation.parent_id = row['parentAnnotationId']
+            if 'description' in row:
+                annotation.description = row['description']
+        elif type_code in (TYPE_CODES['polygon'], TYPE_CODES['volume']):
+            _class = Polygon if type_code == TYPE_CODES['polygon'] else Volume
+            annotation = _class(row['id'], row['childAnnotationIds'], row['source'])
+            if 'description' in row:
+                annotation.description = row['description']
+            if 'parentAnnotationId' in row and type_code == TYPE_CODES['polygon']:
+                annotation.parent_id = row['parentAnnotationId']
+            children = self.children_of(index)
+            if type_code == TYPE_CODES['polygon']:
+                annotation.points = self.coords[children]
+            annotation.childs = ChildAnnotations(self, children)
+        else:
+            annotation = Annotation()
+            annotation.id = row['id']
+            annotation._type = row.get('type')
+        self._objects[index] = annotation
+        return annotation
+
+    @property
+    def annotations(self):
+        """The top level annotation objects, like AnnotationLayer.annotations after grouping."""
+        if self._annotations is None:
+            indexes = np.flatnonzero(~self.is_child)
+            self._annotations = np.array([self.get_object(i) for i in indexes])
+        return self._annotations
+
+    def search_annotation_with_id(self, id):
+        """search in the annotations in the layer for one with a set id
+
+        :param id: UUID annotation id set by neuroglancer
+        """
+        index = self.id_to_index.get(id, -1)
+        if index < 0:
+            print('annotation not found')
+            return None
+        return self.get_object(index)
+
+    def get_annotation_with_id(self, id):
+        """Returns the top level annotation object with a set id
+
+        :param id: UUID string assigned by neuroglancer
+        """
+        index = self.id_to_index.get(id, -1)
+        if index < 0 or self.is_child[index]:
+            print("annotation not found")
+            return None
+        return self.get_object(index)
+
+    def get_volumes(self):
+        """return all the volumes in this layer
+        Returns:
+            list: list of volume annotations
+        """
+        return [self.get_object(i) for i in self.indexes_of_type('volume')]
+
+    def get_polygons(self):
+        """get list of all the polygons that are not part of a volume
+        Returns:
+            list: list of polygon annotations
+        """
+        return [self.get_object(i) for i in self.indexes_of_type('polygon')]
+
+
+class ChildAnnotations(Sequence):
+    """The children of a polygon or volume in a ColumnarAnnotationLayer. The child objects
+    are only created when they are used, so saving a volume through Polygon.points never
+    creates the Line objects.
+    """
+
+    def __init__(self, layer, indexes):
+        self.layer = layer
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.layer.get_object(index) for index in self.indexes[i]]
+        return self.layer.get_object(self.indexes[i])
+
+
 class Annotation:
     """generic annotation type, serves as the base type for all annotations
     """
@@ -411,6 +635,8 @@ class Polygon(Annotation):
         Returns:
             _type_: _description_
         """
+        if getattr(self, 'points', None) is not None:
+            return self.points
         return np.array([i.coord_start for i in self.childs])
 
     def get_section_direction(self, points):
@@ -502,10 +728,6 @@ class ContourSorter:
         self.end_points = np.array(end_points)
         self.check_input_dimensions()
         self.npoints = len(self.start_points)
-        self.sort_index = []
-        first_point_index = self.find_index_of_point_in_array(
-            first_point, self.start_points)
-        self.sort_index.append(first_point_index)
         self.sort_points()
 
     def check_input_dimensions(self):
@@ -519,37 +741,15 @@ class ContourSorter:
         assert len(self.start_points[0]) == len(
             self.end_points[0]) == len(self.first_point) == 3
 
-    def find_index_of_point_in_array(self, point, array):
-        '''
-        Finding the index of the point in the array according to x,y,z, coordinates
-        :param point: x,y,z coordinates
-        :param array: array of which we are searching
-        '''
-        result = np.where(np.all(array == point, axis=1))[0]
-        assert len(result) == 1
-        return result[0]
-
     def sort_points(self):
         '''
-        Main function that sorts the orders of points
+        Main function that sorts the orders of points. The lines are chained with a hash
+        table of the start points so this is linear in the number of points.
         '''
-        while len(self.sort_index) < self.npoints:
-            last_point_index = self.sort_index[-1]
-            next_point_index = self.find_index_of_next_point(last_point_index)
-            self.sort_index.append(next_point_index)
+        self.sort_index = chain_order(self.start_points, self.end_points, first_point=self.first_point)
         check_if_contour_points_are_in_order(
             self.first_point, self.start_points[self.sort_index], self.end_points[self.sort_index])
 
-    def find_index_of_next_point(self, last_point_index):
-        '''
-        Find the index of the point next to the current point
-        :param last_point_index:index of the last point
-        '''
-        last_end_point = self.end_points[last_point_index]
-        next_start_index = self.find_index_of_point_in_array(
-            last_end_point, self.start_points)
-        return next_start_index
-
 
 def check_if_contour_points_are_in_order(first_point, start_points, end_points):
     '''
@@ -42,7 +42,7 @@ from neuroglancer.models import AnnotationSession, BrainRegion, DEBUG, \
     PolygonSequence, StructureCom, PolygonSequence, MarkedCell, get_region_from_abbreviation
 from neuroglancer.contours import get_scales
 from neuroglancer.models import CellType, UNMARKED
-from neuroglancer.contours.annotation_layer import AnnotationLayer, Annotation, random_string
+from neuroglancer.contours.annotation_layer import ColumnarAnnotationLayer, Annotation, random_string
 from neuroglancer.contours.annotation_base import AnnotationBase
 from timeit import default_timer as timer
 
@@ -72,7 +72,7 @@ class AnnotationManager(AnnotationBase):
 
     def set_current_layer(self, state_layer):
         """set the current layer attribute from a layer component of neuroglancer json state.
-           The incoming neuroglancer json state is parsed by a custom class named AnnotationLayer that 
+           The incoming neuroglancer json state is parsed by a custom class named ColumnarAnnotationLayer that 
            groups points according to it's membership to a polygon seqence or volume
 
         :param state_layer (dict): neuroglancer json state component of an annotation layer in dictionary form
@@ -80,7 +80,7 @@ class AnnotationManager(AnnotationBase):
 
         assert 'name' in state_layer
         self.label = str(state_layer['name']).strip()
-        self.current_layer = AnnotationLayer(state_layer) # This takes a long time
+        self.current_layer = ColumnarAnnotationLayer(state_layer)
 
 
     def insert_annotations(self):
@@ -220,13 +220,12 @@ class AnnotationManager(AnnotationBase):
 
         batch = []
         for polygon in annotation.childs:
-            point_order = 1
             polygon_index = random_string()
-            z = mode([int(np.floor(coord.coord_start[2]) * float(self.z_scale)) for coord in polygon.childs])
-            for child in polygon.childs:
-                xa, ya, _ = child.coord_start * (self.scales).astype(np.float64)
+            points = polygon.to_numpy()
+            z = mode((np.floor(points[:, 2]).astype(int) * float(self.z_scale)).astype(int))
+            scaled = points * (self.scales).astype(np.float64)
+            for point_order, (xa, ya, _) in enumerate(scaled, start=1):
                 polygon_sequence = PolygonSequence(annotation_session=annotation_session, x=xa, y=ya, z=z, point_order=point_order, polygon_index=str(polygon_index))
-                point_order += 1
                 batch.append(polygon_sequence)
                 
         PolygonSequence.objects.bulk_create(batch, self.batch_size, ignore_conflicts=True)
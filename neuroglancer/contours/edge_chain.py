@@ -0,0 +1,151 @@
+"""Orders the line segments of a polygon so that every segment starts where the
+previous one ended.
+
+Neuroglancer stores a polygon as line annotations with a pointA and a pointB and the
+lines are not always in drawing order. The old sorters searched all the lines for
+every next point which is quadratic in the number of vertices. Here the start points
+are put in a hash table keyed by their coordinates rounded to the tolerance, so
+finding the next line is a dictionary lookup and the whole chain is walked in
+linear time.
+
+Two points are the same vertex when they are equal within the tolerance of
+:func:`neuroglancer.contours.annotation_layer.check_if_contour_points_are_in_order`,
+i.e. ``np.isclose(a, b, atol=0.1)``. Points that are close but rounded into
+neighbouring cells are found by looking in the 26 neighbouring cells, and as a last
+resort with one vectorized comparison against the lines that are left.
+"""
+from itertools import product
+import numpy as np
+
+ATOL = 0.1
+# the default relative tolerance of np.isclose
+RTOL = 1e-05
+NEIGHBOURS = [offset for offset in product((-1, 0, 1), repeat=3) if offset != (0, 0, 0)]
+
+
+class EdgeChain:
+    """Hash table of the start points of a list of line segments.
+    """
+
+    def __init__(self, start_points, end_points, atol=ATOL):
+        """
+        :param start_points: N x 3 array of the pointA of every line
+        :param end_points: N x 3 array of the pointB of every line
+        :param atol: absolute tolerance for two points to be the same vertex
+        """
+        self.start_points = np.asarray(start_points, dtype=np.float64).reshape(-1, 3)
+        self.end_points = np.asarray(end_points, dtype=np.float64).reshape(-1, 3)
+        if len(self.start_points) != len(self.end_points):
+            raise ValueError('There must be as many start points as end points')
+        self.atol = atol
+        self.npoints = len(self.start_points)
+        self.used = np.zeros(self.npoints, dtype=bool)
+        # key -> indexes of the lines starting in that cell, in input order. Lines that
+        # are used are removed when they are found or skipped when they are seen again.
+        self.buckets = {}
+        for i, key in enumerate(map(tuple, self.keys(self.start_points).tolist())):
+            self.buckets.setdefault(key, []).append(i)
+        # plain lists are much faster than numpy for one point at a time
+        self.start_list = self.start_points.tolist()
+        self.end_list = self.end_points.tolist()
+        self.end_keys = list(map(tuple, self.keys(self.end_points).tolist()))
+
+    def keys(self, points):
+        return np.round(np.asarray(points, dtype=np.float64) / self.atol).astype(np.int64)
+
+    def is_close(self, index, point):
+        """Same test as np.all(np.isclose(start_point, point, atol=atol))."""
+        return all(abs(a - b) <= self.atol + RTOL * abs(b) for a, b in zip(self.start_list[index], point))
+
+    def pop_from_bucket(self, key, point):
+        """Returns the first unused line in a cell that starts at the point, or None."""
+        bucket = self.buckets.get(key)
+        if not bucket:
+            return None
+        for position, index in enumerate(bucket):
+            if not self.used[index] and self.is_close(index, point):
+                del bucket[position]
+                return index
+        return None
+
+    def find_start(self, point, key=None):
+        """Returns the index of an unused line starting at the point or None.
+
+        :param point: x,y,z coordinates
+        :param key: the hash key of the point if it is already known
+        """
+        point = [float(x) for x in point]
+        if key is None:
+            key = tuple(self.keys(point).tolist())
+        index = self.pop_from_bucket(key, point)
+        if index is not None:
+            return index
+        for offset in NEIGHBOURS:
+            index = self.pop_from_bucket((key[0] + offset[0], key[1] + offset[1], key[2] + offset[2]), point)
+            if index is not None:
+                return index
+        # np.isclose also has a relative tolerance, so very large coordinates can be
+        # further apart than one cell
+        candidates = np.flatnonzero(~self.used & np.all(np.isclose(self.start_points, point, atol=self.atol), axis=1))
+        if len(candidates) == 0:
+            return None
+        return candidates[0]
+
+    def order(self, first_index=0):
+        """Walks the chain from the first line and returns the order of the lines.
+        When the chain is broken, it goes on with the first line that is not used yet,
+        so every line is in the result exactly once.
+
+        :param first_index: index of the line to start with
+        :return: array of line indexes
+        """
+        result = np.empty(self.npoints, dtype=np.int64)
+        if self.npoints == 0:
+            return result
+        current = first_index
+        next_unused = 0
+        for n in range(self.npoints):
+            self.used[current] = True
+            result[n] = current
+            if n == self.npoints - 1:
+                break
+            following = self.find_start(self.end_list[current], self.end_keys[current])
+            if following is None:
+                while self.used[next_unused]:
+                    next_unused += 1
+                following = next_unused
+            current = following
+        return result
+
+
+def chain_order(start_points, end_points, first_point=None, atol=ATOL):
+    """Returns the indexes that put the line segments of a polygon in order.
+
+    :param start_points: N x 3 array of the pointA of every line
+    :param end_points: N x 3 array of the pointB of every line
+    :param first_point: optional x,y,z coordinates where the polygon starts,
+        the first line is used when this is None
+    :param atol: absolute tolerance for two points to be the same vertex
+    :return: array of line indexes
+    """
+    chain = EdgeChain(start_points, end_points, atol)
+    first_index = 0
+    if first_point is not None and chain.npoints > 0:
+        first_index = chain.find_start(first_point)
+        if first_index is None:
+            raise ValueError(f'The first point {first_point} is not the start of a line')
+    return chain.order(first_index)
+
+
+def chain_rows(rows, atol=ATOL):
+    """Orders a list of Neuroglancer line dictionaries with a pointA and pointB,
+    starting with the first one.
+
+    :param rows: list of line annotation dictionaries
+    :return: a new list of the same dictionaries
+    """
+    if not rows:
+        return rows
+    start_points = [row['pointA'] for row in rows]
+    end_points = [row['pointB'] for row in rows]
+    return [rows[i] for i in chain_order(start_points, end_points, atol=atol)]
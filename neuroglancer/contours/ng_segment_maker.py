@@ -38,7 +38,14 @@ class NgConverter(NumpyToNeuroglancer):
         self.precomputed_vol = CloudVolume(
             f'file://{path}', mip=0, info=info, compress=True, progress=True)
         self.precomputed_vol.commit_info()
-        self.precomputed_vol[:, :, :] = self.volume
+        if isinstance(self.volume, np.ndarray):
+            self.precomputed_vol[:, :, :] = self.volume
+        else:
+            # a volume that yields (z start, x,y,z block) is written one block at a time
+            z_offset = self.precomputed_vol.bounds.minpt.z
+            for z_start, block in self.volume:
+                z_start += z_offset
+                self.precomputed_vol[:, :, z_start:z_start + block.shape[2]] = block
 
     def create_neuroglancer_files(self, output_dir, segment_properties):
         self.reset_output_path(output_dir)
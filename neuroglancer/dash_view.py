@@ -8,7 +8,7 @@ def dash_scatter_view(request, template_name="dash_point_table.html", **kwargs):
     pk = kwargs['pk']
     dash_context = request.session.get("django_plotly_dash", dict())
     dash_context['pk'] = pk
-    neuroglancerState = NeuroglancerState.objects.get(pk=pk)
+    neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=pk)
     animal = neuroglancerState.animal
     scanRun = ScanRun.objects.get(prep_id__exact=animal)
     df = neuroglancerState.points
@@ -10,7 +10,7 @@ def create_2DgraphXXX():
     img_height = 36000
 
     id = 200
-    neuroglancerState = NeuroglancerState.objects.get(pk=id)
+    neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=id)
     df = neuroglancerState.points
     df.reset_index(inplace=True)
     df['ID'] = df.index
@@ -100,7 +100,7 @@ def create_2Dgraph(animal, section):
     img_height = 36000
 
     id = 200
-    neuroglancerState = NeuroglancerState.objects.get(pk=id)
+    neuroglancerState = NeuroglancerState.objects.defer('neuroglancer_state').get(pk=id)
     df = neuroglancerState.points
     df.reset_index(inplace=True)
     df['ID'] = df.index
@@ -0,0 +1,181 @@
+"""Applies partial updates to the annotation JSON of a session so a small edit in
+Neuroglancer does not have to send the whole volume back.
+
+Two formats are accepted:
+
+#. an RFC 6902 JSON Patch, a list of operations such as
+   ``{"op": "replace", "path": "/childJsons/3/childJsons/0/pointA", "value": [1, 2, 3]}``.
+   All six operations are supported: add, remove, replace, move, copy and test.
+#. a delta of the children of a volume or polygon keyed by annotation ID:
+   ``{"children": [polygon, ...], "removed": [id, ...]}``. A child in ``children``
+   replaces the child with the same ID or is appended, and the IDs in ``removed``
+   are deleted. ``childAnnotationIds`` is kept in sync.
+
+The document is changed in place. When an operation fails a JsonPatchError is raised
+and the caller must throw the document away.
+"""
+
+
+class JsonPatchError(ValueError):
+    """Raised when a patch is not valid or cannot be applied to the document."""
+
+
+def parse_pointer(path):
+    """Splits a JSON Pointer (RFC 6901) into its unescaped tokens."""
+    if not isinstance(path, str) or (path and not path.startswith('/')):
+        raise JsonPatchError(f'Invalid JSON pointer: {path!r}')
+    if path == '':
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
+
+
+def get_index(container, token, path, append=False):
+    if append and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchError(f'Invalid array index {token!r} in {path}')
+    index = int(token)
+    size = len(container) + 1 if append else len(container)
+    if index >= size:
+        raise JsonPatchError(f'Array index {index} is out of range in {path}')
+    return index
+
+
+def resolve(document, tokens, path):
+    """Returns the value the tokens point to."""
+    value = document
+    for token in tokens:
+        if isinstance(value, dict):
+            if token not in value:
+                raise JsonPatchError(f'{path} does not exist')
+            value = value[token]
+        elif isinstance(value, list):
+            value = value[get_index(value, token, path)]
+        else:
+            raise JsonPatchError(f'{path} does not exist')
+    return value
+
+
+def get_value(document, path):
+    return resolve(document, parse_pointer(path), path)
+
+
+def add_value(document, path, value):
+    tokens = parse_pointer(path)
+    if len(tokens) == 0:
+        return value
+    parent = resolve(document, tokens[:-1], path)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(get_index(parent, token, path, append=True), value)
+    else:
+        raise JsonPatchError(f'The parent of {path} is not an object or an array')
+    return document
+
+
+def remove_value(document, path):
+    """Removes the value at the path and returns it."""
+    tokens = parse_pointer(path)
+    if len(tokens) == 0:
+        raise JsonPatchError('The whole document cannot be removed')
+    parent = resolve(document, tokens[:-1], path)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError(f'{path} does not exist')
+        return parent.pop(token)
+    if isinstance(parent, list):
+        return parent.pop(get_index(parent, token, path))
+    raise JsonPatchError(f'{path} does not exist')
+
+
+def copy_value(value):
+    """Deep copy of plain JSON data, much faster than copy.deepcopy."""
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+
+def apply_patch(document, operations):
+    """Applies a JSON Patch to the document.
+
+    :param document: the JSON document, changed in place
+    :param operations: list of JSON Patch operations
+    :return: the patched document, which is a new object only if the root was replaced
+    """
+    if not isinstance(operations, list):
+        raise JsonPatchError('A JSON Patch must be a list of operations')
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise JsonPatchError(f'Invalid operation: {operation!r}')
+        op = operation['op']
+        path = operation['path']
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise JsonPatchError(f'The {op} operation needs a value')
+        if op in ('move', 'copy') and 'from' not in operation:
+            raise JsonPatchError(f'The {op} operation needs a from')
+
+        if op == 'add':
+            document = add_value(document, path, operation['value'])
+        elif op == 'remove':
+            remove_value(document, path)
+        elif op == 'replace':
+            if parse_pointer(path):
+                remove_value(document, path)
+            document = add_value(document, path, operation['value'])
+        elif op == 'move':
+            source = operation['from']
+            if path != source and path.startswith(source + '/'):
+                raise JsonPatchError(f'{source} cannot be moved into one of its children')
+            value = remove_value(document, source)
+            document = add_value(document, path, value)
+        elif op == 'copy':
+            value = copy_value(get_value(document, operation['from']))
+            document = add_value(document, path, value)
+        elif op == 'test':
+            if get_value(document, path) != operation['value']:
+                raise JsonPatchError(f'Test failed for {path}')
+        else:
+            raise JsonPatchError(f'Unknown operation: {op!r}')
+    return document
+
+
+def apply_children_delta(annotation, delta):
+    """Applies a delta of changed children to a volume or polygon annotation.
+
+    :param annotation: the annotation JSON with its childJsons, changed in place
+    :param delta: dictionary with optional 'children' and 'removed' lists
+    :return: the annotation
+    """
+    if not isinstance(annotation, dict):
+        raise JsonPatchError('The annotation is not an object')
+    children = delta.get('children', [])
+    removed = delta.get('removed', [])
+    if not isinstance(children, list) or not isinstance(removed, list):
+        raise JsonPatchError('children and removed must be lists')
+    if any(not isinstance(child, dict) or 'id' not in child for child in children):
+        raise JsonPatchError('Every child needs an id')
+
+    child_jsons = annotation.setdefault('childJsons', [])
+    child_ids = annotation.setdefault('childAnnotationIds', [child.get('id') for child in child_jsons])
+    positions = {child.get('id'): i for i, child in enumerate(child_jsons)}
+    missing = [id for id in removed if id not in positions]
+    if missing:
+        raise JsonPatchError(f'The children {missing} do not exist')
+
+    for child in children:
+        if child['id'] in positions:
+            child_jsons[positions[child['id']]] = child
+        else:
+            positions[child['id']] = len(child_jsons)
+            child_jsons.append(child)
+            child_ids.append(child['id'])
+    if removed:
+        removed = set(removed)
+        annotation['childJsons'] = [child for child in child_jsons if child.get('id') not in removed]
+        annotation['childAnnotationIds'] = [id for id in child_ids if id not in removed]
+    return annotation
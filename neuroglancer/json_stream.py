@@ -0,0 +1,289 @@
+"""A small streaming JSON extractor for the large Neuroglancer states.
+
+``json.loads`` turns a 100 MB Neuroglancer state into more than a gigabyte of Python
+dictionaries, even when we only want the names of the layers. This module
+walks the raw JSON text (a string, bytes or a file like object read in chunks) and
+only decodes the values that were asked for. Everything else is skipped without
+building the dictionaries: text that is already in memory is skipped by the C
+JSON scanner with the objects thrown away as they are parsed, and files are read
+in chunks and skipped with regular expressions.
+
+A path is a tuple of object keys and '*' for every element of an array, e.g.:
+
+* ``('layers', '*', 'name')`` the name of every layer
+* ``('layers', '*', 'annotations')`` the annotations of every layer
+
+Examples::
+
+    names = list(iter_path(raw, ('layers', '*', 'name')))
+    counts = list(iter_items(raw, ('layers', '*'), keys=('name',), counts=('annotations',)))
+"""
+import codecs
+import json
+import re
+
+WILDCARD = '*'
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+SCALAR_RE = re.compile(r'[^,:\]}\s]+')
+# Skips everything that is not a bracket, including whole strings, and captures the next bracket
+BRACKET_RE = re.compile(r'(?:[^"\[\]{}]|"(?:[^"\\]|\\.)*")*([\[\]{}])', re.DOTALL)
+# Decodes a value but throws away every object as soon as it is parsed, so skipping
+# a large in-memory value only keeps lists of None instead of all the dictionaries.
+SKIP_DECODER = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+DECODER = json.JSONDecoder()
+
+
+class JsonStream:
+    """A pull tokenizer over JSON text that keeps at most one chunk plus the value
+    being decoded in memory.
+    """
+
+    def __init__(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param source: JSON as a str, bytes or an object with a read() method
+        :param chunk_size: number of characters or bytes read at a time from a file
+        """
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.mark = None
+        self.file = None
+        self.decoder = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.buf = bytes(source).decode('utf-8')
+            self.eof = True
+        elif isinstance(source, str):
+            self.buf = source
+            self.eof = True
+        else:
+            self.buf = ''
+            self.file = source
+            self.eof = False
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def fill(self):
+        """Reads the next chunk and drops the part of the buffer that has been consumed.
+
+        :return: True if more data was read
+        """
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        final = not chunk
+        if isinstance(chunk, (bytes, bytearray)) or final:
+            chunk = self.decoder.decode(chunk or b'', final=final)
+        if final:
+            self.eof = True
+        keep = self.pos if self.mark is None else min(self.mark, self.pos)
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark -= keep
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character without consuming it."""
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at position {self.pos}')
+        self.pos += 1
+
+    def read_string(self):
+        self.peek()
+        while True:
+            match = STRING_RE.match(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                text = match.group()
+                return text[1:-1] if '\\' not in text else json.loads(text)
+            if not self.fill():
+                raise ValueError(f'Unterminated string at position {self.pos}')
+
+    def skip_scalar(self):
+        while True:
+            match = SCALAR_RE.match(self.buf, self.pos)
+            if match is None:
+                raise ValueError(f'Invalid JSON value at position {self.pos}')
+            if match.end() < len(self.buf) or not self.fill():
+                self.pos = match.end()
+                return
+
+    def skip_value(self):
+        """Skips one value of any type without keeping it."""
+        char = self.peek()
+        if self.file is None:
+            _, self.pos = SKIP_DECODER.raw_decode(self.buf, self.pos)
+            return
+        if char == '"':
+            while True:
+                match = STRING_RE.match(self.buf, self.pos)
+                if match is not None:
+                    self.pos = match.end()
+                    return
+                if not self.fill():
+                    raise ValueError(f'Unterminated string at position {self.pos}')
+        if char not in '[{':
+            self.skip_scalar()
+            return
+        self.pos += 1
+        depth = 1
+        while depth > 0:
+            match = BRACKET_RE.match(self.buf, self.pos)
+            if match is None:
+                if not self.fill():
+                    raise ValueError('Unexpected end of JSON')
+                continue
+            self.pos = match.end()
+            depth += 1 if match.group(1) in '[{' else -1
+
+    def read_value(self):
+        """Decodes and returns the next value."""
+        self.peek()
+        if self.file is None:
+            value, self.pos = DECODER.raw_decode(self.buf, self.pos)
+            return value
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return json.loads(self.buf[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def iter_array(self):
+        """Consumes an array and yields once for every element. The caller must
+        consume the element before asking for the next one.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'Expected , or ] at position {self.pos - 1}')
+
+    def iter_object(self):
+        """Consumes an object and yields every key. The caller must consume
+        the value before asking for the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'Expected , or }} at position {self.pos - 1}')
+
+    def count_array(self):
+        """Returns the number of elements in the next array without decoding them."""
+        if self.peek() != '[':
+            self.skip_value()
+            return 0
+        if self.file is None:
+            values, self.pos = SKIP_DECODER.raw_decode(self.buf, self.pos)
+            return len(values)
+        count = 0
+        for _ in self.iter_array():
+            self.skip_value()
+            count += 1
+        return count
+
+    def walk(self, path, handler):
+        """Yields handler() for every value matching the path and skips the rest."""
+        if len(path) == 0:
+            yield handler()
+            return
+        step, rest = path[0], path[1:]
+        char = self.peek()
+        if step == WILDCARD and char == '[':
+            for _ in self.iter_array():
+                yield from self.walk(rest, handler)
+        elif step != WILDCARD and char == '{':
+            for key in self.iter_object():
+                if key == step:
+                    yield from self.walk(rest, handler)
+                else:
+                    self.skip_value()
+        else:
+            self.skip_value()
+
+    def search(self, name):
+        """Yields the value of every object member called name, at any depth."""
+        char = self.peek()
+        if char == '{':
+            for key in self.iter_object():
+                if key == name:
+                    yield self.read_value()
+                else:
+                    yield from self.search(name)
+        elif char == '[':
+            for _ in self.iter_array():
+                yield from self.search(name)
+        else:
+            self.skip_value()
+
+
+def iter_path(source, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the decoded values found at the path.
+
+    :param source: JSON as a str, bytes or file like object
+    :param path: tuple of keys and '*'
+    """
+    stream = JsonStream(source, chunk_size)
+    yield from stream.walk(tuple(path), stream.read_value)
+
+
+def iter_counts(source, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the length of every array found at the path, without decoding the arrays."""
+    stream = JsonStream(source, chunk_size)
+    yield from stream.walk(tuple(path), stream.count_array)
+
+
+def iter_items(source, path, keys=(), counts=(), chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields a small dictionary for every object found at the path. Only the members
+    in keys are decoded, the members in counts are replaced by the length of the array
+    and every other member is skipped. Missing members are not in the dictionary.
+    """
+    stream = JsonStream(source, chunk_size)
+
+    def handler():
+        item = {}
+        if stream.peek() != '{':
+            stream.skip_value()
+            return item
+        for key in stream.iter_object():
+            if key in keys:
+                item[key] = stream.read_value()
+            elif key in counts:
+                item[key] = stream.count_array()
+            else:
+                stream.skip_value()
+        return item
+
+    yield from stream.walk(tuple(path), handler)
+
+
+def find_values(name, source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns the values of every member called name at any depth of the JSON."""
+    stream = JsonStream(source, chunk_size)
+    return list(stream.search(name))
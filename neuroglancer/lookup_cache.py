@@ -0,0 +1,128 @@
+"""An in-process cache of the small lookup tables read on every save: the annotation
+labels, the brain regions and the cell types.
+
+Each table is loaded whole with one query and kept as dictionaries keyed by name.
+A table is loaded again when:
+
+#. it was saved or deleted in this process, the signals in :mod:`neuroglancer.signals`
+   bump its version, or
+#. it is older than LOOKUP_CACHE_TTL seconds, which picks up the changes made by the
+   other web server processes, or
+#. a name is not found in it but is in the database, e.g. a label just added by
+   another process. A name found in neither is not looked for again during
+   LOOKUP_MISS_TTL seconds.
+
+Names are matched exactly first and then case insensitively, like the default MySQL
+collation, so '7N_L' and '7n_L' stay two brain regions.
+
+The cached objects are shared by all threads and must not be changed.
+"""
+import threading
+import time
+from django.conf import settings
+
+from neuroglancer.models import AnnotationLabel, BrainRegion, CellType
+
+LOOKUP_CACHE_TTL = getattr(settings, 'LOOKUP_CACHE_TTL', 60)
+LOOKUP_MISS_TTL = getattr(settings, 'LOOKUP_MISS_TTL', 1)
+# the names remembered as missing, forgotten all at once beyond this
+MAXIMUM_MISSES = 1000
+
+
+class Lookup:
+    """The rows of a table by name, the first row by primary key wins."""
+
+    def __init__(self, rows, get_name):
+        self.rows = list(rows)
+        self.by_name = {}
+        self.by_folded_name = {}
+        for row in self.rows:
+            name = get_name(row)
+            self.by_name.setdefault(name, row)
+            self.by_folded_name.setdefault(name.casefold(), row)
+
+    def get(self, name, default=None):
+        if name in self.by_name:
+            return self.by_name[name]
+        return self.by_folded_name.get(str(name).casefold(), default)
+
+
+class LookupTable:
+    """A versioned copy of a small table, loaded on first use."""
+
+    def __init__(self, load, exists=None, ttl=LOOKUP_CACHE_TTL, miss_ttl=LOOKUP_MISS_TTL):
+        self.load = load
+        self.exists = exists
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.misses = {}
+        self.version = 0
+        self.lookup = None
+        self.loaded_version = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.lookup is None or self.loaded_version != self.version or time.monotonic() - self.loaded > self.ttl:
+                version = self.version
+                self.lookup = self.load()
+                self.loaded_version = version
+                self.loaded = time.monotonic()
+            return self.lookup
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.misses.clear()
+
+    def find(self, name):
+        """Returns the row of the name. A name missing from the table is looked for in
+        the database with exists(name), and the table is loaded again when it is there."""
+        row = self.get().get(name)
+        if row is not None or self.exists is None:
+            return row
+        with self.lock:
+            missed = self.misses.get(name)
+        if missed is not None and time.monotonic() - missed < self.miss_ttl:
+            return None
+        if self.exists(name):
+            self.invalidate()
+            return self.get().get(name)
+        with self.lock:
+            if len(self.misses) >= MAXIMUM_MISSES:
+                self.misses.clear()
+            self.misses[name] = time.monotonic()
+        return None
+
+
+labels = LookupTable(lambda: Lookup(AnnotationLabel.objects.order_by('pk'), lambda row: row.label),
+                     lambda name: AnnotationLabel.objects.filter(label__iexact=name).exists())
+brain_regions = LookupTable(lambda: Lookup(BrainRegion.objects.order_by('pk'), lambda row: row.abbreviation),
+                            lambda name: BrainRegion.objects.filter(abbreviation__iexact=name).exists())
+cell_types = LookupTable(lambda: Lookup(CellType.objects.order_by('pk'), lambda row: row.cell_type),
+                         lambda name: CellType.objects.filter(cell_type__iexact=name).exists())
+TABLES = {AnnotationLabel: labels, BrainRegion: brain_regions, CellType: cell_types}
+
+
+def invalidate(model):
+    """Reloads the table of the model on its next use."""
+    if model in TABLES:
+        TABLES[model].invalidate()
+
+
+def get_label(label):
+    return labels.find(label)
+
+
+def get_active_labels():
+    """Returns the active labels ordered by label."""
+    return sorted((row for row in labels.get().rows if row.active), key=lambda row: (row.label, row.pk))
+
+
+def get_brain_region(abbreviation):
+    return brain_regions.find(abbreviation)
+
+
+def get_cell_type(name):
+    return cell_types.find(name)
@@ -1,12 +1,18 @@
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.html import escape
+import hashlib
 import json
 import pandas as pd
 from django.template.defaultfilters import truncatechars
 from authentication.models import Lab
 from brain.models import AtlasModel, Animal, ScanRun
 from django_mysql.models import EnumField
+from neuroglancer.json_stream import WILDCARD, find_values, iter_items
+from neuroglancer.points_cache import get_points
+from neuroglancer.points_parser import PREMOTOR_LAYERS, create_points_dataframe, summarize_layers
+from neuroglancer.response_cache import get_version
 
 LAUREN_ID = 16
 MANUAL = 1
@@ -63,8 +69,9 @@ class NeuroglancerState(models.Model):
     @property
     def point_frame(self):
         df = None
-        if self.neuroglancer_state is not None:
-            point_data = self.find_values('annotations', self.neuroglancer_state)
+        state = self.get_state()
+        if state is not None:
+            point_data = self.find_values('annotations', state)
             if len(point_data) > 0:
                 d = [row['point'] for row in point_data[0]]
                 df = pd.DataFrame(d, columns=['X', 'Y', 'Section'])
@@ -75,8 +82,17 @@ class NeuroglancerState(models.Model):
 
     @property
     def points(self):
+        """Returns a DataFrame of all the points, cloud points and polygon vertices
+        in the annotation layers. The DataFrame is cached per state and updated timestamp,
+        see :mod:`neuroglancer.points_cache`
+        """
+        return get_points(self, self.create_points)
+
+    def create_points(self):
+        """Parses the annotation layers into a DataFrame. The layers are parsed in one pass,
+        see :mod:`neuroglancer.points_parser`
+        """
         result = None
-        dfs = []
         xy_resolution = 1.0
         z_resolution = 1.0
         if self.animal is not None and self.animal != 'NA':
@@ -86,107 +102,22 @@ class NeuroglancerState(models.Model):
                 z_resolution = scan_run.zresolution
         
         if self.neuroglancer_state is not None:
-            json_txt = self.neuroglancer_state
-            layers = json_txt['layers']
-            for layer in layers:
-                if 'annotations' in layer:
-                    name = layer['name']
-                    annotations = layer['annotations']
-                    ##### This is for the points
-                    point_ids = list(set(row["id"] for row in annotations if "id" in row 
-                                         and 'point' in row and "parentAnnotationId" not in row))
-                    for UUID in point_ids:
-                        points = [row['point'] for row in annotations if 'point' in row and "id" in row and row["id"] == UUID]
-                        descriptions = [row["description"] for row in annotations if "description" in row 
-                                              and 'type' in row 
-                                              and row['type'] == 'point'
-                                              and 'id' in row
-                                              and row['id'] == UUID]
-                        if len(descriptions) == 0:
-                            descriptions = 'unlabeled point'
-                        else:
-                            descriptions = descriptions[0].replace('\n', ', ')
-                        df = create_one_dataframe(points, name, UUID, 'point', 0, descriptions, xy_resolution, z_resolution)
-                        df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-                        dfs.append(df)
-                    
-                    ##### Finished with non cloud points
-                    ##### This is for cloud points
-                    cloud_parent_ids = list(set(row["id"] for row in annotations if "id" in row
-                                         and 'type' in row
-                                         and row['type'] == 'cloud'))
-
-                    for UUID in cloud_parent_ids:
-                        descriptions = [row["description"] for row in annotations if "description" in row 
-                                            and 'type' in row 
-                                            and row['type'] == 'cloud'
-                                            and 'id' in row
-                                            and row['id'] == UUID]
-                        if len(descriptions) == 0:
-                            descriptions = 'unlabeled cloud point'
-                        else:
-                            descriptions = descriptions[0].replace('\n', ', ')
-                        points = [ row['point'] for row in annotations if 'point' in row and "parentAnnotationId" in row and row["parentAnnotationId"] == UUID]
-                        df = create_one_dataframe(points, name, UUID, 'cloud', 0, descriptions, xy_resolution, z_resolution)
-                        df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-                        dfs.append(df)
-                    ##### Finished with cloud points
-
-                    ##### This is for the volumes/polygons
-                    ##### For each volume, get all the polygons and then for each polygon, get all the points
-                    volume_ids = [row['id'] for row in annotations if "id" in row and 'type' in row and row['type'] == 'volume']
-                    for volume_id in volume_ids:
-                        polygon_ids = [row['id'] for row in annotations if "id" in row 
-                                       and 'type' in row 
-                                       and row['type'] == 'polygon'
-                                       and 'parentAnnotationId' in row
-                                       and row['parentAnnotationId'] == volume_id]
-                        
-                        # The description is associated with a volume, not a polygon
-                        descriptions = [row["description"] for row in annotations if "description" in row 
-                                                and 'type' in row 
-                                                and row['type'] == 'volume'
-                                                and row['id'] == volume_id]
-                        if len(descriptions) == 0:
-                            descriptions = 'unlabeled polygon'
-                        else:
-                            descriptions = descriptions[0].replace('\n', ', ')
-                        
-                        for UUID in polygon_ids:
-                            lines = [row for row in annotations
-                                if "pointA" in row
-                                and "type" in row
-                                and row["type"] == "line"
-                                and "parentAnnotationId" in row
-                                and row["parentAnnotationId"] == UUID
-                            ]
-                            first = [round(x) for x in lines[0]['pointA']]
-                            last = [round(x) for x in lines[-1]['pointB']] 
-
-                            if first != last:
-                                lines = resort_points(lines)
-
-                            points = [row['pointA'] for row in lines]
-                            orders = [o for o in range(1, len(points) + 1)]
-                            df = create_one_dataframe(points, name, UUID, 'volume', orders, descriptions, xy_resolution, z_resolution)
-                            df = df[['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']]
-                            dfs.append(df)
-
-            if len(dfs) == 0:
-                return None
-            elif len(dfs) == 1:
-                result = dfs[0]
-            else:
-                result = pd.concat(dfs)
-
-        if DEBUG:
+            layers = self.neuroglancer_state['layers']
+            result = create_points_dataframe(layers, xy_resolution, z_resolution)
+
+        if DEBUG and result is not None:
             print(result.head())
 
-        result.sort_values(by=['Layer', 'Type', 'Labels', 'UUID', 'Section', 'Order', 'X', 'Y'], inplace=True)
         return result
 
     @property
     def layers(self):
+        """Returns the names of the annotation layers. If the JSON column has not been
+        loaded, the names are streamed from the raw JSON instead of loading the whole state.
+        """
+        if 'neuroglancer_state' in self.get_deferred_fields():
+            return [name for name, _ in self.annotation_counts]
+
         layer_list = []
         if self.neuroglancer_state is not None:
             json_txt = self.neuroglancer_state
@@ -197,6 +128,40 @@ class NeuroglancerState(models.Model):
                     layer_list.append(layer_name)
         return layer_list
 
+    @property
+    def annotation_counts(self):
+        """Returns a list of (layer name, number of annotations) for the annotation layers.
+        When the JSON column has not been loaded, the annotations are counted on the raw
+        JSON and are never decoded.
+        """
+        state = self.get_state()
+        if state is None:
+            return []
+        if isinstance(state, dict):
+            return [(layer.get('name'), len(layer['annotations'])) for layer in state.get('layers', []) if 'annotations' in layer]
+        layers = iter_items(state, ('layers', WILDCARD), keys=('name',), counts=('annotations',))
+        return [(layer.get('name'), layer['annotations']) for layer in layers if 'annotations' in layer]
+
+    def get_state(self):
+        """Returns the state as it is on the object when the JSON column was loaded,
+        including unsaved changes, or else its JSON text read from the database.
+        """
+        if 'neuroglancer_state' not in self.get_deferred_fields():
+            return self.neuroglancer_state
+        return self.get_raw_state()
+
+    def get_raw_state(self):
+        """Returns the JSON text of the state straight from the database, without decoding
+        it. The whole text is read into one string: only the decoded objects are avoided.
+        """
+        if self.id is None:
+            return None
+        column = self._meta.get_field('neuroglancer_state').column
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {column} FROM {self._meta.db_table} WHERE id = %s', [self.id])
+            row = cursor.fetchone()
+        return None if row is None else row[0]
+
     class Meta:
         managed = False
         verbose_name = "Neuroglancer state"
@@ -210,25 +175,63 @@ class NeuroglancerState(models.Model):
     @property
     def point_count(self):
         result = "display:none;"
-        if self.points is not None:
+        try:
+            has_premotor = self.summary.has_premotor
+        except ObjectDoesNotExist:
             df = self.points
-            df = df[(df.Layer == 'PM nucleus') | (df.Layer == 'premotor')]
-            if len(df) > 0:
-                result = "display:inline;"
+            has_premotor = df is not None and len(df[df.Layer.isin(PREMOTOR_LAYERS)]) > 0
+        if has_premotor:
+            result = "display:inline;"
         return result
 
     def find_values(self, id, json_repr):
-        results = []
+        """Returns the values of every key named id in the JSON. The JSON text is
+        streamed so only the values that are found get decoded.
+        """
+        if not isinstance(json_repr, (str, bytes, bytearray)):
+            json_repr = json.dumps(json_repr)
+        return find_values(id, json_repr)
+
+
+class NeuroglancerStateSummary(models.Model):
+    """A small summary of the annotations in a Neuroglancer state. It is computed
+    by the post_save signal of the state, see neuroglancer.signals, so the admin list
+    pages and the API filters do not need to decode the neuroglancer_state JSON column.
+    A state saved with a bulk update has no summary until
+    scripts/update_state_summaries.py is run.
+    """
+
+    neuroglancer_state = models.OneToOneField(NeuroglancerState, models.DO_NOTHING, primary_key=True,
+                                              db_column='FK_neuroglancer_state_id', related_name='summary')
+    layers = models.JSONField(verbose_name="Annotation layers", default=list)
+    counts = models.JSONField(verbose_name="Annotations by layer and type", default=dict)
+    annotation_count = models.IntegerField(default=0)
+    bounding_box = models.JSONField(null=True, blank=True)
+    has_premotor = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        managed = False
+        db_table = 'neuroglancer_state_summary'
+        verbose_name = 'Neuroglancer state summary'
+        verbose_name_plural = 'Neuroglancer state summaries'
+
+    def __str__(self):
+        return ', '.join(self.layers)
 
-        def _decode_dict(a_dict):
-            try:
-                results.append(a_dict[id])
-            except KeyError:
-                pass
-            return a_dict
+    @classmethod
+    def update_summary(cls, neuroglancer_state):
+        """Computes and saves the summary of a Neuroglancer state.
 
-        json.loads(json_repr, object_hook=_decode_dict)  # Return value ignored.
-        return results
+        :param neuroglancer_state: the saved NeuroglancerState object
+        :return: the summary object
+        """
+        layers = []
+        if neuroglancer_state.neuroglancer_state is not None:
+            layers = neuroglancer_state.neuroglancer_state.get('layers', [])
+        summary, _ = cls.objects.update_or_create(neuroglancer_state=neuroglancer_state,
+                                                  defaults=summarize_layers(layers))
+        return summary
 
 
 class CellType(models.Model):
@@ -266,24 +269,68 @@ class BrainRegion(AtlasModel):
         return f'{self.description} {self.abbreviation}'
 
 def get_region_from_abbreviation(abbreviation):
+    from neuroglancer.lookup_cache import get_brain_region
     if abbreviation is None or abbreviation == '':
         abbreviation = 'polygon'
-    brainRegion = BrainRegion.objects.filter(abbreviation=abbreviation).first()
-    return brainRegion
+    return get_brain_region(abbreviation)
+
+
+def get_search_text(session_id, animal, labels, username, annotation_type):
+    """Returns the searchable text of an annotation session: its ID, animal, labels,
+    username and type, or None when a part is missing."""
+    if animal is None or username is None or annotation_type is None or len(labels) == 0:
+        return None
+    return f"{session_id} {animal} {','.join(labels)} {username} {annotation_type}"
 
 
 class SearchSessions(models.Model):
-    id = models.BigAutoField(primary_key=True)
+    """The searchable text of the active annotation sessions. The search_sessions table
+    replaces the v_search_sessions view, which read the type out of the annotation JSON
+    of every session on every search. A row is refreshed when its session or one of
+    its labels is saved, see neuroglancer.signals, and
+    scripts/update_search_sessions.py refreshes all of them.
+    """
+    id = models.BigIntegerField(primary_key=True, verbose_name="Annotation session")
+    animal = models.CharField(max_length=20, db_column="FK_prep_id", verbose_name="Animal")
+    labels = models.CharField(max_length=2001, blank=False, null=False)
+    username = models.CharField(max_length=150, blank=False, null=False)
     animal_abbreviation_username = models.CharField(max_length=2001, null=False, db_column="animal_abbreviation_username", verbose_name="Animal")
     label_type = models.CharField(max_length=100, blank=False, null=False)
-    updated = models.CharField(max_length=100, blank=False, null=False)
+    updated = models.DateTimeField()
 
     class Meta:
         managed = False
-        db_table = 'v_search_sessions'
+        db_table = 'search_sessions'
         verbose_name = 'Search session'
         verbose_name_plural = 'Search sessions'
 
+    @classmethod
+    def refresh(cls, session_ids):
+        """Recomputes the rows of the sessions. A session that is no longer active,
+        or has no active label, loses its row. Only the type is read from the JSON.
+
+        :param session_ids: list of annotation session IDs
+        :return: the number of rows written
+        """
+        rows = AnnotationSession.objects\
+            .filter(id__in=session_ids, active=True, annotator__is_active=True, labels__active=True)\
+            .values_list('id', 'animal_id', 'annotator__username', 'annotation__type', 'updated', 'labels__label')
+        grouped = {}
+        for session_id, animal, username, annotation_type, updated, label in rows:
+            grouped.setdefault(session_id, (animal, [], username, annotation_type, updated))[1].append(label)
+        search_sessions = []
+        for session_id, (animal, labels, username, annotation_type, updated) in grouped.items():
+            labels = sorted(labels)
+            text = get_search_text(session_id, animal, labels, username, annotation_type)
+            if text is not None:
+                search_sessions.append(cls(id=session_id, animal=animal, labels=','.join(labels), username=username,
+                                           animal_abbreviation_username=text, label_type=annotation_type, updated=updated))
+        with transaction.atomic():
+            cls.objects.filter(id__in=session_ids).delete()
+            cls.objects.bulk_create(search_sessions)
+        return len(search_sessions)
+
+
 class AnnotationLabel(AtlasModel):
     id = models.BigAutoField(primary_key=True)
     label_type = EnumField(choices=['brain region', 'cell'], blank=False, null=False, default='brain region')
@@ -299,6 +346,16 @@ class AnnotationLabel(AtlasModel):
     def __str__(self):
         return f'{self.label}'
 
+def get_label_signature(label_ids):
+    """Returns the SHA-256 of the sorted, comma separated label IDs, or None without
+    labels. The SQL backfill computes the same value with
+    SHA2(GROUP_CONCAT(id ORDER BY id SEPARATOR ','), 256)."""
+    label_ids = sorted({int(label_id) for label_id in label_ids})
+    if len(label_ids) == 0:
+        return None
+    return hashlib.sha256(','.join(map(str, label_ids)).encode()).hexdigest()
+
+
 class AnnotationSession(AtlasModel):
     """This model describes a user session in Neuroglancer."""
     id = models.BigAutoField(primary_key=True)
@@ -307,6 +364,8 @@ class AnnotationSession(AtlasModel):
     annotator = models.ForeignKey(settings.AUTH_USER_MODEL, models.CASCADE, db_column="FK_user_id",
                                verbose_name="Annotator", blank=False, null=False)
     annotation = models.JSONField(verbose_name="Annotation")
+    # see get_label_signature, kept up to date by the m2m_changed signal of labels
+    label_signature = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     updated = models.DateTimeField(auto_now=True)
 
@@ -322,6 +381,26 @@ class AnnotationSession(AtlasModel):
         if self.annotation is not None and 'type' in self.annotation:
             annotation_type = self.annotation['type']
         return annotation_type
+
+    @property
+    def version(self):
+        """The updated timestamp in microseconds, in hexadecimal, which a PATCH has to
+        send back to show which annotation it was made against. It is the first part of
+        the ETag of the annotation, see neuroglancer.response_cache.parse_etag."""
+        return f'{get_version(self.updated):x}' if self.updated is not None else None
+
+    @classmethod
+    def update_label_signatures(cls, session_ids):
+        """Stores the label signature of the sessions. update() is used so the
+        updated timestamp, the version of the annotation, does not change."""
+        session_ids = list(session_ids)
+        label_ids = {session_id: [] for session_id in session_ids}
+        rows = cls.labels.through.objects.filter(annotationsession_id__in=session_ids)\
+            .values_list('annotationsession_id', 'annotationlabel_id')
+        for session_id, label_id in rows:
+            label_ids[session_id].append(label_id)
+        for session_id, ids in label_ids.items():
+            cls.objects.filter(pk=session_id).update(label_signature=get_label_signature(ids))
     
 
 class AnnotationData(AnnotationSession):
@@ -343,33 +422,3 @@ class Points(NeuroglancerState):
         proxy = True
         verbose_name = 'Layer points/polygons'
         verbose_name_plural = 'Layer points/polygons'
-
-def resort_points(rows):
-    """Reorders a list of dictionaries based on the previous value of a specified key."""
-
-    if not rows:
-        return rows
-
-    result = [rows[0]]  # Start with the first dictionary
-    for i in range(1, len(rows)):
-        for j in range(i):
-            if rows[i]['pointA'] == result[j]['pointB']:
-                result.insert(j + 1, rows[i])
-                break
-        else:
-            result.append(rows[i])
-
-    return result
-
-def create_one_dataframe(points, name, UUID, data_type='point', orders=0, descriptions="", xy_resolution=1, z_resolution=1):
-    df = pd.DataFrame(points, columns=['X', 'Y', 'Section'])
-    df['Section'] = df['Section'].astype(int)
-    df['Layer'] = name
-    df['Type'] = data_type
-    df['UUID'] = UUID
-    df['Order'] = orders
-    df['Labels'] = descriptions
-    df['Xum'] = df['X'] * xy_resolution
-    df['Yum'] = df['Y'] * xy_resolution
-    df['Zum'] = df['Section'] * z_resolution
-    return df
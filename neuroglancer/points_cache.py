@@ -0,0 +1,129 @@
+"""A cache of the parsed point DataFrames of the Neuroglancer states.
+
+Parsing the JSON of a large Neuroglancer state takes a long time and the same
+DataFrame is used by the admin graph, the data table, the dash scatter view
+and the point_count CSS toggle. The parsed DataFrame is stored once per
+(state id, updated timestamp):
+
+#. In a small in-process LRU cache.
+#. On local disk as a compressed numpy .npz file, one column per array. Strings
+   are stored as fixed width unicode arrays so the file can be loaded without pickle.
+
+The updated column changes every time a state is saved, so an old entry can
+never be returned for a new state. The serializer also calls :func:`invalidate`
+after a save so the old files do not pile up on disk.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+from django.conf import settings
+
+from neuroglancer.points_parser import COLUMNS
+
+POINTS_CACHE_DIR = getattr(settings, 'POINTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'brainsharer_points'))
+POINTS_CACHE_SIZE = getattr(settings, 'POINTS_CACHE_SIZE', 32)
+STRING_COLUMNS = ['Layer', 'Type', 'Labels', 'UUID']
+
+_memory_cache = LRUCache(maxsize=POINTS_CACHE_SIZE)
+_lock = threading.Lock()
+# Marker stored when a state has no points so we do not parse it again
+_EMPTY = 'empty'
+
+
+def cache_key(state_id, updated):
+    """Returns the key of a state. The updated timestamp is stored in microseconds."""
+    version = int(updated.timestamp() * 1000000) if updated is not None else 0
+    return (int(state_id), version)
+
+
+def get_cache_path(state_id, version):
+    return os.path.join(POINTS_CACHE_DIR, str(state_id), f'{version}.npz')
+
+
+def write_frame(path, df):
+    """Writes the DataFrame to a compressed .npz file. The file is first written to
+    a temporary name and then renamed so other processes never read half a file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if df is None:
+        arrays = {_EMPTY: np.array(True)}
+    else:
+        arrays = {'index': df.index.to_numpy()}
+        for column in COLUMNS:
+            values = df[column].to_numpy()
+            if column in STRING_COLUMNS:
+                values = values.astype(str)
+            arrays[column] = values
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        np.savez_compressed(fh, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_frame(path):
+    """Reads a DataFrame that was written by write_frame.
+
+    :return: a tuple of (found, DataFrame or None)
+    """
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if _EMPTY in data.files:
+                return True, None
+            columns = {}
+            for column in COLUMNS:
+                values = data[column]
+                if column in STRING_COLUMNS:
+                    values = values.astype(object)
+                columns[column] = values
+            return True, pd.DataFrame(columns, columns=COLUMNS, index=data['index'])
+    except (OSError, ValueError, KeyError):
+        return False, None
+
+
+def get_points(neuroglancer_state, parse):
+    """Returns the parsed points of a Neuroglancer state, parsing it only on a cache miss.
+    The JSON column is only read from the database when the DataFrame is not cached,
+    so this works on querysets that defer the neuroglancer_state column.
+
+    :param neuroglancer_state: the NeuroglancerState object
+    :param parse: callable that parses the state into a DataFrame
+    :return: a copy of the DataFrame or None if there are no points
+    """
+    if neuroglancer_state.id is None:
+        return parse()
+
+    key = cache_key(neuroglancer_state.id, neuroglancer_state.updated)
+    with _lock:
+        found = key in _memory_cache
+        df = _memory_cache.get(key)
+
+    if not found:
+        path = get_cache_path(*key)
+        found, df = read_frame(path)
+        if not found:
+            df = parse()
+            try:
+                write_frame(path, df)
+            except OSError:
+                pass
+        with _lock:
+            _memory_cache[key] = df
+
+    # The callers change the DataFrame in place, so never hand out the cached one.
+    return None if df is None else df.copy()
+
+
+def invalidate(state_id):
+    """Removes all cached DataFrames of a state from memory and disk.
+
+    :param state_id: primary key of the Neuroglancer state
+    """
+    state_id = int(state_id)
+    with _lock:
+        for key in [key for key in _memory_cache.keys() if key[0] == state_id]:
+            del _memory_cache[key]
+    shutil.rmtree(os.path.join(POINTS_CACHE_DIR, str(state_id)), ignore_errors=True)
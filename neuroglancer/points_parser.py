@@ -0,0 +1,210 @@
+"""This module parses the annotation layers of a Neuroglancer state into a pandas DataFrame.
+It is used by the `points` property of the NeuroglancerState model.
+
+The annotations in a layer are a flat list where clouds, volumes and polygons
+refer to each other with the `parentAnnotationId` key. Instead of searching the whole
+list for every UUID, each layer is walked exactly once and the rows are put into
+dictionaries: id -> rows, parent -> children and type -> ids. The DataFrame is then
+created in one step from flat column lists.
+"""
+from collections import Counter, defaultdict
+import numpy as np
+import pandas as pd
+
+from neuroglancer.contours.edge_chain import chain_rows
+
+
+COLUMNS = ['Layer', 'Type', 'Labels', 'UUID', 'Order', 'X', 'Y', 'Section', 'Xum', 'Yum', 'Zum']
+SORT_COLUMNS = ['Layer', 'Type', 'Labels', 'UUID', 'Section', 'Order', 'X', 'Y']
+PREMOTOR_LAYERS = ('PM nucleus', 'premotor')
+
+
+class LayerIndex:
+    """Indexes of one annotation layer built with a single pass over the annotations.
+
+    Attributes:
+        points (dict): point UUID -> list of coordinates for rows without a parent.
+        point_descriptions (dict): point UUID -> description of the first 'point' row.
+        cloud_ids (dict): cloud UUID -> description (None if not described), in order of appearance.
+        cloud_points (dict): parent UUID -> list of child point coordinates.
+        volume_ids (list): volume UUIDs in order of appearance.
+        volume_descriptions (dict): volume UUID -> description.
+        polygons (dict): volume UUID -> list of polygon UUIDs.
+        lines (dict): polygon UUID -> list of line rows.
+    """
+
+    def __init__(self, annotations):
+        self.points = defaultdict(list)
+        self.point_descriptions = {}
+        self.cloud_ids = {}
+        self.cloud_points = defaultdict(list)
+        self.volume_ids = []
+        self.volume_descriptions = {}
+        self.polygons = defaultdict(list)
+        self.lines = defaultdict(list)
+
+        for row in annotations:
+            _type = row.get('type')
+            _id = row.get('id')
+            parent_id = row.get('parentAnnotationId')
+            if 'point' in row:
+                if 'parentAnnotationId' not in row:
+                    if 'id' in row:
+                        self.points[_id].append(row['point'])
+                else:
+                    self.cloud_points[parent_id].append(row['point'])
+
+            if _type == 'point':
+                if 'id' in row and 'description' in row:
+                    self.point_descriptions.setdefault(_id, row['description'])
+            elif _type == 'cloud':
+                if _id is not None:
+                    description = self.cloud_ids.get(_id)
+                    if description is None:
+                        description = row.get('description')
+                    self.cloud_ids[_id] = description
+            elif _type == 'volume':
+                if _id is not None:
+                    self.volume_ids.append(_id)
+                    if 'description' in row:
+                        self.volume_descriptions.setdefault(_id, row['description'])
+            elif _type == 'polygon':
+                if _id is not None and parent_id is not None:
+                    self.polygons[parent_id].append(_id)
+            elif _type == 'line':
+                if 'pointA' in row and parent_id is not None:
+                    self.lines[parent_id].append(row)
+
+
+def format_description(description, default):
+    """Returns the description on one line or the default if there is no description."""
+    if description is None:
+        return default
+    return description.replace('\n', ', ')
+
+
+def resort_points(rows):
+    """Reorders the line dictionaries of a polygon so every pointA follows the previous pointB.
+    The lines are chained in linear time, see neuroglancer.contours.edge_chain.
+
+    :param rows: list of line annotation dictionaries
+    :return: the ordered list
+    """
+    return chain_rows(rows)
+
+
+def create_points_dataframe(layers, xy_resolution=1.0, z_resolution=1.0):
+    """Creates one DataFrame of all the points, cloud points and polygon vertices in the
+    annotation layers of a Neuroglancer state.
+
+    :param layers: the 'layers' list of the Neuroglancer JSON state
+    :param xy_resolution: the x,y resolution of the scan run in micrometers
+    :param z_resolution: the z resolution of the scan run in micrometers
+    :return: a sorted DataFrame with the COLUMNS above or None if there are no points
+    """
+    coordinates = []
+    lengths = []
+    layer_names = []
+    types = []
+    labels = []
+    uuids = []
+    orders = []
+
+    def add_group(points, name, UUID, data_type, description, ordered=False):
+        coordinates.extend(points)
+        lengths.append(len(points))
+        layer_names.append(name)
+        types.append(data_type)
+        labels.append(description)
+        uuids.append(UUID)
+        orders.append(ordered)
+
+    for layer in layers:
+        if 'annotations' not in layer:
+            continue
+        name = layer['name']
+        index = LayerIndex(layer['annotations'])
+
+        for UUID, points in index.points.items():
+            description = format_description(index.point_descriptions.get(UUID), 'unlabeled point')
+            add_group(points, name, UUID, 'point', description)
+
+        for UUID, description in index.cloud_ids.items():
+            description = format_description(description, 'unlabeled cloud point')
+            add_group(index.cloud_points.get(UUID, []), name, UUID, 'cloud', description)
+
+        for volume_id in index.volume_ids:
+            # The description is associated with a volume, not a polygon
+            description = format_description(index.volume_descriptions.get(volume_id), 'unlabeled polygon')
+            for UUID in index.polygons.get(volume_id, []):
+                lines = index.lines.get(UUID)
+                if not lines:
+                    continue
+                first = [round(x) for x in lines[0]['pointA']]
+                last = [round(x) for x in lines[-1]['pointB']]
+                if first != last:
+                    lines = resort_points(lines)
+                add_group([row['pointA'] for row in lines], name, UUID, 'volume', description, ordered=True)
+
+    if len(coordinates) == 0:
+        return None
+
+    lengths = np.array(lengths)
+    starts = np.cumsum(lengths) - lengths
+    # position of every row inside its own group, used for the order and the index
+    positions = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    ordered = np.repeat(np.array(orders, dtype=bool), lengths)
+
+    df = pd.DataFrame(coordinates, columns=['X', 'Y', 'Section'], index=positions)
+    df['Section'] = df['Section'].astype(int)
+    df['Layer'] = np.repeat(np.array(layer_names, dtype=object), lengths)
+    df['Type'] = np.repeat(np.array(types, dtype=object), lengths)
+    df['UUID'] = np.repeat(np.array(uuids, dtype=object), lengths)
+    df['Order'] = np.where(ordered, positions + 1, 0)
+    df['Labels'] = np.repeat(np.array(labels, dtype=object), lengths)
+    df['Xum'] = df['X'] * xy_resolution
+    df['Yum'] = df['Y'] * xy_resolution
+    df['Zum'] = df['Section'] * z_resolution
+    df = df[COLUMNS]
+    df.sort_values(by=SORT_COLUMNS, inplace=True)
+    return df
+
+
+def summarize_layers(layers):
+    """Creates the small summary of the annotation layers that is stored in the
+    neuroglancer_state_summary table, so the admin and the API do not need to
+    decode the whole state.
+
+    :param layers: the 'layers' list of the Neuroglancer JSON state
+    :return: a dictionary with the annotation layer names, the number of annotations by
+        type for each layer, the total number of annotations, the bounding box of
+        all the coordinates and whether a premotor layer has annotations
+    """
+    layer_names = []
+    counts = {}
+    mins = []
+    maxs = []
+    for layer in layers:
+        if 'annotations' not in layer:
+            continue
+        name = layer.get('name')
+        annotations = layer['annotations']
+        layer_names.append(name)
+        counts[name] = dict(Counter(row.get('type', 'unknown') for row in annotations))
+        coordinates = [row[key] for row in annotations for key in ('point', 'pointA', 'pointB') if key in row]
+        if len(coordinates) > 0:
+            coordinates = np.array(coordinates, dtype=np.float64)
+            mins.append(coordinates.min(axis=0))
+            maxs.append(coordinates.max(axis=0))
+
+    bounding_box = None
+    if len(mins) > 0:
+        bounding_box = [np.min(mins, axis=0).tolist(), np.max(maxs, axis=0).tolist()]
+
+    return {
+        'layers': layer_names,
+        'counts': counts,
+        'annotation_count': sum(sum(c.values()) for c in counts.values()),
+        'bounding_box': bounding_box,
+        'has_premotor': any(name in PREMOTOR_LAYERS and len(counts[name]) > 0 for name in layer_names),
+    }
@@ -0,0 +1,375 @@
+"""Writes the annotation of a session as a Neuroglancer precomputed annotation source,
+https://github.com/google/neuroglancer/blob/master/src/datasource/precomputed/annotations.md
+
+A session with a million cells is far too large to be sent inline in the JSON of
+the annotation layer. As a precomputed source the viewer only fetches the chunks
+that are visible:
+
+* ``info`` describes the coordinate space, the annotation type and the indexes.
+* ``by_id`` holds every annotation under its uint64 ID.
+* ``spatial0``, ``spatial1``, ... is a multi-level spatial index. Level 0 is one
+  chunk over the whole bounding box and every next level splits the largest
+  dimensions in two. The annotations are shuffled and every chunk of a level keeps
+  at most ``limit`` of them and passes the rest down to the next level, so every
+  level holds a uniform sample of what is left and the viewer can stop as soon as
+  it has enough annotations on screen.
+
+Each index is written in the uint64 sharded format with the identity hash, so a
+million annotations end up in a few shard files instead of a million small files.
+Clouds and points of the session are POINT annotations, the lines of polygons and
+volumes are LINE annotations. A line is put in the spatial chunk of its midpoint.
+The coordinates are in micrometers and the categories of the cells are stored as
+an enum property.
+"""
+import json
+import math
+import os
+import shutil
+import struct
+import numpy as np
+from django.conf import settings
+
+M_UM_SCALE = 1000000
+ANNOTATIONS_PATH = getattr(settings, 'ANNOTATIONS_PATH', '/var/www/brainsharer/annotations')
+# the maximum number of annotations in one spatial chunk
+CHUNK_LIMIT = 5000
+MAX_LEVELS = 12
+SHARD_BYTES = 64 * 1024 * 1024
+MINISHARD_KEYS = 256
+POINT_TYPES = ('point', 'cell', 'com')
+
+
+def get_annotation_rows(annotation):
+    """Returns the point and line annotations in the JSON of a session.
+
+    :param annotation: the annotation JSON: a point, cloud, polygon or volume
+    :return: (list of point dictionaries, list of line dictionaries)
+    """
+    points = []
+    lines = []
+    stack = [annotation]
+    while stack:
+        row = stack.pop()
+        if not isinstance(row, dict):
+            continue
+        row_type = row.get('type')
+        if row_type in POINT_TYPES and 'point' in row:
+            points.append(row)
+        elif row_type == 'line' and 'pointA' in row and 'pointB' in row:
+            lines.append(row)
+        # keep the drawing order, the stack is last in first out
+        stack.extend(reversed(row.get('childJsons', [])))
+    return points, lines
+
+
+def compressed_morton_code(positions, grid_shape):
+    """Returns the compressed Morton codes of chunk grid positions, as used for the keys
+    of a sharded spatial index.
+
+    :param positions: N x 3 array of chunk grid positions
+    :param grid_shape: the number of chunks in every dimension
+    :return: uint64 array of N codes
+    """
+    positions = np.asarray(positions, dtype=np.uint64).reshape(-1, 3)
+    bits = [max(0, math.ceil(math.log2(size))) for size in grid_shape]
+    codes = np.zeros(len(positions), dtype=np.uint64)
+    output_bit = 0
+    for bit in range(max(bits, default=0)):
+        for dim in range(3):
+            if bit < bits[dim]:
+                codes |= ((positions[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(output_bit)
+                output_bit += 1
+    return codes
+
+
+def choose_sharding(count, total_bytes):
+    """Returns the sharding spec of an index with count keys and total_bytes of data."""
+    shard_bits = max(0, math.ceil(math.log2(max(1, total_bytes / SHARD_BYTES))))
+    keys_per_shard = max(1, count >> shard_bits)
+    minishard_bits = max(0, math.ceil(math.log2(max(1, keys_per_shard / MINISHARD_KEYS))))
+    return {
+        '@type': 'neuroglancer_uint64_sharded_v1',
+        'hash': 'identity',
+        'preshift_bits': 0,
+        'minishard_bits': minishard_bits,
+        'shard_bits': shard_bits,
+        'minishard_index_encoding': 'raw',
+        'data_encoding': 'raw',
+    }
+
+
+def get_shard_and_minishard(keys, sharding):
+    hashed = np.asarray(keys, dtype=np.uint64) >> np.uint64(sharding['preshift_bits'])
+    minishards = hashed & np.uint64((1 << sharding['minishard_bits']) - 1)
+    shards = (hashed >> np.uint64(sharding['minishard_bits'])) & np.uint64((1 << sharding['shard_bits']) - 1)
+    return shards, minishards
+
+
+def get_shard_filename(shard, sharding):
+    digits = math.ceil(sharding['shard_bits'] / 4)
+    return f'{int(shard):0{digits}x}.shard' if digits > 0 else '0.shard'
+
+
+def write_sharded(directory, keys, values, sharding):
+    """Writes the values in the uint64 sharded format.
+
+    :param directory: the directory of the index
+    :param keys: the uint64 keys
+    :param values: list of bytes, one per key
+    """
+    os.makedirs(directory, exist_ok=True)
+    keys = np.asarray(keys, dtype=np.uint64)
+    shards, minishards = get_shard_and_minishard(keys, sharding)
+    minishard_count = 1 << sharding['minishard_bits']
+    order = np.lexsort((keys, minishards, shards))
+    boundaries = np.flatnonzero(np.diff(shards[order])) + 1
+    for shard_order in np.split(order, boundaries):
+        if len(shard_order) == 0:
+            continue
+        shard_index = np.zeros((minishard_count, 2), dtype='<u8')
+        data = []
+        minishard_indexes = []
+        offset = 0
+        minishard_boundaries = np.flatnonzero(np.diff(minishards[shard_order])) + 1
+        for minishard_order in np.split(shard_order, minishard_boundaries):
+            chunk_keys = keys[minishard_order]
+            sizes = np.array([len(values[i]) for i in minishard_order], dtype=np.uint64)
+            starts = offset + np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.uint64)
+            for i in minishard_order:
+                data.append(values[i])
+            offset += int(sizes.sum())
+            index = np.stack([
+                np.diff(chunk_keys, prepend=np.uint64(0)),
+                # the first start is relative to the end of the shard index, the
+                # next ones to the end of the previous chunk, which is 0 here
+                np.concatenate([[starts[0]], np.zeros(len(sizes) - 1, dtype=np.uint64)]),
+                sizes,
+            ]).astype('<u8')
+            minishard_indexes.append((int(minishards[minishard_order[0]]), index.tobytes()))
+        for minishard, index in minishard_indexes:
+            shard_index[minishard] = (offset, offset + len(index))
+            data.append(index)
+            offset += len(index)
+        filename = get_shard_filename(shards[shard_order[0]], sharding)
+        with open(os.path.join(directory, filename), 'wb') as fh:
+            fh.write(shard_index.tobytes())
+            for value in data:
+                fh.write(value)
+
+
+def read_sharded(directory, key, sharding):
+    """Returns the value of a key in a sharded index or None, like the viewer reads it."""
+    shards, minishards = get_shard_and_minishard([key], sharding)
+    path = os.path.join(directory, get_shard_filename(shards[0], sharding))
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fh:
+        content = fh.read()
+    index_size = 16 << sharding['minishard_bits']
+    start, end = struct.unpack_from('<QQ', content, 16 * int(minishards[0]))
+    if start == end:
+        return None
+    index = np.frombuffer(content[index_size + start:index_size + end], dtype='<u8').reshape(3, -1)
+    chunk_keys = np.cumsum(index[0])
+    chunk_ends = np.cumsum(index[1] + index[2])
+    chunk_starts = chunk_ends - index[2]
+    matches = np.flatnonzero(chunk_keys == key)
+    if len(matches) == 0:
+        return None
+    i = matches[0]
+    return content[index_size + int(chunk_starts[i]):index_size + int(chunk_ends[i])]
+
+
+class PrecomputedAnnotationWriter:
+    """Writes point or line annotations with their categories to a precomputed directory.
+    """
+
+    def __init__(self, annotation_type, geometry, categories=None, limit=CHUNK_LIMIT, seed=0):
+        """
+        :param annotation_type: 'POINT' or 'LINE'
+        :param geometry: N x 3 array of points or N x 6 array of line end points in micrometers
+        :param categories: optional list of N category names
+        :param limit: the maximum number of annotations in a spatial chunk
+        :param seed: the seed of the shuffle of the spatial index
+        """
+        self.annotation_type = annotation_type
+        self.geometry = np.asarray(geometry, dtype=np.float32).reshape(len(geometry), 3 if annotation_type == 'POINT' else 6)
+        self.count = len(self.geometry)
+        self.ids = np.arange(1, self.count + 1, dtype=np.uint64)
+        self.limit = limit
+        self.seed = seed
+        self.labels = []
+        self.category_codes = None
+        if categories is not None:
+            self.labels, self.category_codes = np.unique(np.asarray(categories, dtype=str), return_inverse=True)
+        points = self.geometry.reshape(-1, 3)
+        if self.count == 0:
+            points = np.zeros((1, 3), dtype=np.float32)
+        self.lower_bound = np.floor(points.min(axis=0)).astype(np.float64)
+        self.upper_bound = np.floor(points.max(axis=0)).astype(np.float64) + 1
+        self.records = self.encode_records()
+
+    def encode_records(self):
+        """Returns the encoding of every annotation as an N x record_size uint8 array."""
+        fields = [('geometry', '<f4', (self.geometry.shape[1],))]
+        if self.category_codes is not None:
+            fields.append(('category', '<u4'))
+        records = np.zeros(self.count, dtype=fields)
+        records['geometry'] = self.geometry
+        if self.category_codes is not None:
+            records['category'] = self.category_codes
+        return records.view(np.uint8).reshape(self.count, records.dtype.itemsize)
+
+    def get_positions(self):
+        if self.annotation_type == 'POINT':
+            return self.geometry.astype(np.float64)
+        return (self.geometry[:, :3].astype(np.float64) + self.geometry[:, 3:]) / 2
+
+    def create_levels(self):
+        """Splits the shuffled annotations into the levels of the spatial index.
+
+        :return: list of (grid_shape, chunk_size, chunk grid positions, annotation indexes)
+        """
+        extent = self.upper_bound - self.lower_bound
+        positions = self.get_positions()
+        remaining = np.random.default_rng(self.seed).permutation(self.count)
+        grid_shape = np.ones(3, dtype=np.int64)
+        levels = []
+        while True:
+            chunk_size = extent / grid_shape
+            cells = np.floor((positions[remaining] - self.lower_bound) / chunk_size).astype(np.int64)
+            cells = np.clip(cells, 0, grid_shape - 1)
+            keys = np.ravel_multi_index(cells.T, grid_shape)
+            # stable sort keeps the shuffled order within a chunk
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            first = np.searchsorted(sorted_keys, sorted_keys, side='left')
+            rank = np.arange(len(order)) - first
+            last_level = len(levels) == MAX_LEVELS - 1 or (rank < self.limit).all()
+            keep = np.ones(len(order), dtype=bool) if last_level else rank < self.limit
+            selected = order[keep]
+            levels.append((grid_shape.copy(), chunk_size, cells[selected], remaining[selected]))
+            if last_level:
+                return levels
+            remaining = remaining[order[~keep]]
+            grid_shape = np.where(chunk_size >= chunk_size.max() / 2, grid_shape * 2, grid_shape)
+
+    def write(self, path, sharded=True):
+        """Writes the info file and the indexes.
+
+        :param path: the directory of the annotation source
+        :param sharded: write the indexes as shard files instead of one file per key
+        """
+        os.makedirs(path, exist_ok=True)
+        info = {
+            '@type': 'neuroglancer_annotations_v1',
+            'dimensions': {'x': [1e-6, 'm'], 'y': [1e-6, 'm'], 'z': [1e-6, 'm']},
+            'lower_bound': self.lower_bound.tolist(),
+            'upper_bound': self.upper_bound.tolist(),
+            'annotation_type': self.annotation_type,
+            'properties': [],
+            'relationships': [],
+            'by_id': {'key': 'by_id'},
+            'spatial': [],
+        }
+        if self.category_codes is not None:
+            info['properties'].append({'id': 'category', 'type': 'uint32', 'description': 'Cell category',
+                                       'enum_values': list(range(len(self.labels))),
+                                       'enum_labels': [str(label) for label in self.labels]})
+
+        values = [record.tobytes() for record in self.records]
+        if sharded:
+            info['by_id']['sharding'] = choose_sharding(self.count, self.records.size)
+            write_sharded(os.path.join(path, 'by_id'), self.ids, values, info['by_id']['sharding'])
+        else:
+            self.write_files(os.path.join(path, 'by_id'), [str(id) for id in self.ids.tolist()], values)
+
+        for level, (grid_shape, chunk_size, cells, indexes) in enumerate(self.create_levels()):
+            key = f'spatial{level}'
+            spatial = {'key': key, 'grid_shape': grid_shape.tolist(), 'chunk_size': chunk_size.tolist(), 'limit': self.limit}
+            chunk_keys, chunks = self.encode_chunks(grid_shape, cells, indexes)
+            if sharded:
+                codes = compressed_morton_code([np.unravel_index(k, grid_shape) for k in chunk_keys], grid_shape)
+                spatial['sharding'] = choose_sharding(len(chunks), sum(len(chunk) for chunk in chunks))
+                write_sharded(os.path.join(path, key), codes, chunks, spatial['sharding'])
+            else:
+                names = ['_'.join(map(str, np.unravel_index(k, grid_shape))) for k in chunk_keys]
+                self.write_files(os.path.join(path, key), names, chunks)
+            info['spatial'].append(spatial)
+
+        with open(os.path.join(path, 'info'), 'w') as fh:
+            json.dump(info, fh)
+        return info
+
+    def encode_chunks(self, grid_shape, cells, indexes):
+        """Returns the flat chunk keys and the multiple annotation encoding of every chunk."""
+        keys = np.ravel_multi_index(cells.T, grid_shape) if len(cells) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        indexes = indexes[order]
+        boundaries = np.flatnonzero(np.diff(keys)) + 1
+        chunk_keys = []
+        chunks = []
+        for chunk in np.split(np.arange(len(keys)), boundaries):
+            if len(chunk) == 0:
+                continue
+            chunk_indexes = indexes[chunk]
+            chunk_keys.append(int(keys[chunk[0]]))
+            chunks.append(struct.pack('<Q', len(chunk_indexes)) + self.records[chunk_indexes].tobytes()
+                          + self.ids[chunk_indexes].astype('<u8').tobytes())
+        return chunk_keys, chunks
+
+    @staticmethod
+    def write_files(directory, names, values):
+        os.makedirs(directory, exist_ok=True)
+        for name, value in zip(names, values):
+            with open(os.path.join(directory, name), 'wb') as fh:
+                fh.write(value)
+
+
+def create_writer(annotation):
+    """Returns the writer of the annotation JSON of a session or None if it has no points or lines."""
+    points, lines = get_annotation_rows(annotation)
+    if len(lines) > 0:
+        geometry = [row['pointA'] + row['pointB'] for row in lines]
+        return PrecomputedAnnotationWriter('LINE', np.array(geometry, dtype=np.float64) * M_UM_SCALE)
+    if len(points) > 0:
+        geometry = np.array([row['point'] for row in points], dtype=np.float64) * M_UM_SCALE
+        categories = None
+        if any('category' in row for row in points):
+            categories = [row.get('category') or '' for row in points]
+        return PrecomputedAnnotationWriter('POINT', geometry, categories)
+    return None
+
+
+def export_session(annotation_session):
+    """Writes an annotation session as a precomputed annotation source in ANNOTATIONS_PATH.
+    The folder name has the updated timestamp of the session, so it is only written
+    again when the session was saved. Older folders of the session are deleted.
+
+    :param annotation_session: AnnotationSession object
+    :return: the folder name or None if the session has no points or lines
+    """
+    version = int(annotation_session.updated.timestamp() * 1000000)
+    folder_name = f'{annotation_session.id}_{version}'
+    path = os.path.join(ANNOTATIONS_PATH, folder_name)
+    if os.path.isfile(os.path.join(path, 'info')):
+        return folder_name
+
+    writer = create_writer(annotation_session.annotation)
+    if writer is None:
+        return None
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    writer.write(tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process wrote the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    prefix = f'{annotation_session.id}_'
+    for entry in os.scandir(ANNOTATIONS_PATH):
+        if entry.name.startswith(prefix) and entry.name != folder_name and not entry.name.endswith('.tmp'):
+            shutil.rmtree(entry.path, ignore_errors=True)
+    return folder_name
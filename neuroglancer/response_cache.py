@@ -0,0 +1,199 @@
+"""Conditional and compressed responses for the large JSON payloads: the annotation
+of a session and the JSON state of a Neuroglancer view.
+
+Neuroglancer fetches the same multi megabyte JSON every time a view is loaded. The
+response of an object is cached per (kind, id, updated timestamp):
+
+#. The strong ETag is the updated timestamp in microseconds, in hexadecimal,
+   followed by a hash of the variant, e.g. the requested fields, and by the content
+   coding, so every representation has its own tag, e.g. ``"5f3a1c-f1a2b3c4d-br"``.
+   The only query needed to answer ``If-None-Match`` is the one reading the updated
+   column, so an unchanged object is answered with 304 without loading or
+   serializing it. The timestamp is also the version a PATCH of an annotation sends
+   back in ``If-Match``, see AnnotationSession.version and parse_etag.
+#. The JSON body and every compressed version of it (gzip, brotli and zstd,
+   negotiated from ``Accept-Encoding``) are kept in an in-process LRU cache limited
+   to RESPONSE_CACHE_BYTES, so the JSON is serialized and compressed once per version.
+
+The updated column changes every time an object is saved. It is a datetime(6) since
+sql/2026-10-18.updates.sql, so two saves in the same second have different versions
+and an old body is not returned for a new version.
+"""
+import gzip
+import hashlib
+import threading
+from cachetools import LRUCache
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESPONSE_CACHE_BYTES = getattr(settings, 'RESPONSE_CACHE_BYTES', 256 * 1024 * 1024)
+# bodies smaller than this are not worth compressing
+MINIMUM_COMPRESS_SIZE = 1024
+IDENTITY = 'identity'
+
+_cache = LRUCache(maxsize=RESPONSE_CACHE_BYTES, getsizeof=len)
+_lock = threading.Lock()
+
+
+def compress_gzip(body):
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def compress_brotli(body):
+    return brotli.compress(body, quality=6)
+
+
+def compress_zstd(body):
+    return zstandard.ZstdCompressor(level=10).compress(body)
+
+
+# in order of preference when the client accepts them with the same quality
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS['br'] = compress_brotli
+if zstandard is not None:
+    COMPRESSORS['zstd'] = compress_zstd
+COMPRESSORS['gzip'] = compress_gzip
+
+
+def get_version(updated):
+    """Returns the updated timestamp in microseconds."""
+    return int(updated.timestamp() * 1000000) if updated is not None else 0
+
+
+def make_etag(version, variant=None, encoding=IDENTITY):
+    """Returns the ETag of one representation of a version, e.g. '"5f3a1c-f1a2b3c4d-br"'.
+
+    :param version: the version from get_version
+    :param variant: the name of the variant of the object, e.g. the requested fields
+    :param encoding: the content coding of the body
+    """
+    parts = [f'{version:x}']
+    if variant:
+        parts.append('f' + hashlib.sha256(variant.encode()).hexdigest()[:8])
+    if encoding != IDENTITY:
+        parts.append(encoding)
+    return '"' + '-'.join(parts) + '"'
+
+
+def parse_etag(etag):
+    """Returns the version of an ETag, e.g. 'W/"5f3a1c-br"' or '5f3a1c' gives '5f3a1c'."""
+    return str(etag).strip().removeprefix('W/').strip('"').split('-')[0]
+
+
+def etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header against the ETag. The comparison is weak as
+    required by RFC 9110, so W/ prefixes are ignored."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def choose_encoding(accept_encoding):
+    """Returns the best encoding of COMPRESSORS accepted by the client, or identity.
+
+    :param accept_encoding: the Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, parameters = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith('q='):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+    best = IDENTITY
+    best_quality = 0.0
+    for name in COMPRESSORS:
+        quality = qualities.get(name, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def cache_get(key):
+    with _lock:
+        return _cache.get(key)
+
+
+def cache_set(key, value):
+    with _lock:
+        try:
+            _cache[key] = value
+        except ValueError:
+            # larger than the whole cache
+            pass
+
+
+def not_modified(etag):
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def cached_json_response(request, kind, pk, updated, get_data, variant=None):
+    """Returns the JSON of an object as a conditional, compressed response.
+
+    :param request: the request with the If-None-Match and Accept-Encoding headers
+    :param kind: the name of the payload, e.g. 'annotation'
+    :param pk: the primary key of the object
+    :param updated: the updated timestamp of the object
+    :param get_data: function returning the data to render as JSON, it is only
+        called when the body is not in the cache
+    :param variant: the name of the representation when the object has several,
+        e.g. the requested fields
+    :return: a 200 or 304 HttpResponse
+    """
+    version = get_version(updated)
+    key = (kind, variant, int(pk), version)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    etag = make_etag(version, variant, encoding)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    body = cache_get(key + (encoding,))
+    if body is None:
+        identity = cache_get(key + (IDENTITY,))
+        if identity is None:
+            identity = JSONRenderer().render(get_data())
+            cache_set(key + (IDENTITY,), identity)
+        if len(identity) < MINIMUM_COMPRESS_SIZE and encoding != IDENTITY:
+            # a small body is sent uncompressed, with the tag of the identity coding
+            encoding = IDENTITY
+            etag = make_etag(version, variant)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+        body = identity
+        if encoding != IDENTITY:
+            body = COMPRESSORS[encoding](identity)
+            cache_set(key + (encoding,), body)
+
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    # the client must check with the server, it gets a 304 when nothing changed
+    response['Cache-Control'] = 'private, no-cache'
+    if encoding != IDENTITY:
+        response['Content-Encoding'] = encoding
+    return response
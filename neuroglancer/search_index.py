@@ -0,0 +1,216 @@
+"""An in-process n-gram index of the annotation labels and of the searchable text of
+the annotation sessions, used by the typeahead search endpoints.
+
+``search_label`` used to run ``label__icontains`` and ``search_annotation`` ran
+``animal_abbreviation_username__icontains`` on every keystroke. Here the label and
+the text of the search_sessions table are indexed once:
+
+#. Every 1, 2 and 3 character substring of a text points to the IDs having it, so
+   a query of up to 3 characters is a single dictionary lookup.
+#. A longer query intersects the ID sets of its trigrams, starting with the
+   smallest, and the few candidates left are checked with ``in``.
+
+The matches are the same as icontains. The index is built the first time it is
+used and the signals in :mod:`neuroglancer.signals` update the entries of a label
+or session when it is saved or deleted, after refreshing its search_sessions row. Every web server process has its own index,
+so it is also rebuilt from the database every SEARCH_INDEX_TTL seconds to pick up
+the changes made by other processes.
+"""
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+
+from neuroglancer.models import AnnotationLabel, SearchSessions
+
+SEARCH_INDEX_TTL = getattr(settings, 'SEARCH_INDEX_TTL', 300)
+NGRAM_SIZE = 3
+# the format of the old DATE_FORMAT(updated, '%d %b %Y %H:%i') in v_search_sessions
+UPDATED_FORMAT = '%d %b %Y %H:%M'
+
+
+def get_ngrams(text):
+    """Returns every substring of the text of 1 to NGRAM_SIZE characters."""
+    return {text[i:i + n] for n in range(1, NGRAM_SIZE + 1) for i in range(len(text) - n + 1)}
+
+
+class NgramIndex:
+    """Case insensitive substring search over a set of texts keyed by ID."""
+
+    def __init__(self):
+        self.texts = {}
+        self.ngrams = defaultdict(set)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, key, text):
+        self.remove(key)
+        text = text.lower()
+        self.texts[key] = text
+        for ngram in get_ngrams(text):
+            self.ngrams[ngram].add(key)
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for ngram in get_ngrams(text):
+            keys = self.ngrams[ngram]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.ngrams[ngram]
+
+    def search(self, query):
+        """Returns the set of keys whose text contains the query."""
+        query = query.lower()
+        if not query:
+            return set()
+        if len(query) <= NGRAM_SIZE:
+            return set(self.ngrams.get(query, ()))
+        postings = sorted((self.ngrams.get(query[i:i + NGRAM_SIZE], set())
+                           for i in range(len(query) - NGRAM_SIZE + 1)), key=len)
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            if len(keys) == 0:
+                break
+            keys &= posting
+        return {key for key in keys if query in self.texts[key]}
+
+
+class SearchIndex:
+    """The label and session search index of this process."""
+
+    def __init__(self):
+        self.labels = NgramIndex()
+        self.label_rows = {}
+        self.sessions = NgramIndex()
+        self.session_rows = {}
+        self.built = None
+        self.lock = threading.Lock()
+
+    def is_stale(self, ttl=SEARCH_INDEX_TTL):
+        return self.built is None or time.monotonic() - self.built > ttl
+
+    def set_label(self, label_id, label_type, label):
+        self.label_rows[label_id] = {'id': label_id, 'label_type': label_type, 'label': label}
+        self.labels.add(label_id, label)
+
+    def remove_label(self, label_id):
+        self.label_rows.pop(label_id, None)
+        self.labels.remove(label_id)
+
+    def set_session(self, session_id, text, annotation_type, updated):
+        self.session_rows[session_id] = {
+            'id': session_id,
+            'animal_abbreviation_username': text,
+            'label_type': annotation_type,
+            'updated': updated.strftime(UPDATED_FORMAT) if updated is not None else None,
+        }
+        self.sessions.add(session_id, text)
+
+    def remove_session(self, session_id):
+        self.session_rows.pop(session_id, None)
+        self.sessions.remove(session_id)
+
+    def search_labels(self, query):
+        """Returns the labels containing the query, ordered by label."""
+        rows = [self.label_rows[label_id] for label_id in self.labels.search(query)]
+        return sorted(rows, key=lambda row: (row['label'], row['id']))
+
+    def search_sessions(self, query, exclude_type='cell'):
+        """Returns the sessions whose text contains the query, ordered by the text."""
+        rows = [self.session_rows[session_id] for session_id in self.sessions.search(query)]
+        rows = [row for row in rows if row['label_type'] != exclude_type]
+        return sorted(rows, key=lambda row: (row['animal_abbreviation_username'], row['id']))
+
+
+def load_labels():
+    return AnnotationLabel.objects.values_list('id', 'label_type', 'label')
+
+
+def load_sessions(session_ids=None):
+    """Returns (id, text, type, updated) of the rows of search_sessions.
+
+    :param session_ids: only these sessions
+    """
+    rows = SearchSessions.objects.all()
+    if session_ids is not None:
+        rows = rows.filter(id__in=session_ids)
+    return rows.values_list('id', 'animal_abbreviation_username', 'label_type', 'updated')
+
+
+_index = SearchIndex()
+_rebuild_lock = threading.Lock()
+
+
+def get_search_index():
+    """Returns the search index of this process, built again when it is older than
+    SEARCH_INDEX_TTL. While one thread rebuilds it the others use the old index."""
+    if _index.is_stale() and _rebuild_lock.acquire(blocking=_index.built is None):
+        try:
+            if _index.is_stale():
+                rebuild()
+        finally:
+            _rebuild_lock.release()
+    return _index
+
+
+def search_labels(query):
+    search_index = get_search_index()
+    with search_index.lock:
+        return search_index.search_labels(query)
+
+
+def search_sessions(query):
+    search_index = get_search_index()
+    with search_index.lock:
+        return search_index.search_sessions(query)
+
+
+def rebuild():
+    """Builds the index from the database. The rows are read before the lock is
+    taken so searches are answered from the old index meanwhile."""
+    labels = list(load_labels())
+    sessions = list(load_sessions())
+    fresh = SearchIndex()
+    for row in labels:
+        fresh.set_label(*row)
+    for row in sessions:
+        fresh.set_session(*row)
+    with _index.lock:
+        _index.labels, _index.label_rows = fresh.labels, fresh.label_rows
+        _index.sessions, _index.session_rows = fresh.sessions, fresh.session_rows
+        _index.built = time.monotonic()
+
+
+def refresh_label(label_id):
+    """Reloads a label after it was saved."""
+    if _index.built is None:
+        return
+    label = AnnotationLabel.objects.filter(id=label_id).values_list('id', 'label_type', 'label').first()
+    with _index.lock:
+        if label is None:
+            _index.remove_label(label_id)
+        else:
+            _index.set_label(*label)
+
+
+def remove_label(label_id):
+    if _index.built is None:
+        return
+    with _index.lock:
+        _index.remove_label(label_id)
+
+
+def refresh_sessions(session_ids):
+    """Reloads sessions after their search_sessions rows were refreshed. The sessions
+    without a row are removed."""
+    if _index.built is None or len(session_ids) == 0:
+        return
+    rows = list(load_sessions(session_ids))
+    with _index.lock:
+        for session_id in set(session_ids) - {row[0] for row in rows}:
+            _index.remove_session(session_id)
+        for row in rows:
+            _index.set_session(*row)
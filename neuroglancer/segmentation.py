@@ -0,0 +1,284 @@
+"""Creates the 3D segmentation volumes of annotation sessions in the background.
+
+Building a volume runs the polygon interpolation, the Gaussian, the precomputed
+writer and the igneous meshing and can take minutes for large structures, which
+is too long for one HTTP request. A job is submitted instead and the client polls
+its status:
+
+#. ``POST annotations/segmentation/jobs`` returns the job id straight away.
+#. ``GET annotations/segmentation/jobs/<id>`` returns the status, the progress
+   and, once it is done, the precomputed URL.
+
+The jobs are stored in a small SQLite database so every web server process sees
+the same jobs, and each process runs the jobs it was given in a thread pool.
+A job is identified by the session and the parameters, so submitting the same
+segmentation again while it is queued or running returns the existing job.
+Jobs that were running in a process that stopped are marked as failed when the
+next process starts its pool.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from brain.models import ScanRun
+from neuroglancer.annotation_session_manager import AnnotationSessionManager
+from neuroglancer.models import AnnotationSession, DEBUG
+from neuroglancer.structures_cache import evict, get_cached_folder, get_folder_name, get_segmentation_key, lock_folder, \
+    mark_complete
+
+SEGMENTATION_JOBS_DB = getattr(settings, 'SEGMENTATION_JOBS_DB', os.path.join(tempfile.gettempdir(), 'brainsharer_segmentation_jobs.sqlite3'))
+SEGMENTATION_WORKERS = getattr(settings, 'SEGMENTATION_WORKERS', 2)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segmentation_job (
+    id TEXT PRIMARY KEY,
+    job_key TEXT NOT NULL,
+    session_id INTEGER NOT NULL,
+    parameters TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    url TEXT,
+    name TEXT,
+    pid INTEGER,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS UK__segmentation_job_active_key
+    ON segmentation_job (job_key) WHERE status IN ('queued', 'running');
+"""
+
+
+class SegmentationError(Exception):
+    """Raised when a segmentation volume cannot be created from an annotation session."""
+
+
+def create_segmentation(session_id, stdDevX, stdDevY, stdDevZ, interpolate, progress=None):
+    """Creates the 3D segmentation volume of an annotation session: the polygons are
+    interpolated, filled and blurred into a volume which is written as a precomputed
+    folder with its mesh. This is used by the Segmentation view and the job workers.
+    The folder name is a hash of the annotation and the parameters, so a segmentation
+    that was already created is returned without doing any of the work. The folder is
+    checked and built while holding its lock, see structures_cache.lock_folder, so the
+    same segmentation asked for twice at once is built once.
+
+    :param session_id: the primary key of the annotation session
+    :param stdDevX: the standard deviation of the Gaussian in x
+    :param stdDevY: the standard deviation of the Gaussian in y
+    :param stdDevZ: the standard deviation of the Gaussian in z
+    :param interpolate: the number of points to interpolate
+    :param progress: optional callable taking a fraction between 0 and 1 and a message
+    :return: a dictionary with the precomputed url and the folder name
+    """
+
+    def report(fraction, message):
+        if progress is not None:
+            progress(fraction, message)
+
+    start_time = timer()
+    try:
+        annotationSession = AnnotationSession.objects.get(pk=session_id)
+    except AnnotationSession.DoesNotExist:
+        raise SegmentationError("Annotation data does not exist")
+    try:
+        scan_run = ScanRun.objects.get(prep=annotationSession.animal)
+    except ScanRun.DoesNotExist:
+        raise SegmentationError("Scan run data does not exist")
+
+    label = annotationSession.labels.first()
+    annotation_session_manager = AnnotationSessionManager(scan_run, label)
+    label_name = label.label if label is not None else label
+    key = get_segmentation_key(annotationSession.annotation, stdDevX, stdDevY, stdDevZ, interpolate,
+                               annotation_session_manager.isotropic, annotation_session_manager.color)
+    folder_name = get_folder_name(annotationSession.animal, label_name, key)
+    result = {'url': f"precomputed://{settings.HTTP_HOST}/structures/{folder_name}", 'name': folder_name}
+    with lock_folder(folder_name):
+        if get_cached_folder(folder_name):
+            report(1.0, 'Done')
+            return result
+
+        report(0.05, 'Creating the polygons')
+        polygons = annotation_session_manager.create_polygons(annotationSession.annotation, int(interpolate))
+        if not isinstance(polygons, dict):
+            raise SegmentationError(polygons)
+        origin, section_size = annotation_session_manager.get_origin_and_section_size(polygons)
+        volume = annotation_session_manager.create_chunked_volume(polygons, origin, section_size, float(stdDevX), float(stdDevY), float(stdDevZ))
+        if volume.shape[0] == 0 or volume.shape[1] == 0:
+            raise SegmentationError("Volume could not be created")
+        report(0.3, 'Creating the volume and writing the precomputed data')
+        annotation_session_manager.create_segmentation_folder(volume, annotationSession.animal,
+                                                 label, origin.tolist(), folder_name=folder_name)
+        del volume
+        mark_complete(folder_name, key)
+    evict(keep=folder_name)
+    report(1.0, 'Done')
+    if DEBUG:
+        end_time = timer()
+        total_elapsed_time = round((end_time - start_time), 2)
+        print(f'Creating segmentation took {total_elapsed_time} seconds.')
+
+    return result
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def normalize_parameters(stdDevX, stdDevY, stdDevZ, interpolate):
+    """Returns the parameters as numbers so '1' and '1.0' are the same job."""
+    return {'stdDevX': float(stdDevX), 'stdDevY': float(stdDevY), 'stdDevZ': float(stdDevZ),
+            'interpolate': int(interpolate)}
+
+
+def get_job_key(session_id, parameters):
+    text = json.dumps({'session_id': int(session_id), **parameters}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class SegmentationJobQueue:
+    """The SQLite job table and the thread pool of one process.
+    """
+
+    def __init__(self, path=SEGMENTATION_JOBS_DB, workers=SEGMENTATION_WORKERS, run=create_segmentation):
+        """
+        :param path: the path of the SQLite database
+        :param workers: the number of jobs run at the same time by this process
+        :param run: the function that creates the segmentation
+        """
+        self.path = path
+        self.workers = workers
+        self.run = run
+        self.executor = None
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def start(self):
+        """Starts the thread pool the first time a job is submitted. Jobs that another
+        process left running or queued are failed so they do not block new submissions.
+        """
+        with self.lock:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='segmentation')
+            with self.connect() as connection:
+                rows = connection.execute(
+                    'SELECT id, pid FROM segmentation_job WHERE status IN (?, ?)', ACTIVE).fetchall()
+                for row in rows:
+                    if row['pid'] != os.getpid() and not pid_is_running(row['pid']):
+                        self.update(row['id'], status=FAILED, message='The worker stopped before the job was done')
+
+    def submit(self, session_id, stdDevX, stdDevY, stdDevZ, interpolate):
+        """Queues a segmentation or returns the job that is already queued or running
+        for the same session and parameters.
+
+        :return: the job as a dictionary
+        """
+        self.start()
+        parameters = normalize_parameters(stdDevX, stdDevY, stdDevZ, interpolate)
+        job_key = get_job_key(session_id, parameters)
+        job_id = uuid.uuid4().hex
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    'SELECT id FROM segmentation_job WHERE job_key = ? AND status IN (?, ?)',
+                    (job_key, *ACTIVE)).fetchone()
+                if row is not None:
+                    connection.execute('COMMIT')
+                    return self.get(row['id'])
+                timestamp = now()
+                connection.execute(
+                    'INSERT INTO segmentation_job (id, job_key, session_id, parameters, status, pid, created, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, job_key, int(session_id), json.dumps(parameters), QUEUED, os.getpid(), timestamp, timestamp))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        self.executor.submit(self.work, job_id, int(session_id), parameters)
+        return self.get(job_id)
+
+    def work(self, job_id, session_id, parameters):
+        """Runs one job in a worker thread."""
+        self.update(job_id, status=RUNNING, message='Started')
+
+        def progress(fraction, message):
+            self.update(job_id, progress=fraction, message=message)
+
+        try:
+            result = self.run(session_id, progress=progress, **parameters)
+            self.update(job_id, status=DONE, progress=1.0, message='Done', url=result['url'], name=result['name'])
+        except Exception as e:
+            self.update(job_id, status=FAILED, message=str(e))
+        finally:
+            # the worker threads have their own database connections
+            close_old_connections()
+
+    def update(self, job_id, **values):
+        values['updated'] = now()
+        columns = ', '.join(f'{column} = ?' for column in values)
+        with self.connect() as connection:
+            connection.execute(f'UPDATE segmentation_job SET {columns} WHERE id = ?', (*values.values(), job_id))
+
+    def get(self, job_id):
+        """Returns the job as a dictionary or None if there is no job with this id."""
+        with self.connect() as connection:
+            row = connection.execute('SELECT * FROM segmentation_job WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {key: row[key] for key in ['id', 'session_id', 'status', 'progress', 'message', 'url', 'name', 'created', 'updated']}
+        job['parameters'] = json.loads(row['parameters'])
+        return job
+
+
+def pid_is_running(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the job queue of this process."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = SegmentationJobQueue()
+        return _queue
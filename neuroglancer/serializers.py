@@ -4,6 +4,7 @@
 from rest_framework import serializers
 from rest_framework.exceptions import APIException
 from neuroglancer.models import AnnotationLabel, AnnotationSession, NeuroglancerState
+from neuroglancer.points_cache import invalidate
 from authentication.models import Lab, User
 
 
@@ -24,6 +25,7 @@ class AnnotationSessionDataSerializer(serializers.Serializer):
 
     id = serializers.IntegerField()
     annotation = serializers.JSONField()
+    version = serializers.CharField(required=False)
 
 class AnnotationSearchSerializer(serializers.Serializer):
     """This one feeds the data import of annotations.
@@ -40,7 +42,26 @@ class LabelSerializer(serializers.Serializer):
     label_type = serializers.CharField()
     label = serializers.CharField()
 
-class NeuroglancerNoStateSerializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """Only returns the fields listed in the ?fields= query parameter, e.g. ?fields=id,comments,updated
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        names = get_requested_fields(self.context.get('request'))
+        if names is not None:
+            for name in set(self.fields) - names:
+                self.fields.pop(name)
+
+
+def get_requested_fields(request):
+    """Returns the set of field names of the ?fields= parameter or None if all fields are wanted."""
+    if request is None or request.method != 'GET' or not request.query_params.get('fields'):
+        return None
+    return {name.strip() for name in request.query_params['fields'].split(',') if name.strip()}
+
+
+class NeuroglancerNoStateSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Override method of entering a url into the DB.
     This serializer ignores the JSON state as it is a really big
     field to serialize when unneccessary.
@@ -55,7 +76,7 @@ class NeuroglancerNoStateSerializer(serializers.ModelSerializer):
         exclude = ('neuroglancer_state', )
 
 
-class NeuroglancerStateSerializer(serializers.ModelSerializer):
+class NeuroglancerStateSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Override method of entering a url into the DB.
     The url *probably* can't be in the NeuroglancerState when it is returned
     to neuroglancer as it crashes neuroglancer.
@@ -95,6 +116,7 @@ class NeuroglancerStateSerializer(serializers.ModelSerializer):
         if 'owner' in validated_data:
             owner = validated_data['owner']
             obj = self.save_neuroglancer_state(obj, owner)
+        invalidate(obj.id)
         return obj
 
     def save_neuroglancer_state(self, obj, owner):
@@ -121,7 +143,7 @@ class NeuroglancerStateSerializer(serializers.ModelSerializer):
             obj.save()
         except APIException:
             raise APIException('Could not save Neuroglancer model')
-        
+
         #obj.neuroglancer_state = None
         return obj
 
@@ -0,0 +1,129 @@
+"""Keeps the label signatures of the sessions, the search_sessions table, the
+in-process search index, the lookup cache and the Neuroglancer state summaries up to
+date when annotation labels, sessions, brain regions, cell types and Neuroglancer
+states are saved or deleted. The signals are connected in NeuroglancerConfig.ready.
+
+The label signatures and the state summaries are written in the same transaction
+as the saved rows. The search
+rows are refreshed once the transaction is committed, so they are computed from
+the saved data. Bulk operations do not send signals, they are picked up by
+scripts/update_search_sessions.py.
+"""
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from neuroglancer import lookup_cache, search_index
+from neuroglancer.models import AnnotationLabel, AnnotationSession, BrainRegion, CellType, NeuroglancerState, \
+    NeuroglancerStateSummary, Points, SearchSessions
+
+# the sessions of a label are refreshed this many at a time
+REFRESH_BATCH_SIZE = 1000
+# the fields of a label shown in the search, see label_saved
+LABEL_INDEX_FIELDS = {'label', 'label_type'}
+LABEL_SESSION_FIELDS = {'label', 'active'}
+
+
+def refresh_sessions(session_ids):
+    session_ids = list(session_ids)
+
+    def refresh():
+        for i in range(0, len(session_ids), REFRESH_BATCH_SIZE):
+            batch = session_ids[i:i + REFRESH_BATCH_SIZE]
+            SearchSessions.refresh(batch)
+            search_index.refresh_sessions(batch)
+
+    if session_ids:
+        transaction.on_commit(refresh)
+
+
+def get_label_sessions(label):
+    # the sessions of a label are label.labels, see AnnotationSession.labels
+    return list(label.labels.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=AnnotationLabel)
+@receiver(post_delete, sender=AnnotationLabel)
+@receiver(post_save, sender=BrainRegion)
+@receiver(post_delete, sender=BrainRegion)
+@receiver(post_save, sender=CellType)
+@receiver(post_delete, sender=CellType)
+def lookup_table_changed(sender, **kwargs):
+    # now and after the commit, so a rollback cannot leave an uncommitted row cached
+    lookup_cache.invalidate(sender)
+    transaction.on_commit(lambda: lookup_cache.invalidate(sender))
+
+
+@receiver(pre_save, sender=AnnotationLabel)
+def label_saving(sender, instance, update_fields=None, **kwargs):
+    # the values before the save, so label_saved knows what changed
+    fields = LABEL_INDEX_FIELDS | LABEL_SESSION_FIELDS
+    instance._previous = None
+    if instance.pk is not None and (update_fields is None or fields & set(update_fields)):
+        instance._previous = sender.objects.filter(pk=instance.pk).values(*fields).first()
+
+
+@receiver(post_save, sender=AnnotationLabel)
+def label_saved(sender, instance, created, update_fields=None, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    if previous is not None:
+        changed = {name for name, value in previous.items() if getattr(instance, name) != value}
+    elif created or update_fields is None:
+        changed = LABEL_INDEX_FIELDS | LABEL_SESSION_FIELDS
+    else:
+        changed = set()
+    if changed & LABEL_INDEX_FIELDS:
+        transaction.on_commit(lambda: search_index.refresh_label(instance.id))
+    # a new label has no session yet
+    if changed & LABEL_SESSION_FIELDS and not created:
+        refresh_sessions(get_label_sessions(instance))
+
+
+@receiver(pre_delete, sender=AnnotationLabel)
+def label_deleting(sender, instance, **kwargs):
+    # the sessions have to be read before the label is removed from them
+    instance._session_ids = get_label_sessions(instance)
+
+
+@receiver(post_delete, sender=AnnotationLabel)
+def label_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search_index.remove_label(instance.id))
+    session_ids = getattr(instance, '_session_ids', [])
+    AnnotationSession.update_label_signatures(session_ids)
+    refresh_sessions(session_ids)
+
+
+@receiver(post_save, sender=AnnotationSession)
+def session_saved(sender, instance, **kwargs):
+    refresh_sessions([instance.id])
+
+
+@receiver(m2m_changed, sender=AnnotationSession.labels.through)
+def session_labels_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # label.labels.clear() does not say which sessions lose the label
+        instance._session_ids = get_label_sessions(instance)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        session_ids = [instance.id]
+    elif action == 'post_clear':
+        session_ids = getattr(instance, '_session_ids', [])
+    else:
+        session_ids = list(pk_set)
+    # written now and not on commit, so get_session finds the session in this transaction
+    AnnotationSession.update_label_signatures(session_ids)
+    refresh_sessions(session_ids)
+
+
+@receiver(post_delete, sender=AnnotationSession)
+def session_deleted(sender, instance, **kwargs):
+    refresh_sessions([instance.id])
+
+
+@receiver(post_save, sender=NeuroglancerState)
+@receiver(post_save, sender=Points)
+def state_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'neuroglancer_state' not in update_fields:
+        return
+    NeuroglancerStateSummary.update_summary(instance)
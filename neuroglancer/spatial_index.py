@@ -0,0 +1,170 @@
+"""An in-process spatial index of the annotation points of every animal, so a client
+can ask for the points inside a bounding box instead of downloading whole sessions.
+
+There is one index per animal, built the first time the animal is queried. It has
+two levels:
+
+#. An R-tree of the bounding boxes of the active annotation sessions.
+#. For every session, a numpy array of its points in micrometers. Clouds and points
+   give their points, polygons and volumes the pointA of their lines.
+
+A query finds the sessions whose box intersects the query box in the R-tree and
+then filters their points with one vectorized comparison per session.
+
+Every web server process has its own index, so before each query the updated
+timestamps and labels of the animal's sessions are read with one light query and
+only the sessions that were added, saved or deleted since are loaded again. The
+indexes of the SPATIAL_INDEX_ANIMALS animals queried last are kept.
+"""
+import threading
+from itertools import islice
+import numpy as np
+from cachetools import LRUCache
+from django.conf import settings
+from rtree import index
+
+from neuroglancer.models import AnnotationSession
+from neuroglancer.precomputed_annotations import M_UM_SCALE, get_annotation_rows
+
+
+class SessionPoints:
+    """The points of one annotation session."""
+
+    def __init__(self, session_id, updated, labels, annotation):
+        self.session_id = session_id
+        self.updated = updated
+        self.labels = labels
+        points, lines = get_annotation_rows(annotation)
+        rows = points + lines
+        self.ids = [row.get('id') for row in rows]
+        self.types = [row.get('type') for row in rows]
+        coordinates = [row['point'] for row in points] + [row['pointA'] for row in lines]
+        self.points = np.array(coordinates, dtype=np.float64).reshape(-1, 3) * M_UM_SCALE
+
+    @property
+    def bounds(self):
+        """min x, min y, min z, max x, max y, max z as used by rtree."""
+        return tuple(self.points.min(axis=0).tolist() + self.points.max(axis=0).tolist())
+
+    def query(self, lower, upper):
+        """Returns the indexes of the points inside the box."""
+        inside = np.all((self.points >= lower) & (self.points <= upper), axis=1)
+        return np.flatnonzero(inside)
+
+
+class AnnotationSpatialIndex:
+    """The spatial index of the sessions of one animal.
+    """
+
+    def __init__(self):
+        properties = index.Property()
+        properties.dimension = 3
+        self.tree = index.Index(properties=properties)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def update(self, session_id, updated, labels, annotation):
+        """Adds a session or replaces its points."""
+        self.remove(session_id)
+        session = SessionPoints(session_id, updated, labels, annotation)
+        # sessions without points are kept so they are not loaded again, but not in the tree
+        self.sessions[session_id] = session
+        if len(session.points) > 0:
+            self.tree.insert(session_id, session.bounds)
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None and len(session.points) > 0:
+            self.tree.delete(session_id, session.bounds)
+
+    def query(self, lower, upper, labels=None):
+        """Yields the points inside the box, ordered by session ID.
+
+        :param lower: the min x,y,z corner in micrometers
+        :param upper: the max x,y,z corner in micrometers
+        :param labels: optional set of labels, a session must have one of them
+        :return: generator of dictionaries
+        """
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        for session_id in sorted(self.tree.intersection(tuple(lower.tolist() + upper.tolist()))):
+            session = self.sessions.get(session_id)
+            if session is None or (labels and not labels.intersection(session.labels)):
+                continue
+            for i in session.query(lower, upper):
+                x, y, z = session.points[i].tolist()
+                yield {'session_id': session_id, 'id': session.ids[i], 'type': session.types[i],
+                       'labels': session.labels, 'x': x, 'y': y, 'z': z}
+
+    def count(self, lower, upper, labels=None):
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        total = 0
+        for session_id in self.tree.intersection(tuple(lower.tolist() + upper.tolist())):
+            session = self.sessions.get(session_id)
+            if session is None or (labels and not labels.intersection(session.labels)):
+                continue
+            total += len(session.query(lower, upper))
+        return total
+
+    def synchronize(self, versions, load):
+        """Brings the index up to date with the database.
+
+        :param versions: dictionary of session ID -> (updated, labels) of the active sessions
+        :param load: function taking a list of session IDs and returning (id, annotation) pairs
+        """
+        for session_id in set(self.sessions) - set(versions):
+            self.remove(session_id)
+        changed = [session_id for session_id, (updated, labels) in versions.items()
+                   if session_id not in self.sessions or self.sessions[session_id].updated != updated]
+        for session_id, (updated, labels) in versions.items():
+            session = self.sessions.get(session_id)
+            if session is not None and session.updated == updated:
+                session.labels = labels
+        for session_id, annotation in load(changed):
+            updated, labels = versions[session_id]
+            self.update(session_id, updated, labels, annotation)
+
+
+SPATIAL_INDEX_ANIMALS = getattr(settings, 'SPATIAL_INDEX_ANIMALS', 8)
+_indexes = LRUCache(maxsize=SPATIAL_INDEX_ANIMALS)
+_indexes_lock = threading.Lock()
+
+
+def get_session_versions(animal):
+    versions = {}
+    rows = AnnotationSession.objects.filter(animal_id=animal, active=True).values_list('id', 'updated', 'labels__label')
+    for session_id, updated, label in rows:
+        _, labels = versions.setdefault(session_id, (updated, []))
+        if label is not None:
+            labels.append(label)
+    return {session_id: (updated, tuple(sorted(labels))) for session_id, (updated, labels) in versions.items()}
+
+
+def load_annotations(session_ids, batch_size=100):
+    for i in range(0, len(session_ids), batch_size):
+        yield from AnnotationSession.objects.filter(id__in=session_ids[i:i + batch_size]).values_list('id', 'annotation')
+
+
+def get_index(animal):
+    """Returns the up to date spatial index of an animal."""
+    with _indexes_lock:
+        spatial_index = _indexes.get(animal)
+        if spatial_index is None:
+            spatial_index = AnnotationSpatialIndex()
+            _indexes[animal] = spatial_index
+    versions = get_session_versions(animal)
+    with spatial_index.lock:
+        spatial_index.synchronize(versions, load_annotations)
+    return spatial_index
+
+
+def query_page(animal, lower, upper, labels, offset, limit):
+    """Returns the number of points of an animal inside the box and the list of them
+    from offset to offset + limit. Both are read under the lock of the index, so a
+    request synchronizing it meanwhile cannot change them."""
+    spatial_index = get_index(animal)
+    with spatial_index.lock:
+        count = spatial_index.count(lower, upper, labels)
+        rows = list(islice(spatial_index.query(lower, upper, labels), offset, offset + limit))
+    return count, rows
@@ -0,0 +1,167 @@
+"""A content addressed cache of the precomputed segmentation folders in the structures directory.
+
+The name of a segmentation folder ends with a hash of everything that changes the
+volume: the annotation JSON, the Gaussian sigmas, the interpolation, the isotropic
+resolution and the color. If the same segmentation is asked for again, the folder
+that is already there is returned straight away instead of being rebuilt.
+
+A marker file is written in a folder once the volume and the mesh are done, so a
+folder that is half written is never returned. It records the size of the folder.
+The modification time of the marker is updated on every hit and the least recently
+used folders are deleted when the finished folders take more than STRUCTURES_QUOTA
+bytes. Only folders with a marker are counted and ever evicted.
+
+A folder is checked, built and deleted while holding an exclusive file lock on
+``<folder name>.lock`` next to it, so two requests or processes asking for the same
+segmentation never write into the same folder at once and a folder is not evicted
+while it is being returned. The lock files are never deleted: removing one while
+another process waits on it would let two processes hold the lock.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from django.conf import settings
+
+STRUCTURES_PATH = getattr(settings, 'STRUCTURES_PATH', '/var/www/brainsharer/structures')
+STRUCTURES_QUOTA = getattr(settings, 'STRUCTURES_QUOTA', 20 * 1024 ** 3)
+MARKER = '.segmentation.json'
+
+
+def get_segmentation_key(annotation, stdDevX, stdDevY, stdDevZ, interpolate, isotropic, color):
+    """Returns the hash of the annotation and all the parameters used to create its volume.
+
+    :param annotation: the annotation JSON of the session
+    :return: a hex string
+    """
+    content = {
+        'annotation': annotation,
+        'stdDevX': float(stdDevX),
+        'stdDevY': float(stdDevY),
+        'stdDevZ': float(stdDevZ),
+        'interpolate': int(interpolate),
+        'isotropic': float(isotropic),
+        'color': int(color),
+    }
+    text = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_folder_name(animal, label, key):
+    """Returns the name of the segmentation folder, e.g. MD589_SC_1f3a5b7c9d0e2f4a"""
+    label = str(label).replace(' ', '_')
+    return f'{animal}_{label}_{key[:16]}'
+
+
+def get_marker_path(folder_name):
+    return os.path.join(STRUCTURES_PATH, folder_name, MARKER)
+
+
+@contextmanager
+def lock_folder(folder_name, blocking=True):
+    """Holds the exclusive lock of a segmentation folder, shared by all the threads and
+    processes. Yields True, or False when blocking is False and the lock is taken."""
+    os.makedirs(STRUCTURES_PATH, exist_ok=True)
+    with open(os.path.join(STRUCTURES_PATH, f'{folder_name}.lock'), 'a') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def get_cached_folder(folder_name):
+    """Returns True and marks the folder as used if a finished segmentation folder exists."""
+    marker_path = get_marker_path(folder_name)
+    if not os.path.isfile(marker_path):
+        return False
+    try:
+        os.utime(marker_path)
+    except OSError:
+        return False
+    return True
+
+
+def write_marker(marker_path, key, size):
+    tmp_path = f'{marker_path}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump({'key': key, 'size': size}, fh)
+    os.replace(tmp_path, marker_path)
+
+
+def mark_complete(folder_name, key):
+    """Writes the marker of a finished segmentation folder with the size of the folder."""
+    write_marker(get_marker_path(folder_name), key, get_folder_size(os.path.join(STRUCTURES_PATH, folder_name)))
+
+
+def get_marked_size(folder_path):
+    """Returns the size recorded in the marker of a folder. A marker written before
+    the size was recorded gets it now, keeping its modification time."""
+    marker_path = os.path.join(folder_path, MARKER)
+    try:
+        with open(marker_path) as fh:
+            marker = json.load(fh)
+        if 'size' in marker:
+            return marker['size']
+        used = os.path.getmtime(marker_path)
+        size = get_folder_size(folder_path)
+        write_marker(marker_path, marker.get('key'), size)
+        os.utime(marker_path, (used, used))
+    except (OSError, ValueError):
+        return get_folder_size(folder_path)
+    return size
+
+
+def get_folder_size(path):
+    """Returns the size of the files of a folder, without its marker."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            if filename.startswith(MARKER):
+                continue
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return size
+
+
+def evict(keep=None, quota=STRUCTURES_QUOTA):
+    """Deletes the least recently used segmentation folders until the finished
+    folders are under the quota. The sizes are read from the markers. A folder whose
+    lock is taken is being returned or rebuilt and is skipped.
+
+    :param keep: name of a folder that must not be deleted, e.g. the one just created
+    :param quota: the maximum size in bytes
+    :return: the names of the deleted folders
+    """
+    if not os.path.isdir(STRUCTURES_PATH):
+        return []
+    folders = []
+    total = 0
+    for entry in os.scandir(STRUCTURES_PATH):
+        marker_path = os.path.join(entry.path, MARKER)
+        if not entry.is_dir(follow_symlinks=False) or not os.path.isfile(marker_path):
+            continue
+        size = get_marked_size(entry.path)
+        total += size
+        if entry.name != keep:
+            folders.append((os.path.getmtime(marker_path), entry.name, size))
+
+    deleted = []
+    for _, name, size in sorted(folders):
+        if total <= quota:
+            break
+        with lock_folder(name, blocking=False) as locked:
+            if not locked:
+                continue
+            shutil.rmtree(os.path.join(STRUCTURES_PATH, name), ignore_errors=True)
+        total -= size
+        deleted.append(name)
+    return deleted
@@ -20,7 +20,7 @@ def upsert_annotations(layer, neuroglancer_state_id):
     neuroglancerState = NeuroglancerState.objects.get(pk=neuroglancer_state_id)
     manager = AnnotationManager(neuroglancerState)
     start_time = timer()
-    manager.set_current_layer(layer) # This takes a LONG time for polygons/volumes!
+    manager.set_current_layer(layer)
     if DEBUG:
         end_time = timer()
         total_elapsed_time = round((end_time - start_time),2)
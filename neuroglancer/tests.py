@@ -1,11 +1,34 @@
+import io
 import json
+import numpy as np
+import os
+import tempfile
+import threading
+from unittest import mock
 from rest_framework import status
-from django.test import Client, TestCase
+from django.test import Client, SimpleTestCase, TestCase
 from rest_framework.test import APIClient
 
 from authentication.models import User
 from brain.models import Animal, ScanRun
-from neuroglancer.models import AnnotationSession, LAUREN_ID, AnnotationLabel
+from neuroglancer.models import AnnotationSession, LAUREN_ID, AnnotationLabel, NeuroglancerState, SearchSessions, get_label_signature
+from neuroglancer.json_stream import iter_items, iter_path, find_values
+from neuroglancer.json_patch import JsonPatchError, apply_children_delta, apply_patch
+from neuroglancer.points_parser import COLUMNS, create_points_dataframe
+from neuroglancer.contours.annotation_layer import AnnotationLayer, ColumnarAnnotationLayer, ContourSorter
+from neuroglancer.contours.edge_chain import chain_order
+from neuroglancer.segmentation import DONE, FAILED, SegmentationError, SegmentationJobQueue
+from neuroglancer import structures_cache
+from neuroglancer import response_cache
+from neuroglancer.precomputed_annotations import compressed_morton_code, create_writer, read_sharded
+from neuroglancer.spatial_index import AnnotationSpatialIndex, get_index, query_page
+from neuroglancer.annotation_export import csv_lines, iter_session_rows, ndjson_lines, render_page
+from neuroglancer.search_index import SearchIndex
+from neuroglancer.lookup_cache import Lookup, LookupTable
+from brainsharer.admin_extensions import ExportCsvMixin, gzip_lines
+from brainsharer.pagination import UpdatedKeysetPagination
+from brainsharer.query_budget import QueryRecorder, assert_max_queries, fingerprint
+from neuroglancer.annotation_session_manager import AnnotationSessionManager, ChunkedVolume
 
 
 class TestSetUp(TestCase):
@@ -114,6 +137,14 @@ class TestAnnotations(TestSetUp):
         response = self.client.get("/annotations/labels")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_get_label_query_budget(self):
+        """The labels come from the lookup cache, so loading them again runs no query
+        """
+        self.client.get("/annotations/labels")
+        with assert_max_queries(2):
+            response = self.client.get("/annotations/labels")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_get_labs(self):
         """Test the API that returns labels
         """
@@ -207,6 +238,31 @@ class TestAnnotations(TestSetUp):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_annotations_patch_conflict(self):
+        """Test that a PATCH made against an older version of the annotation is refused
+        """
+        self.annotation_session.annotation = {"type": "volume", "childJsons": []}
+        self.annotation_session.save()
+        client = APIClient()
+        client.force_authenticate(user=self.annotator)
+        url = f"{self.annotation_api_url}{self.annotation_session.id}"
+        response = client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{self.annotation_session.version}"')
+
+        patch = [{"op": "add", "path": "/description", "value": "first"}]
+        response = client.patch(url, patch, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['version'], self.annotation_session.version)
+
+        patch = [{"op": "add", "path": "/description", "value": "second"}]
+        response = client.patch(url, patch, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.annotation_session.refresh_from_db()
+        self.assertEqual(self.annotation_session.annotation['description'], 'first')
+        self.assertEqual(response.data['version'], self.annotation_session.version)
+
     def test_annotations_put_no_animal(self):
         """Test the API that updates an existing annotation session
         """
@@ -218,3 +274,699 @@ class TestAnnotations(TestSetUp):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+class TestSearchSessionSignals(TestSetUp):
+    """Tests that the search_sessions rows follow the saves of the sessions and labels
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.signal_label = AnnotationLabel.objects.create(label='TestSignalLabel', label_type='brain region',
+                                                           description='test', active=True)
+        self.signal_session = AnnotationSession.objects.create(animal=self.animal, annotator=self.annotator,
+                                                               annotation={'type': 'volume'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.signal_session.labels.add(self.signal_label)
+
+    def get_row(self):
+        return SearchSessions.objects.filter(pk=self.signal_session.id).first()
+
+    def test_session_saved(self):
+        self.assertEqual(self.get_row().labels, 'TestSignalLabel')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.signal_session.annotation = {'type': 'cell'}
+            self.signal_session.save()
+        self.assertEqual(self.get_row().label_type, 'cell')
+
+    def test_label_renamed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.signal_label.label = 'TestSignalRenamed'
+            self.signal_label.save()
+        self.assertEqual(self.get_row().labels, 'TestSignalRenamed')
+        self.assertIn('TestSignalRenamed', self.get_row().animal_abbreviation_username)
+
+    def test_label_unchanged(self):
+        """Saving a label without changing its name or active does not refresh its sessions"""
+        with mock.patch.object(SearchSessions, 'refresh') as refresh, self.captureOnCommitCallbacks(execute=True):
+            self.signal_label.description = 'changed'
+            self.signal_label.save()
+        refresh.assert_not_called()
+
+    def test_label_deleted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.signal_label.delete()
+        self.assertIsNone(self.get_row())
+        self.signal_session.refresh_from_db()
+        self.assertIsNone(self.signal_session.label_signature)
+
+
+class TestNeuroglancerStateJson(SimpleTestCase):
+    """Tests that a loaded state is read from the object and not from the database
+    """
+
+    def test_loaded_state(self):
+        state = NeuroglancerState(id=1, neuroglancer_state={'layers': [
+            {'name': 'image'}, {'name': 'COM', 'annotations': [{'point': [1.4, 2.6, 3]}, {'point': [4, 5, 6]}]}]})
+        with mock.patch.object(NeuroglancerState, 'get_raw_state') as get_raw_state:
+            self.assertEqual(state.annotation_counts, [('COM', 2)])
+            self.assertEqual(state.point_frame.values.tolist(), [[1, 3, 3], [4, 5, 6]])
+            # unsaved changes are seen
+            state.neuroglancer_state['layers'][1]['annotations'].pop()
+            self.assertEqual(state.annotation_counts, [('COM', 1)])
+        get_raw_state.assert_not_called()
+
+
+class TestPointsParser(SimpleTestCase):
+    """Tests the single pass parser used by NeuroglancerState.points
+    """
+
+    def setUp(self):
+        self.layers = [
+            {'type': 'image', 'name': 'C1'},
+            {'type': 'annotation', 'name': 'premotor', 'annotations': [
+                {'id': 'p1', 'type': 'point', 'point': [10.0, 20.0, 5.6], 'description': 'one\ntwo'},
+                {'id': 'c1', 'type': 'cloud'},
+                {'id': 'c1a', 'type': 'point', 'parentAnnotationId': 'c1', 'point': [1.0, 2.0, 3.0]},
+                {'id': 'c1b', 'type': 'point', 'parentAnnotationId': 'c1', 'point': [4.0, 5.0, 6.0]},
+                {'id': 'v1', 'type': 'volume', 'description': 'SC'},
+                {'id': 'pg1', 'type': 'polygon', 'parentAnnotationId': 'v1'},
+                {'id': 'l2', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [2.0, 0.0, 1.0], 'pointB': [0.0, 2.0, 1.0]},
+                {'id': 'l1', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [0.0, 0.0, 1.0], 'pointB': [2.0, 0.0, 1.0]},
+                {'id': 'l3', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [0.0, 2.0, 1.0], 'pointB': [0.0, 0.0, 1.0]},
+            ]},
+        ]
+
+    def test_columns_and_types(self):
+        df = create_points_dataframe(self.layers, xy_resolution=0.5, z_resolution=20)
+        self.assertEqual(list(df.columns), COLUMNS)
+        self.assertEqual(len(df), 6)
+        self.assertEqual(sorted(df['Type'].unique()), ['cloud', 'point', 'volume'])
+        point = df[df.Type == 'point'].iloc[0]
+        self.assertEqual(point['Labels'], 'one, two')
+        self.assertEqual(point['Section'], 5)
+        self.assertEqual(point['Zum'], 100)
+        self.assertEqual(point['Xum'], 5.0)
+        cloud = df[df.Type == 'cloud']
+        self.assertEqual(list(cloud['Labels'].unique()), ['unlabeled cloud point'])
+
+    def test_polygon_order(self):
+        df = create_points_dataframe(self.layers)
+        volume = df[df.Type == 'volume']
+        self.assertEqual(list(volume['Order']), [1, 2, 3])
+        self.assertEqual(list(volume['Labels'].unique()), ['SC'])
+
+    def test_no_annotations(self):
+        self.assertIsNone(create_points_dataframe([{'type': 'image', 'name': 'C1'}]))
+
+
+class TestJsonStream(SimpleTestCase):
+    """Tests the streaming extractor used on the raw Neuroglancer JSON
+    """
+
+    def setUp(self):
+        self.state = {'layers': [
+            {'type': 'image', 'name': 'C1', 'source': 'precomputed://x'},
+            {'type': 'annotation', 'name': 'SC [left] {"x"}', 'annotations': [
+                {'id': 'a', 'type': 'point', 'point': [1, 2.5, -3e2], 'description': 'a\nb'},
+                {'id': 'b', 'type': 'point', 'point': [4, 5, 6]},
+            ]},
+        ], 'position': [1, 2, 3]}
+        self.raw = json.dumps(self.state)
+
+    def test_layer_names(self):
+        expected = ['C1', 'SC [left] {"x"}']
+        self.assertEqual(list(iter_path(self.raw, ('layers', '*', 'name'))), expected)
+        # a tiny chunk size makes every token cross a chunk boundary
+        source = io.BytesIO(self.raw.encode())
+        self.assertEqual(list(iter_path(source, ('layers', '*', 'name'), chunk_size=3)), expected)
+
+    def test_counts(self):
+        for source in [self.raw, io.StringIO(self.raw)]:
+            items = list(iter_items(source, ('layers', '*'), keys=('name',), counts=('annotations',), chunk_size=5))
+            self.assertEqual(items, [{'name': 'C1'}, {'name': 'SC [left] {"x"}', 'annotations': 2}])
+
+    def test_find_values(self):
+        self.assertEqual(find_values('annotations', self.raw), [self.state['layers'][1]['annotations']])
+
+
+class TestColumnarAnnotationLayer(SimpleTestCase):
+    """Tests that the columnar annotation layer groups like the object based one
+    """
+
+    def setUp(self):
+        lines = [
+            {'id': 'l1', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [0.0, 0.0, 1.0], 'pointB': [2.0, 0.0, 1.0]},
+            {'id': 'l2', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [2.0, 0.0, 1.0], 'pointB': [0.0, 2.0, 1.0]},
+            {'id': 'l3', 'type': 'line', 'parentAnnotationId': 'pg1', 'pointA': [0.0, 2.0, 1.0], 'pointB': [0.0, 0.0, 1.0]},
+        ]
+        self.layer = {'type': 'annotation', 'name': 'SC', 'source': '', 'annotations': [
+            {'id': 'v1', 'type': 'volume', 'childAnnotationIds': ['pg1'], 'source': [0, 0, 1], 'description': 'SC'},
+            {'id': 'pg1', 'type': 'polygon', 'childAnnotationIds': ['l1', 'l2', 'l3'], 'source': [0, 0, 1], 'parentAnnotationId': 'v1'},
+            *lines,
+            {'id': 'c1', 'type': 'cell', 'point': [5.0, 6.0, 7.0], 'description': 'positive', 'category': ''},
+        ]}
+
+    def test_same_grouping(self):
+        expected = AnnotationLayer(json.loads(json.dumps(self.layer)))
+        layer = ColumnarAnnotationLayer(self.layer)
+        self.assertEqual([a.id for a in layer.annotations], [a.id for a in expected.annotations])
+        volume = layer.get_volumes()[0]
+        self.assertEqual(volume.get_volume_name_and_contours()[1].keys(),
+                         expected.get_volumes()[0].get_volume_name_and_contours()[1].keys())
+        self.assertEqual([line.id for line in volume.childs[0].childs], ['l1', 'l2', 'l3'])
+        self.assertEqual(layer.get_polygon_points(1).tolist(), [[0.0, 0.0, 1.0], [2.0, 0.0, 1.0], [0.0, 2.0, 1.0]])
+        self.assertIsNone(layer.get_annotation_with_id('l1'))
+        self.assertEqual(layer.search_annotation_with_id('l1').id, 'l1')
+
+
+class TestEdgeChain(SimpleTestCase):
+    """Tests the linear ordering of the lines of a polygon
+    """
+
+    def setUp(self):
+        self.points = [[0.0, 0.0, 1.0], [2.0, 0.0, 1.0], [2.0, 2.0, 1.0], [0.0, 2.0, 1.0]]
+        # pointB is a little off, but within the 0.1 tolerance
+        self.lines = [(self.points[i], [x + 0.06 for x in self.points[(i + 1) % 4]]) for i in range(4)]
+
+    def test_shuffled_polygon(self):
+        shuffled = [self.lines[i] for i in [0, 3, 1, 2]]
+        order = chain_order([a for a, _ in shuffled], [b for _, b in shuffled])
+        self.assertEqual(order.tolist(), [0, 2, 3, 1])
+        sorter = ContourSorter([a for a, _ in shuffled], [b for _, b in shuffled], first_point=self.points[2])
+        self.assertEqual(list(sorter.sort_index), [3, 1, 0, 2])
+
+    def test_broken_polygon(self):
+        lines = self.lines[:2] + [([5.0, 5.0, 1.0], [6.0, 6.0, 1.0])]
+        order = chain_order([a for a, _ in lines], [b for _, b in lines])
+        self.assertEqual(order.tolist(), [0, 1, 2])
+
+
+class TestSegmentationJobs(SimpleTestCase):
+    """Tests the segmentation job queue with a fake segmentation function
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.release = threading.Event()
+        self.calls = []
+
+        def run(session_id, progress, **parameters):
+            self.calls.append(session_id)
+            progress(0.5, 'Halfway')
+            self.release.wait(5)
+            if session_id == 2:
+                raise SegmentationError('Volume could not be created')
+            return {'url': f'precomputed://host/structures/{session_id}', 'name': str(session_id)}
+
+        self.queue = SegmentationJobQueue(os.path.join(self.directory.name, 'jobs.sqlite3'), workers=2, run=run)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.executor.shutdown(wait=True)
+        self.directory.cleanup()
+
+    def test_coalesce_and_finish(self):
+        job = self.queue.submit(1, '1', '1', '1.0', '2')
+        same = self.queue.submit(1, 1.0, 1, 1, 2)
+        other = self.queue.submit(1, 2, 1, 1, 2)
+        self.assertEqual(job['id'], same['id'])
+        self.assertNotEqual(job['id'], other['id'])
+        self.release.set()
+        self.queue.executor.shutdown(wait=True)
+        job = self.queue.get(job['id'])
+        self.assertEqual(job['status'], DONE)
+        self.assertEqual(job['url'], 'precomputed://host/structures/1')
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_failed_job(self):
+        job = self.queue.submit(2, 1, 1, 1, 2)
+        self.release.set()
+        self.queue.executor.shutdown(wait=True)
+        job = self.queue.get(job['id'])
+        self.assertEqual(job['status'], FAILED)
+        self.assertEqual(job['message'], 'Volume could not be created')
+        self.assertIsNone(self.queue.get('missing'))
+
+
+class TestStructuresCache(SimpleTestCase):
+    """Tests the content addressed segmentation folders
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(structures_cache, 'STRUCTURES_PATH', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def create_folder(self, name, size, used):
+        os.makedirs(os.path.join(self.directory.name, name))
+        with open(os.path.join(self.directory.name, name, 'data'), 'wb') as fh:
+            fh.write(b'0' * size)
+        structures_cache.mark_complete(name, name)
+        marker = structures_cache.get_marker_path(name)
+        os.utime(marker, (used, used))
+
+    def test_key(self):
+        annotation = {'childJsons': [{'pointA': [1, 2, 3]}]}
+        key = structures_cache.get_segmentation_key(annotation, '1', 1, 1.0, '0', 10, 851)
+        self.assertEqual(key, structures_cache.get_segmentation_key(dict(annotation), 1, 1, 1, 0, 10.0, 851))
+        self.assertNotEqual(key, structures_cache.get_segmentation_key(annotation, 2, 1, 1, 0, 10, 851))
+        self.assertTrue(structures_cache.get_folder_name('MD589', 'SC left', key).startswith('MD589_SC_left_'))
+
+    def test_evict_least_recently_used(self):
+        self.create_folder('old', 100, 1000)
+        self.create_folder('new', 100, 3000)
+        self.create_folder('kept', 100, 500)
+        os.makedirs(os.path.join(self.directory.name, 'building'))
+        self.assertFalse(structures_cache.get_cached_folder('building'))
+        self.assertTrue(structures_cache.get_cached_folder('new'))
+        deleted = structures_cache.evict(keep='kept', quota=250)
+        self.assertEqual(deleted, ['old'])
+        folders = [name for name in os.listdir(self.directory.name) if not name.endswith('.lock')]
+        self.assertEqual(sorted(folders), ['building', 'kept', 'new'])
+
+    def test_locked_folder(self):
+        self.create_folder('old', 100, 1000)
+        self.create_folder('new', 100, 3000)
+        with structures_cache.lock_folder('old'):
+            with structures_cache.lock_folder('old', blocking=False) as locked:
+                self.assertFalse(locked)
+            # a folder that is being returned or rebuilt is not deleted
+            self.assertEqual(structures_cache.evict(quota=0), ['new'])
+        self.assertEqual(structures_cache.evict(quota=0), ['old'])
+
+    def test_marker_size(self):
+        self.create_folder('new', 100, 3000)
+        with mock.patch.object(structures_cache, 'get_folder_size') as get_folder_size:
+            self.assertEqual(structures_cache.evict(quota=1000), [])
+        get_folder_size.assert_not_called()
+        # a marker without the size gets it once, and stays as recently used as it was
+        marker = structures_cache.get_marker_path('new')
+        with open(marker, 'w') as fh:
+            json.dump({'key': 'new'}, fh)
+        os.utime(marker, (3000, 3000))
+        self.assertEqual(structures_cache.get_marked_size(os.path.dirname(marker)), 100)
+        with open(marker) as fh:
+            self.assertEqual(json.load(fh), {'key': 'new', 'size': 100})
+        self.assertEqual(os.path.getmtime(marker), 3000)
+
+
+class TestChunkedVolume(SimpleTestCase):
+    """Tests that the blocks of the chunked volume are the same as blurring the whole volume
+    """
+
+    def test_blocks(self):
+        from scipy.ndimage import gaussian_filter
+        angles = np.linspace(0, 2 * np.pi, 30, endpoint=False)
+        polygons = {z: list(zip(20 + (5 + z % 4) * np.cos(angles), 20 + 8 * np.sin(angles))) for z in range(10, 31)}
+        origin, section_size = np.array([10, 8, 10]), np.array([26, 22])
+        volume = ChunkedVolume(polygons, origin, section_size, 851, (1, 1, 1.5), block_size=4, executor='thread', workers=3)
+        whole = ChunkedVolume(polygons, origin, section_size, 851, (0, 0, 0), block_size=100, executor='serial')
+        mask = next(iter(whole))[1] > 0
+        expected = np.where(gaussian_filter(mask.astype(np.float64), (1, 1, 1.5), mode='nearest') > 0, 851, 0)
+        blocks = list(volume)
+        self.assertEqual([z for z, _ in blocks], [0, 4, 8, 12, 16, 20])
+        result = np.concatenate([block for _, block in blocks], axis=2)
+        self.assertEqual(result.shape, (22, 26, 21))
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestBSpline(SimpleTestCase):
+    """Tests the batch B-spline resampling against scipy's splev
+    """
+
+    def test_same_as_splev(self):
+        import scipy.interpolate as si
+        rng = np.random.default_rng(0)
+        sections = {i: rng.normal(size=(count, 2)) for i, count in enumerate([3, 7, 7, 40])}
+        resampled = AnnotationSessionManager.resample_sections(sections, n=50, degree=3)
+        for i, cv in sections.items():
+            count = len(cv)
+            degree = min(3, count - 1)
+            kv = np.concatenate(([0] * degree, np.arange(count - degree + 1), [count - degree] * degree))
+            u = np.linspace(0, count - degree, 50)
+            expected = np.array(si.splev(u, (kv, cv.T, degree))).T
+            np.testing.assert_allclose(resampled[i], expected, atol=1e-12)
+            np.testing.assert_allclose(AnnotationSessionManager.bspliner(cv, 50, 3), expected, atol=1e-12)
+
+
+class TestJsonPatch(SimpleTestCase):
+    """Tests the JSON Patch operations and the children delta of an annotation
+    """
+
+    def setUp(self):
+        self.annotation = {'id': 'v1', 'type': 'volume', 'childAnnotationIds': ['pg1', 'pg2'], 'childJsons': [
+            {'id': 'pg1', 'childJsons': [{'id': 'l1', 'pointA': [1, 2, 3], 'pointB': [4, 5, 3]}]},
+            {'id': 'pg2', 'childJsons': []}]}
+
+    def test_patch(self):
+        patch = [
+            {'op': 'test', 'path': '/childJsons/0/id', 'value': 'pg1'},
+            {'op': 'replace', 'path': '/childJsons/0/childJsons/0/pointA', 'value': [0, 0, 3]},
+            {'op': 'add', 'path': '/childJsons/1/childJsons/-', 'value': {'id': 'l2'}},
+            {'op': 'add', 'path': '/description', 'value': 'SC'},
+            {'op': 'copy', 'from': '/childJsons/0/id', 'path': '/label'},
+            {'op': 'move', 'from': '/description', 'path': '/desc~1ription'},
+            {'op': 'remove', 'path': '/childAnnotationIds/1'},
+        ]
+        result = apply_patch(self.annotation, patch)
+        self.assertEqual(result['childJsons'][0]['childJsons'][0]['pointA'], [0, 0, 3])
+        self.assertEqual(result['childJsons'][1]['childJsons'], [{'id': 'l2'}])
+        self.assertEqual(result['desc/ription'], 'SC')
+        self.assertNotIn('description', result)
+        self.assertEqual(result['label'], 'pg1')
+        self.assertEqual(result['childAnnotationIds'], ['pg1'])
+        with self.assertRaises(JsonPatchError):
+            apply_patch(result, [{'op': 'test', 'path': '/type', 'value': 'polygon'}])
+        with self.assertRaises(JsonPatchError):
+            apply_patch(result, [{'op': 'remove', 'path': '/childJsons/5'}])
+
+    def test_children_delta(self):
+        delta = {'children': [{'id': 'pg2', 'childJsons': [{'id': 'l3'}]}, {'id': 'pg3', 'childJsons': []}], 'removed': ['pg1']}
+        result = apply_children_delta(self.annotation, delta)
+        self.assertEqual([child['id'] for child in result['childJsons']], ['pg2', 'pg3'])
+        self.assertEqual(result['childAnnotationIds'], ['pg2', 'pg3'])
+        self.assertEqual(result['childJsons'][0]['childJsons'], [{'id': 'l3'}])
+        with self.assertRaises(JsonPatchError):
+            apply_children_delta(result, {'removed': ['pg1']})
+
+
+class TestResponseCache(SimpleTestCase):
+    """Tests the ETag, 304 and encoding negotiation of the cached JSON responses
+    """
+
+    def test_conditional_get(self):
+        import gzip
+        from datetime import datetime, timezone
+        from django.test import RequestFactory
+        updated = datetime(2026, 1, 2, 3, 4, 5, 678, tzinfo=timezone.utc)
+        data = {'id': 1, 'annotation': {'childJsons': list(range(1000))}}
+        get_data = mock.Mock(return_value=data)
+        factory = RequestFactory()
+
+        request = factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=1, deflate, br;q=0')
+        response = response_cache.cached_json_response(request, 'test', 1, updated, get_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content)), data)
+        etag = response['ETag']
+
+        request = factory.get('/', HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING='gzip')
+        response = response_cache.cached_json_response(request, 'test', 1, updated, get_data)
+        self.assertEqual(response.status_code, 304)
+        request = factory.get('/')
+        response = response_cache.cached_json_response(request, 'test', 1, updated, get_data)
+        self.assertEqual(json.loads(response.content), data)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(get_data.call_count, 1)
+
+        # every coding and variant has its own tag, all of them parse to the version
+        version = f'{response_cache.get_version(updated):x}'
+        self.assertEqual(etag, f'"{version}-gzip"')
+        self.assertEqual(response['ETag'], f'"{version}"')
+        request = factory.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response_cache.cached_json_response(request, 'test', 1, updated, get_data).status_code, 200)
+        request = factory.get('/', HTTP_IF_NONE_MATCH=etag)
+        response = response_cache.cached_json_response(request, 'test', 1, updated, get_data, 'fields=id')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(response['ETag'], (etag, f'"{version}"'))
+        self.assertEqual(response_cache.parse_etag(f'W/{etag}'), version)
+        self.assertEqual(response_cache.parse_etag(response['ETag']), version)
+
+    def test_choose_encoding(self):
+        self.assertEqual(response_cache.choose_encoding(''), 'identity')
+        self.assertEqual(response_cache.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(response_cache.choose_encoding('gzip;q=0.5, *;q=0.1'), 'gzip')
+        self.assertEqual(response_cache.choose_encoding('gzip;q=0'), 'identity')
+
+
+class TestPrecomputedAnnotations(SimpleTestCase):
+    """Tests that the sharded by_id and spatial indexes hold every annotation exactly once
+    """
+
+    def test_write_cloud(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(0, 0.01, size=(3000, 3))
+        annotation = {'type': 'cloud', 'childJsons': [
+            {'type': 'cell', 'point': point, 'category': 'Round' if i % 3 else 'Star'} for i, point in enumerate(points.tolist())]}
+        writer = create_writer(annotation)
+        writer.limit = 200
+        with tempfile.TemporaryDirectory() as directory:
+            info = writer.write(directory)
+            self.assertEqual(info['annotation_type'], 'POINT')
+            self.assertEqual(info['properties'][0]['enum_labels'], ['Round', 'Star'])
+            record = read_sharded(os.path.join(directory, 'by_id'), 3, info['by_id']['sharding'])
+            np.testing.assert_allclose(np.frombuffer(record[:12], dtype='<f4'), points[2] * 1000000, rtol=1e-6)
+            self.assertEqual(int(np.frombuffer(record[12:], dtype='<u4')[0]), 0)
+
+            ids = []
+            for level in info['spatial']:
+                grid_shape = level['grid_shape']
+                for position in np.ndindex(*grid_shape):
+                    code = int(compressed_morton_code([position], grid_shape)[0])
+                    chunk = read_sharded(os.path.join(directory, level['key']), code, level['sharding'])
+                    if chunk is None:
+                        continue
+                    count = int(np.frombuffer(chunk[:8], dtype='<u8')[0])
+                    if level is not info['spatial'][-1]:
+                        self.assertLessEqual(count, level['limit'])
+                    ids.extend(np.frombuffer(chunk[8 + count * 16:], dtype='<u8').tolist())
+            self.assertGreater(len(info['spatial']), 1)
+            self.assertEqual(sorted(ids), list(range(1, 3001)))
+
+    def test_morton_code(self):
+        codes = compressed_morton_code([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0], [2, 0, 0], [3, 1, 0]], [4, 2, 1])
+        self.assertEqual(codes.tolist(), [0, 1, 2, 3, 4, 7])
+
+
+class TestSpatialIndex(SimpleTestCase):
+    """Tests the bounding box query and the synchronization of the spatial index
+    """
+
+    def test_query(self):
+        cloud = {'type': 'cloud', 'childJsons': [
+            {'id': f'p{i}', 'type': 'cell', 'point': [i / 1000000, 0.0001, 0.0001]} for i in range(100)]}
+        volume = {'type': 'volume', 'childJsons': [{'type': 'polygon', 'childJsons': [
+            {'id': 'l1', 'type': 'line', 'pointA': [0.00005, 0.0001, 0.0001], 'pointB': [0.00006, 0.0001, 0.0001]}]}]}
+        load = mock.Mock(side_effect=lambda ids: [(id, {1: cloud, 2: volume}[id]) for id in ids])
+        spatial_index = AnnotationSpatialIndex()
+        spatial_index.synchronize({1: ('t1', ('Round',)), 2: ('t1', ('SC',))}, load)
+
+        rows = list(spatial_index.query([10, 99, 99], [50, 101, 101]))
+        self.assertEqual([row['id'] for row in rows], [f'p{i}' for i in range(10, 51)] + ['l1'])
+        self.assertEqual(spatial_index.count([10, 99, 99], [50, 101, 101], {'SC'}), 1)
+        self.assertEqual(list(spatial_index.query([200, 0, 0], [300, 1, 1])), [])
+
+        # only the session that changed is loaded again, the deleted one is removed
+        spatial_index.synchronize({2: ('t2', ('IC',))}, load)
+        self.assertEqual(load.call_args[0][0], [2])
+        rows = list(spatial_index.query([0, 0, 0], [1000, 1000, 1000]))
+        self.assertEqual([(row['id'], row['labels']) for row in rows], [('l1', ('IC',))])
+
+    def test_query_page(self):
+        from cachetools import LRUCache
+        cloud = {'type': 'cloud', 'childJsons': [
+            {'id': f'p{i}', 'type': 'cell', 'point': [i / 1000000, 0, 0]} for i in range(10)]}
+        versions = mock.Mock(return_value={1: ('t1', ('SC',))})
+        load = mock.Mock(side_effect=lambda ids: [(id, cloud) for id in ids])
+        with mock.patch('neuroglancer.spatial_index._indexes', LRUCache(maxsize=2)) as indexes, \
+                mock.patch('neuroglancer.spatial_index.get_session_versions', versions), \
+                mock.patch('neuroglancer.spatial_index.load_annotations', load):
+            count, rows = query_page('MD589', [0, 0, 0], [100, 1, 1], None, 2, 3)
+            self.assertEqual(count, 10)
+            self.assertEqual([row['id'] for row in rows], ['p2', 'p3', 'p4'])
+            self.assertFalse(get_index('MD589').lock.locked())
+            # only the animals queried last are kept
+            get_index('MD585')
+            get_index('MD594')
+            self.assertEqual(sorted(indexes), ['MD585', 'MD594'])
+
+
+class TestAnnotationExport(SimpleTestCase):
+    """Tests the rows, the streamed formats and the pages of the annotation export
+    """
+
+    def setUp(self):
+        lines = [{'pointA': [0.0002, 0.0001, 0.00004], 'pointB': [0.0003, 0.0001, 0.00004], 'parentAnnotationId': 'pg1'},
+                 {'pointA': [0.0003, 0.0001, 0.00004], 'pointB': [0.0002, 0.0001, 0.00004], 'parentAnnotationId': 'pg1'}]
+        self.volume = {'type': 'volume', 'description': 'SC', 'childJsons': [{'childJsons': lines}]}
+
+    def test_rows(self):
+        rows = list(iter_session_rows(self.volume, xy_resolution=0.5, z_resolution=20))
+        self.assertEqual([(row['UUID'], row['Order'], row['X'], row['Section']) for row in rows],
+                         [('pg1', 1, 400.0, 2), ('pg1', 2, 600.0, 2)])
+        self.assertEqual(json.loads(next(ndjson_lines(rows)))['Labels'], 'SC')
+        content = ''.join(csv_lines(iter(rows)))
+        self.assertEqual(content.splitlines()[0], 'Layer,Type,Labels,UUID,Order,X,Y,Section,Xum,Yum,Zum')
+        self.assertEqual(len(content.splitlines()), 3)
+
+    def test_pages(self):
+        rows = ({'Layer': 'Export', 'Type': 'cloud', 'Labels': '<b>', 'UUID': 'c', 'Order': i, 'X': 0, 'Y': 0,
+                 'Section': 0, 'Xum': 0, 'Yum': 0, 'Zum': 0} for i in range(25))
+        html, has_next = render_page(rows, 2, page_size=10)
+        self.assertTrue(has_next)
+        self.assertEqual(html.count('<tr>'), 10)
+        self.assertIn('&lt;b&gt;', html)
+        html, has_next = render_page(iter([]), 1)
+        self.assertIsNone(html)
+
+
+class TestCsvExport(SimpleTestCase):
+    """Tests the streamed CSV export of the admin actions
+    """
+
+    def get_field(self, name, related_model=None):
+        field = mock.Mock(attname=name if related_model is None else f'{name}_id',
+                          is_relation=related_model is not None, related_model=related_model)
+        field.name = name
+        return field
+
+    def test_iter_csv_rows(self):
+        related_model = mock.Mock()
+        related_model._default_manager.in_bulk.return_value = {5: 'DK55'}
+        fields = [self.get_field('id'), self.get_field('file_name'), self.get_field('scan_run', related_model)]
+        rows = [(1, 'S1.tif', 5), (2, 'S2.tif', 5), (3, 'S3.tif', None)]
+        queryset = mock.Mock()
+        queryset.values_list.return_value.iterator.return_value = iter(rows)
+        exporter = ExportCsvMixin()
+        exporter.model = mock.Mock()
+        exporter.model._meta.fields = fields
+        exporter.export_chunk_size = 1
+
+        result = list(exporter.iter_csv_rows(queryset))
+        self.assertEqual(result[0], ['id', 'file_name', 'scan_run'])
+        self.assertEqual(result[1:], [[1, 'S1.tif', 'DK55'], [2, 'S2.tif', 'DK55'], [3, 'S3.tif', None]])
+        queryset.values_list.assert_called_once_with('id', 'file_name', 'scan_run_id')
+        # the related object of a key is fetched once
+        related_model._default_manager.in_bulk.assert_called_once_with({5})
+
+    def test_gzip_lines(self):
+        import gzip
+        lines = [f'{i},S{i}.tif\r\n' for i in range(1000)]
+        chunks = list(gzip_lines(lines, flush_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(gzip.decompress(b''.join(chunks)).decode(), ''.join(lines))
+
+
+class TestKeysetPagination(SimpleTestCase):
+    """Tests the cursor of the keyset pagination on (updated, id)
+    """
+
+    def test_cursor(self):
+        from datetime import datetime, timezone
+        from django.test import RequestFactory
+        from rest_framework.exceptions import NotFound
+        from rest_framework.request import Request
+        state = mock.Mock(id=42, updated=datetime(2026, 3, 4, 5, 6, 7, 8, tzinfo=timezone.utc))
+        paginator = UpdatedKeysetPagination()
+        cursor = paginator.encode_cursor(state)
+        request = Request(RequestFactory().get('/neuroglancer', {'cursor': cursor, 'limit': 5000}))
+        self.assertEqual(paginator.decode_cursor(request), (state.updated, 42))
+        self.assertEqual(paginator.get_page_size(request), 1000)
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor(Request(RequestFactory().get('/neuroglancer', {'cursor': 'bad'})))
+
+
+class TestSearchIndex(SimpleTestCase):
+    """Tests the n-gram search index against icontains
+    """
+
+    def test_search(self):
+        from datetime import datetime
+        search_index = SearchIndex()
+        search_index.set_label(1, 'brain region', 'SC')
+        search_index.set_label(2, 'brain region', 'SNC_L')
+        search_index.set_label(3, 'cell', 'Round3')
+        updated = datetime(2026, 1, 2, 3, 4)
+        search_index.set_session(10, '10 MD589 SC,SNC_L beth volume', 'volume', updated)
+        search_index.set_session(11, '11 DK55 Round3 edward cell', 'cell', updated)
+        self.assertEqual([row['id'] for row in search_index.search_labels('s')], [1, 2])
+        self.assertEqual([row['id'] for row in search_index.search_labels('nc_')], [2])
+        self.assertEqual([row['id'] for row in search_index.search_labels('round3')], [3])
+        self.assertEqual(search_index.search_labels('roundx'), [])
+        rows = search_index.search_sessions('md589 sc,')
+        self.assertEqual([row['id'] for row in rows], [10])
+        self.assertEqual(rows[0]['updated'], '02 Jan 2026 03:04')
+        self.assertEqual(search_index.search_sessions('edward'), [])
+        search_index.set_label(1, 'brain region', 'IC')
+        self.assertEqual([row['id'] for row in search_index.search_labels('ic')], [1])
+        self.assertEqual(search_index.search_labels('sc'), [])
+        search_index.remove_session(10)
+        search_index.remove_session(11)
+        self.assertEqual(search_index.search_sessions('beth'), [])
+        self.assertEqual(len(search_index.sessions.ngrams), 0)
+
+
+class TestLookupCache(SimpleTestCase):
+    """Tests the versioned lookup tables
+    """
+
+    def test_lookup(self):
+        rows = [mock.Mock(pk=1, abbreviation='7N_L'), mock.Mock(pk=2, abbreviation='7n_L'), mock.Mock(pk=3, abbreviation='SC'),
+                mock.Mock(pk=4, abbreviation='SC')]
+        lookup = Lookup(rows, lambda row: row.abbreviation)
+        self.assertEqual(lookup.get('7N_L').pk, 1)
+        self.assertEqual(lookup.get('7n_L').pk, 2)
+        self.assertEqual(lookup.get('sc').pk, 3)
+        self.assertIsNone(lookup.get('IC'))
+
+    def test_table(self):
+        load = mock.Mock(side_effect=lambda: object())
+        table = LookupTable(load, ttl=3600)
+        first = table.get()
+        self.assertIs(table.get(), first)
+        table.invalidate()
+        self.assertIsNot(table.get(), first)
+        self.assertEqual(load.call_count, 2)
+        table.ttl = -1
+        table.get()
+        self.assertEqual(load.call_count, 3)
+
+    def test_table_miss(self):
+        rows = [mock.Mock(pk=1, label='SC')]
+        load = mock.Mock(side_effect=lambda: Lookup(list(rows), lambda row: row.label))
+        exists = mock.Mock(return_value=False)
+        table = LookupTable(load, exists, ttl=3600, miss_ttl=3600)
+        self.assertEqual(table.find('sc').pk, 1)
+        self.assertIsNone(table.find('IC'))
+        self.assertIsNone(table.find('IC'))
+        self.assertEqual(exists.call_count, 1)
+        # added by another process
+        rows.append(mock.Mock(pk=2, label='IC'))
+        exists.return_value = True
+        table.miss_ttl = -1
+        self.assertEqual(table.find('IC').pk, 2)
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(exists.call_count, 2)
+
+
+class TestLabelSignature(SimpleTestCase):
+    """Tests the label signature matches the SQL backfill
+    """
+
+    def test_signature(self):
+        import hashlib
+        self.assertEqual(get_label_signature([3, 1, 2, 2]), hashlib.sha256(b'1,2,3').hexdigest())
+        self.assertEqual(get_label_signature(['2', 1]), get_label_signature([1, 2]))
+        self.assertIsNone(get_label_signature([]))
+
+
+class TestQueryBudget(SimpleTestCase):
+    """Tests the query fingerprints and the duplicate count used to find N+1 queries
+    """
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM slide WHERE id = 12 AND name = 'it''s'"),
+                         'SELECT * FROM slide WHERE id = ? AND name = ?')
+        self.assertEqual(fingerprint('SELECT id FROM t WHERE id IN (%s, %s, %s)'), fingerprint('SELECT id FROM t WHERE id IN (%s)'))
+
+    def test_recorder(self):
+        recorder = QueryRecorder()
+        execute = mock.Mock(return_value=None)
+        for i in range(5):
+            recorder(execute, f'SELECT * FROM label WHERE session_id = {i}', None, False, {})
+        recorder(execute, 'SELECT * FROM session', None, False, {})
+        self.assertEqual(recorder.count, 6)
+        self.assertEqual(recorder.duplicate_count, 4)
+        self.assertEqual(recorder.get_duplicates(), [('SELECT * FROM label WHERE session_id = ?', 5)])
+        self.assertIn('dbdup;desc="4 duplicate queries"', recorder.server_timing())
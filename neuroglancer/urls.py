@@ -1,6 +1,6 @@
 from django.urls import path, include
-from neuroglancer.views import AnnotationPrivateViewSet, NeuroglancerPrivateViewSet, NeuroglancerPublicViewSet,  \
-    Segmentation, get_labels, search_annotation, search_label
+from neuroglancer.views import AnnotationPrecomputed, AnnotationPrivateViewSet, NeuroglancerPrivateViewSet, NeuroglancerPublicViewSet,  \
+    Segmentation, SegmentationJobs, get_labels, query_annotations, search_annotation, search_label
 
 from rest_framework import routers
 app_name = 'neuroglancer'
@@ -15,6 +15,10 @@ annotation_urls = [
     path('annotations/labels/', search_label, name='search_labels'),
     path('annotations/labels/<str:search_string>', search_label, name='search_labels'),
     path('annotations/segmentation/<int:session_id>/<str:stdDevX>/<str:stdDevY>/<str:stdDevZ>/<str:interpolate>', Segmentation.as_view(),name = 'create_segmentation'),
+    path('annotations/segmentation/jobs', SegmentationJobs.as_view(), name='segmentation_jobs'),
+    path('annotations/segmentation/jobs/<str:job_id>', SegmentationJobs.as_view(), name='segmentation_job'),
+    path('annotations/precomputed/<int:session_id>', AnnotationPrecomputed.as_view(), name='annotation_precomputed'),
+    path('annotations/query', query_annotations, name='query_annotations'),
     path('annotations/search', search_annotation, name='search_annotations'),
     path('annotations/search/', search_annotation, name='search_annotations'),
     path('annotations/search/<str:search_string>', search_annotation, name='search_annotations'),
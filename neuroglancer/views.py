@@ -4,66 +4,108 @@ is the 'V' in the MVC framework for the Neuroglancer app
 portion of the portal.
 """
 
+import json
 from rest_framework import viewsets, views, permissions, status
-from django.http import JsonResponse
-from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
 from rest_framework.pagination import LimitOffsetPagination
-from timeit import default_timer as timer
+from rest_framework.parsers import JSONParser
+from rest_framework.settings import api_settings
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 
-from brain.models import ScanRun
-from neuroglancer.annotation_session_manager import AnnotationSessionManager, get_label_ids
-from neuroglancer.models import AnnotationLabel, AnnotationSession, \
-    NeuroglancerState, SearchSessions
+from brainsharer.pagination import UpdatedKeysetPagination
+from neuroglancer.annotation_session_manager import get_label_ids
+from neuroglancer.models import AnnotationSession, NeuroglancerState
 from neuroglancer.serializers import AnnotationLabelModelSerializer, AnnotationModelSerializer, AnnotationSearchSerializer, AnnotationSessionDataSerializer, \
-    LabelSerializer, NeuroglancerNoStateSerializer, NeuroglancerStateSerializer
+    LabelSerializer, NeuroglancerNoStateSerializer, NeuroglancerStateSerializer, get_requested_fields
 from neuroglancer.models import DEBUG
+from neuroglancer.json_patch import JsonPatchError, apply_children_delta, apply_patch
+from neuroglancer.response_cache import cached_json_response, parse_etag
+from neuroglancer.precomputed_annotations import export_session
+from neuroglancer.spatial_index import query_page
+from neuroglancer.search_index import search_labels, search_sessions
+from neuroglancer.lookup_cache import get_active_labels
+from neuroglancer.segmentation import DONE, FAILED, SegmentationError, create_segmentation, get_queue, normalize_parameters
+from neuroglancer.structures_cache import get_cached_folder
 
 
 DEFAULT_ANIMAL = 'AtlasV8'
+QUERY_LIMIT = 1000
+QUERY_MAX_LIMIT = 100000
+
+
+class JSONPatchParser(JSONParser):
+    media_type = 'application/json-patch+json'
+
 
 @api_view(['GET'])
 def get_labels(request):
-    labels = AnnotationLabel.objects.filter(active=True).order_by('label_type').order_by('label').all()
+    labels = get_active_labels()
     serializer = AnnotationLabelModelSerializer(labels, many=True)
     return Response(serializer.data)
 
 @api_view(['GET'])
 def search_label(request, search_string=None):
+    """Typeahead search of the labels, answered from the in-process search index."""
     data = []
     if search_string:
-        labels = AnnotationLabel.objects\
-            .filter(label__icontains=search_string).order_by('label')
-        for row in labels:
-            data.append({"id": row.id, "label_type": row.label_type, "label": row.label})
+        data = search_labels(search_string)
         if DEBUG:
-            print(f'labels query: {labels.query}')
-            print(f'data: {data}')
+            print(f'labels matching {search_string}: {len(data)}')
     serializer = LabelSerializer(data, many=True)
     return Response(serializer.data)
 
 @api_view(['GET'])
 def search_annotation(request, search_string=None):
+    """Typeahead search of the annotation sessions by ID, animal, labels, username
+    and type, answered from the in-process search index."""
     data = []
     if search_string:
-        rows = SearchSessions.objects\
-            .filter(animal_abbreviation_username__icontains=search_string)\
-            .exclude(label_type='cell')\
-            .order_by('-updated').order_by('animal_abbreviation_username').distinct()
+        data = search_sessions(search_string)
         if DEBUG:
-            print(rows.query)
-        for row in rows:
-            data.append({
-                "id": row.id,
-                "animal_abbreviation_username": row.animal_abbreviation_username,
-                "updated": row.updated
-            })
-        
+            print(f'sessions matching {search_string}: {len(data)}')
     serializer = AnnotationSearchSerializer(data, many=True)
     return Response(serializer.data)
 
+@api_view(['GET'])
+def query_annotations(request):
+    """Returns the annotation points of an animal inside a bounding box, e.g.
+    ``annotations/query?animal=MD589&bbox=1000,2000,100,3000,4000,300&labels=SC,IC&limit=1000&offset=0``.
+    The box is min x,y,z and max x,y,z in micrometers. The JSON is streamed one page at a time.
+    """
+    animal = request.GET.get('animal')
+    try:
+        bbox = [float(value) for value in request.GET.get('bbox', '').split(',')]
+        limit = min(int(request.GET.get('limit', QUERY_LIMIT)), QUERY_MAX_LIMIT)
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        bbox, limit, offset = [], 0, 0
+    if not animal or len(bbox) != 6 or limit < 1 or offset < 0:
+        return Response({"detail": "animal and bbox=min x,min y,min z,max x,max y,max z are required"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    labels = {label.strip() for label in request.GET.get('labels', '').split(',') if label.strip()}
+
+    count, rows = query_page(animal, bbox[:3], bbox[3:], labels, offset, limit)
+    next_url = None
+    if offset + limit < count:
+        query = request.GET.copy()
+        query['offset'] = offset + limit
+        query['limit'] = limit
+        next_url = request.build_absolute_uri(f'{request.path}?{query.urlencode()}')
+
+    def stream():
+        yield f'{{"count": {count}, "next": {json.dumps(next_url)}, "results": ['
+        for i, row in enumerate(rows):
+            yield (',' if i > 0 else '') + json.dumps(row)
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
 class Segmentation(views.APIView):
     """Method to create a 3D volume from existing annotation
     """
@@ -72,40 +114,68 @@ class Segmentation(views.APIView):
 
     
     def get(self, request, session_id, stdDevX, stdDevY, stdDevZ, interpolate):
-        """Simpler version that does not use slurm or subprocess script
+        """Simpler version that does not use slurm or subprocess script. This blocks until
+        the volume is done, large structures should use SegmentationJobs instead. It goes
+        through create_segmentation like the jobs, so it waits for a job building the same folder.
         """
         if DEBUG:
-            start_time = timer()
             print(f'Segmentation.get with parameters session_id: {session_id}, stdDevX: {stdDevX}, stdDevY: {stdDevY}, stdDevZ: {stdDevZ}')
         try:
-            annotationSession = AnnotationSession.objects.get(pk=session_id)
-        except AnnotationSession.DoesNotExist:
-            return Response({"msg": f"Annotation data does not exist"}, status=status.HTTP_404_NOT_FOUND)
+            result = create_segmentation(session_id, stdDevX, stdDevY, stdDevZ, interpolate)
+        except SegmentationError as e:
+            return Response({"msg": str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        return JsonResponse(result)
+
+
+class SegmentationJobs(views.APIView):
+    """Creates the 3D volume of an annotation session in the background.
+    POST the session_id, stdDevX, stdDevY, stdDevZ and interpolate to get a job and
+    GET the job with its id until the status is done or failed.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        data = request.data
         try:
-            scan_run = ScanRun.objects.get(prep=annotationSession.animal)
-        except ScanRun.DoesNotExist:
-            return Response({"msg": f"Scan run data does not exist"}, status=status.HTTP_404_NOT_FOUND)
-
-        label = annotationSession.labels.first()
-        annotation_session_manager = AnnotationSessionManager(scan_run, label)
-        polygons = annotation_session_manager.create_polygons(annotationSession.annotation, int(interpolate))
-        if not isinstance(polygons, dict):
-            return Response({"msg": polygons}, status=status.HTTP_404_NOT_FOUND)
-        origin, section_size = annotation_session_manager.get_origin_and_section_size(polygons)
-        volume = annotation_session_manager.create_volume(polygons, origin, section_size, float(stdDevX), float(stdDevY), float(stdDevZ))
-        del polygons
-        if volume is None or volume.shape[0] == 0:
-            return Response({"msg": "Volume could not be created"}, status=status.HTTP_404_NOT_FOUND)        
-        folder_name = annotation_session_manager.create_segmentation_folder(volume, annotationSession.animal, 
-                                                 label, origin.tolist())
-        del volume
-        segmentation_save_folder = f"precomputed://{settings.HTTP_HOST}/structures/{folder_name}"
-        if DEBUG:
-            end_time = timer()
-            total_elapsed_time = round((end_time - start_time), 2)
-            print(f'Creating segmentation took {total_elapsed_time} seconds.')
+            session_id = int(data['session_id'])
+            parameters = normalize_parameters(data.get('stdDevX', 0), data.get('stdDevY', 0),
+                                              data.get('stdDevZ', 0), data.get('interpolate', 0))
+        except (KeyError, TypeError, ValueError):
+            return Response({"msg": "session_id, stdDevX, stdDevY, stdDevZ and interpolate must be numbers"}, 
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not AnnotationSession.objects.filter(pk=session_id).exists():
+            return Response({"msg": "Annotation data does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        job = get_queue().submit(session_id, **parameters)
+        return Response(job, status=status.HTTP_202_ACCEPTED)
+
+    def get(self, request, job_id):
+        job = get_queue().get(job_id)
+        if job is None:
+            return Response({"msg": f"Segmentation job {job_id} does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        if job['status'] == DONE and not get_cached_folder(job['name']):
+            # the folder was evicted since the job was done
+            job.update(status=FAILED, url=None, message='The segmentation was deleted to free space, submit it again')
+        return Response(job)
+
+class AnnotationPrecomputed(views.APIView):
+    """Returns the URL of an annotation session as a precomputed annotation source,
+    writing it first if the session was saved since the last export.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, session_id):
+        try:
+            annotation_session = AnnotationSession.objects.get(pk=session_id)
+        except AnnotationSession.DoesNotExist:
+            return Response({"msg": "Annotation data does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        folder_name = export_session(annotation_session)
+        if folder_name is None:
+            return Response({"msg": "The annotation has no points or lines"}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({'url': f"precomputed://{settings.HTTP_HOST}/annotations/{folder_name}", 'name': folder_name})
 
-        return JsonResponse({'url': segmentation_save_folder, 'name': folder_name})
 
 ##### Annotation API view
 
@@ -116,24 +186,25 @@ class AnnotationPrivateViewSet(APIView):
 
     queryset = AnnotationSession.objects.all()
     permission_classes = [permissions.IsAuthenticated]
+    parser_classes = list(api_settings.DEFAULT_PARSER_CLASSES) + [JSONPatchParser]
 
     def get(self, request, session_id=None):
         if DEBUG:
             print('AnnotationPrivateViewSet.get')
-        session = {}
-        if session_id:
-            try:
-                data = AnnotationSession.objects.get(pk=session_id)
-            except AnnotationSession.DoesNotExist:
-                return Response({"details": "Annotation record does not exist"}, status=status.HTTP_404_NOT_FOUND)
-            
-            session['id'] = data.id
-            session['annotation'] = data.annotation
-        else:
+        if not session_id:
             return Response({"details": "Session ID is missing."}, status=status.HTTP_404_NOT_FOUND)
+        updated = AnnotationSession.objects.filter(pk=session_id).values_list('updated', flat=True).first()
+        if updated is None:
+            return Response({"details": "Annotation record does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
-        serializer = AnnotationSessionDataSerializer(session, many=False)
-        return Response(serializer.data)
+        def get_data():
+            data = AnnotationSession.objects.get(pk=session_id)
+            session = {'id': data.id, 'annotation': data.annotation, 'version': data.version}
+            return AnnotationSessionDataSerializer(session, many=False).data
+
+        if request.accepted_renderer.format == 'json':
+            return cached_json_response(request, 'annotation', session_id, updated, get_data)
+        return Response(get_data())
 
 
     def post(self, request):
@@ -193,6 +264,56 @@ class AnnotationPrivateViewSet(APIView):
                 print(f'AnnotationPrivateViewSet.put serializer errors: {serializer.errors}')
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def patch(self, request, session_id):
+        """Applies a small edit to the annotation instead of sending all of it again.
+        The body is either an RFC 6902 JSON Patch sent as application/json-patch+json
+        with the version in the If-Match header, or an object with the version and
+        a 'patch' list or a 'children'/'removed' delta. See neuroglancer.json_patch.
+        The version is the one returned by GET, or its ETag, or the one returned by the
+        last PATCH; if the annotation was saved since, nothing is changed and 409 is returned.
+        """
+        if DEBUG:
+            print('AnnotationPrivateViewSet.patch')
+
+        data = request.data
+        if isinstance(data, list):
+            version = request.headers.get('If-Match')
+            operations, delta = data, None
+        elif isinstance(data, dict):
+            version = data.get('version', request.headers.get('If-Match'))
+            operations = data.get('patch')
+            delta = None if operations is not None else {key: data[key] for key in ('children', 'removed') if key in data}
+        else:
+            return Response({"detail": "The patch must be a list or an object"}, status=status.HTTP_400_BAD_REQUEST)
+        if not version:
+            return Response({"detail": "Version is required"}, status=status.HTTP_400_BAD_REQUEST)
+        version = parse_etag(version)
+
+        # the row is locked until the commit, so nobody saves the session between the check and the save
+        with transaction.atomic():
+            try:
+                existing_session = AnnotationSession.objects.select_for_update().get(pk=session_id)
+            except AnnotationSession.DoesNotExist:
+                return Response({"detail": "Annotation data does not exist"}, status=status.HTTP_404_NOT_FOUND)
+            if existing_session.version != version:
+                return Response({"detail": "The annotation was changed since this version", "version": existing_session.version},
+                                status=status.HTTP_409_CONFLICT)
+
+            try:
+                if operations is not None:
+                    annotation = apply_patch(existing_session.annotation, operations)
+                else:
+                    annotation = apply_children_delta(existing_session.annotation, delta)
+            except JsonPatchError as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if not isinstance(annotation, dict):
+                return Response({"detail": "The annotation must be an object"}, status=status.HTTP_400_BAD_REQUEST)
+
+            # save sends post_save, which refreshes the search rows of the session
+            existing_session.annotation = annotation
+            existing_session.save(update_fields=['annotation', 'updated'])
+        return Response({'id': existing_session.id, 'version': existing_session.version}, status=status.HTTP_200_OK)
+
 
 ##### Neuroglancer views
 
@@ -212,24 +333,68 @@ class NeuroglancerPublicViewSet(viewsets.ModelViewSet):
         """
         Optionally restricts the returned purchases to a given animal,
         by filtering against a `animal` query parameter in the URL.
+        The `layer` parameter uses the summary table to return the states
+        with an annotation layer of that name.
         """
 
         queryset = NeuroglancerState.objects.only('id').filter(public=True).order_by('comments')
         description = self.request.query_params.get('description')
         lab = self.request.query_params.get('lab')
+        layer = self.request.query_params.get('layer')
         if description is not None:
             queryset = queryset.filter(description__icontains=description)
         if lab is not None and int(lab) > 0:
             queryset = queryset.filter(lab=lab)
+        if layer is not None:
+            # a state without a summary row yet is checked in its JSON
+            queryset = queryset.filter(Q(summary__layers__contains=[layer])
+                                       | Q(summary__isnull=True, neuroglancer_state__layers__contains=[{'name': layer, 'type': 'annotation'}]))
 
         return queryset
 
 class NeuroglancerPrivateViewSet(viewsets.ModelViewSet):
     """
     A viewset for viewing and editing user instances.
+    The list leaves out the JSON state and is paginated with a keyset cursor on
+    (updated, id). Both the list and the detail take ?fields= to return only some fields.
     """
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     serializer_class = NeuroglancerStateSerializer
+    pagination_class = UpdatedKeysetPagination
     queryset = NeuroglancerState.objects.all()
 
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return NeuroglancerNoStateSerializer
+        return NeuroglancerStateSerializer
+
+    def get_queryset(self):
+        if self.action != 'list':
+            return NeuroglancerState.objects.all()
+        queryset = NeuroglancerState.objects.defer('neuroglancer_state')
+        fields = get_requested_fields(self.request)
+        if fields is None or fields & {'lab', 'animal', 'user'}:
+            queryset = queryset.select_related('lab', 'animal', 'owner')
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        """Returns the state with an ETag and a compressed body, see neuroglancer.response_cache.
+        Only the updated column is read when the client already has this version.
+        """
+        if request.accepted_renderer.format != 'json':
+            return super().retrieve(request, *args, **kwargs)
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        updated = self.get_queryset().filter(**{self.lookup_field: pk}).values_list('updated', flat=True).first()
+        if updated is None:
+            return Response({"detail": "Neuroglancer state does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+        def get_data():
+            return self.get_serializer(self.get_object()).data
+
+        variant = None
+        fields = get_requested_fields(request)
+        if fields is not None:
+            variant = f"fields={','.join(sorted(fields))}"
+        return cached_json_response(request, 'neuroglancer', pk, updated, get_data, variant)
+
 
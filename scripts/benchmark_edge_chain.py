@@ -0,0 +1,97 @@
+"""Benchmark of the edge chaining used to order the lines of a polygon against the
+two quadratic sorters it replaced: the list insertion in resort_points and the
+np.where scan of ContourSorter.
+
+Run it from the root of the project:
+``python scripts/benchmark_edge_chain.py --vertices 10000``
+
+The lines of a circle are shuffled and a little noise, smaller than the 0.1
+tolerance, is added to every pointB. It does not need a database connection.
+"""
+import argparse
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+
+PATH = Path('.').absolute().as_posix()
+sys.path.append(PATH)
+
+from neuroglancer.contours.edge_chain import chain_order, chain_rows
+
+
+def create_polygon(vertices, noise=0.04, seed=0):
+    """Creates the shuffled lines of a closed polygon with the first line left in front."""
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    points = np.column_stack([20000 + 5000 * np.cos(angles), 30000 + 5000 * np.sin(angles), np.full(vertices, 54.5)])
+    start_points = points
+    end_points = np.roll(points, -1, axis=0) + rng.uniform(-noise, noise, size=(vertices, 3))
+    order = np.concatenate([[0], rng.permutation(np.arange(1, vertices))])
+    return start_points[order], end_points[order]
+
+
+def legacy_resort_points(rows):
+    """The list insertion sort that was in NeuroglancerState.points, exact matches only."""
+    result = [rows[0]]
+    for i in range(1, len(rows)):
+        for j in range(i):
+            if rows[i]['pointA'] == result[j]['pointB']:
+                result.insert(j + 1, rows[i])
+                break
+        else:
+            result.append(rows[i])
+    return result
+
+
+def legacy_contour_sorter(start_points, end_points):
+    """The np.where scan of ContourSorter, with the same 0.1 tolerance."""
+    sort_index = [0]
+    while len(sort_index) < len(start_points):
+        last_end_point = end_points[sort_index[-1]]
+        result = np.where(np.all(np.isclose(start_points, last_end_point, atol=0.1), axis=1))[0]
+        sort_index.append(result[0])
+    return np.array(sort_index)
+
+
+def is_chained(start_points, end_points):
+    return bool(np.all(np.isclose(start_points[1:], end_points[:-1], atol=0.1)))
+
+
+def main(vertices, repeat):
+    start_points, end_points = create_polygon(vertices)
+    rows = [{'pointA': a, 'pointB': b} for a, b in zip(start_points.tolist(), end_points.tolist())]
+
+    start_time = timer()
+    for _ in range(repeat):
+        order = chain_order(start_points, end_points)
+    chain_time = (timer() - start_time) / repeat
+    print(f'edge chain:       {chain_time:.4f} seconds, chained={is_chained(start_points[order], end_points[order])}')
+
+    start_time = timer()
+    for _ in range(repeat):
+        chain_rows(rows)
+    print(f'edge chain rows:  {(timer() - start_time) / repeat:.4f} seconds')
+
+    start_time = timer()
+    legacy_order = legacy_contour_sorter(start_points, end_points)
+    sorter_time = timer() - start_time
+    print(f'ContourSorter:    {sorter_time:.4f} seconds, same order={np.array_equal(order, legacy_order)}')
+
+    # the legacy resort_points only matches exact coordinates, so give it a polygon without noise
+    exact_start_points, exact_end_points = create_polygon(vertices, noise=0)
+    exact_rows = [{'pointA': a, 'pointB': b} for a, b in zip(exact_start_points.tolist(), exact_end_points.tolist())]
+    start_time = timer()
+    legacy_resort_points(exact_rows)
+    resort_time = timer() - start_time
+    print(f'resort_points:    {resort_time:.4f} seconds')
+    print(f'speedup: {sorter_time / chain_time:.0f}x over ContourSorter, {resort_time / chain_time:.0f}x over resort_points')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the polygon edge chaining')
+    parser.add_argument('--vertices', help='Number of vertices of the polygon', required=False, default=10000, type=int)
+    parser.add_argument('--repeat', help='Number of runs of the edge chaining', required=False, default=5, type=int)
+    args = parser.parse_args()
+    main(args.vertices, args.repeat)
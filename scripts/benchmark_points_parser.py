@@ -0,0 +1,165 @@
+"""Benchmark of the single pass points parser against the original implementation
+of NeuroglancerState.points that searched the whole annotation list for every UUID.
+
+Run it from the root of the project:
+``python scripts/benchmark_points_parser.py --points 100000``
+
+The original implementation is quadratic so it is only run once. It does not need a
+database connection.
+"""
+import argparse
+import random
+import string
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+
+import pandas as pd
+
+PATH = Path('.').absolute().as_posix()
+sys.path.append(PATH)
+
+from neuroglancer.points_parser import COLUMNS, SORT_COLUMNS, create_points_dataframe, resort_points
+
+
+def random_id():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=40))
+
+
+def create_synthetic_state(total_points, cloud_size=500, polygon_size=50, sections_per_volume=20):
+    """Creates a Neuroglancer state with roughly 70% cloud points, 10% single points
+    and 20% polygon vertices.
+    """
+    annotations = []
+    n_clouds = max(1, int(total_points * 0.7) // cloud_size)
+    for i in range(n_clouds):
+        cloud_id = random_id()
+        annotations.append({'id': cloud_id, 'type': 'cloud', 'description': f'cloud {i}'})
+        for _ in range(cloud_size):
+            annotations.append({'id': random_id(), 'type': 'point', 'parentAnnotationId': cloud_id,
+                                'point': [random.uniform(0, 60000), random.uniform(0, 30000), random.randint(0, 400)]})
+
+    for i in range(int(total_points * 0.1)):
+        annotations.append({'id': random_id(), 'type': 'point', 'description': f'point\n{i % 10}',
+                            'point': [random.uniform(0, 60000), random.uniform(0, 30000), random.randint(0, 400)]})
+
+    n_volumes = max(1, int(total_points * 0.2) // (polygon_size * sections_per_volume))
+    for i in range(n_volumes):
+        volume_id = random_id()
+        annotations.append({'id': volume_id, 'type': 'volume', 'description': f'volume {i}'})
+        for section in range(sections_per_volume):
+            polygon_id = random_id()
+            annotations.append({'id': polygon_id, 'type': 'polygon', 'parentAnnotationId': volume_id})
+            vertices = [[random.uniform(0, 60000), random.uniform(0, 30000), section + 0.5] for _ in range(polygon_size)]
+            lines = []
+            for j in range(polygon_size):
+                lines.append({'id': random_id(), 'type': 'line', 'parentAnnotationId': polygon_id,
+                              'pointA': vertices[j], 'pointB': vertices[(j + 1) % polygon_size]})
+            # every other polygon is stored out of order
+            if section % 2 == 1:
+                lines = lines[1:] + lines[:1]
+            annotations.extend(lines)
+
+    random.shuffle(annotations)
+    return {'layers': [{'type': 'annotation', 'name': 'synthetic', 'annotations': annotations},
+                       {'type': 'image', 'name': 'C1'}]}
+
+
+def create_one_dataframe(points, name, UUID, data_type='point', orders=0, descriptions="", xy_resolution=1, z_resolution=1):
+    df = pd.DataFrame(points, columns=['X', 'Y', 'Section'])
+    df['Section'] = df['Section'].astype(int)
+    df['Layer'] = name
+    df['Type'] = data_type
+    df['UUID'] = UUID
+    df['Order'] = orders
+    df['Labels'] = descriptions
+    df['Xum'] = df['X'] * xy_resolution
+    df['Yum'] = df['Y'] * xy_resolution
+    df['Zum'] = df['Section'] * z_resolution
+    return df
+
+
+def legacy_points(json_txt, xy_resolution=1.0, z_resolution=1.0):
+    """The original implementation of NeuroglancerState.points"""
+    dfs = []
+    for layer in json_txt['layers']:
+        if 'annotations' in layer:
+            name = layer['name']
+            annotations = layer['annotations']
+            point_ids = list(set(row["id"] for row in annotations if "id" in row
+                                 and 'point' in row and "parentAnnotationId" not in row))
+            for UUID in point_ids:
+                points = [row['point'] for row in annotations if 'point' in row and "id" in row and row["id"] == UUID]
+                descriptions = [row["description"] for row in annotations if "description" in row
+                                and 'type' in row and row['type'] == 'point' and 'id' in row and row['id'] == UUID]
+                descriptions = 'unlabeled point' if len(descriptions) == 0 else descriptions[0].replace('\n', ', ')
+                df = create_one_dataframe(points, name, UUID, 'point', 0, descriptions, xy_resolution, z_resolution)
+                dfs.append(df[COLUMNS])
+
+            cloud_parent_ids = list(set(row["id"] for row in annotations if "id" in row
+                                        and 'type' in row and row['type'] == 'cloud'))
+            for UUID in cloud_parent_ids:
+                descriptions = [row["description"] for row in annotations if "description" in row
+                                and 'type' in row and row['type'] == 'cloud' and 'id' in row and row['id'] == UUID]
+                descriptions = 'unlabeled cloud point' if len(descriptions) == 0 else descriptions[0].replace('\n', ', ')
+                points = [row['point'] for row in annotations if 'point' in row and "parentAnnotationId" in row
+                          and row["parentAnnotationId"] == UUID]
+                df = create_one_dataframe(points, name, UUID, 'cloud', 0, descriptions, xy_resolution, z_resolution)
+                dfs.append(df[COLUMNS])
+
+            volume_ids = [row['id'] for row in annotations if "id" in row and 'type' in row and row['type'] == 'volume']
+            for volume_id in volume_ids:
+                polygon_ids = [row['id'] for row in annotations if "id" in row and 'type' in row and row['type'] == 'polygon'
+                               and 'parentAnnotationId' in row and row['parentAnnotationId'] == volume_id]
+                descriptions = [row["description"] for row in annotations if "description" in row
+                                and 'type' in row and row['type'] == 'volume' and row['id'] == volume_id]
+                descriptions = 'unlabeled polygon' if len(descriptions) == 0 else descriptions[0].replace('\n', ', ')
+                for UUID in polygon_ids:
+                    lines = [row for row in annotations if "pointA" in row and "type" in row and row["type"] == "line"
+                             and "parentAnnotationId" in row and row["parentAnnotationId"] == UUID]
+                    first = [round(x) for x in lines[0]['pointA']]
+                    last = [round(x) for x in lines[-1]['pointB']]
+                    if first != last:
+                        lines = resort_points(lines)
+                    points = [row['pointA'] for row in lines]
+                    orders = [o for o in range(1, len(points) + 1)]
+                    df = create_one_dataframe(points, name, UUID, 'volume', orders, descriptions, xy_resolution, z_resolution)
+                    dfs.append(df[COLUMNS])
+
+    result = pd.concat(dfs)
+    result.sort_values(by=SORT_COLUMNS, inplace=True)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Neuroglancer state points parser')
+    parser.add_argument('--points', help='Number of points in the synthetic state', required=False, default=100000, type=int)
+    parser.add_argument('--repeats', help='Number of runs of the new parser', required=False, default=5, type=int)
+    parser.add_argument('--seed', help='Random seed', required=False, default=42, type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    state = create_synthetic_state(args.points)
+    total = sum(len(layer.get('annotations', [])) for layer in state['layers'])
+    print(f'Synthetic state with {total} annotations')
+
+    start_time = timer()
+    expected = legacy_points(state, 0.325, 20)
+    legacy_time = timer() - start_time
+    print(f'Original parser took {round(legacy_time, 2)} seconds for {len(expected)} rows.')
+
+    times = []
+    for _ in range(args.repeats):
+        start_time = timer()
+        result = create_points_dataframe(state['layers'], 0.325, 20)
+        times.append(timer() - start_time)
+    new_time = min(times)
+    print(f'Single pass parser took {round(new_time, 3)} seconds for {len(result)} rows.')
+
+    # Rows with the same sort keys can come out in any order, so compare on a stable sort
+    columns = SORT_COLUMNS + ['Xum', 'Yum', 'Zum']
+    pd.testing.assert_frame_equal(
+        expected.reset_index().sort_values(columns + ['index'], kind='stable').reset_index(drop=True),
+        result.reset_index().sort_values(columns + ['index'], kind='stable').reset_index(drop=True))
+    print('Both parsers returned the same DataFrame.')
+    print(f'Speedup: {round(legacy_time / new_time, 1)}x')
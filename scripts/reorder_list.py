@@ -1,19 +1,14 @@
-def resort_points(rows):
-    """Reorders a list of dictionaries based on the previous value of a specified key."""
+"""Shows the order of the lines of a polygon before and after sorting them with the
+same edge chaining that is used by NeuroglancerState.points and the admin export.
+"""
+import sys
+from pathlib import Path
 
+PATH = Path('.').absolute().as_posix()
+sys.path.append(PATH)
 
-    result = [rows[0]]  # Start with the first dictionary
-    for i in range(1, len(rows)):
-        for j in range(i):
-            if rows[i]['pointA'] == result[j]['pointB']:
-                result.insert(j + 1, rows[i])
-                break
-        else:
-            result.append(rows[i])
+from neuroglancer.points_parser import resort_points
 
-    return result
-
-    
 rows = [
     {
         "pointA": [22436.53125, 27149.595703125, 54.5],
@@ -0,0 +1,37 @@
+"""Fills the search_sessions table. Sessions saved from Neuroglancer or the admin
+refresh their own row, run this after bulk imports, or from cron to catch the
+changes that send no signals, such as a deactivated user.
+
+``python scripts/update_search_sessions.py --id 0``
+"""
+import os, sys
+import argparse
+from pathlib import Path
+import django
+
+PATH = Path('.').absolute().as_posix()
+sys.path.append(PATH)
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brainsharer.settings')
+django.setup()
+
+from neuroglancer.models import AnnotationSession, SearchSessions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the search_sessions table')
+    parser.add_argument('--id', help='Enter the ID of one session, or 0 for all sessions', required=False, default=0, type=int)
+    parser.add_argument('--batch', help='Number of sessions refreshed at a time', required=False, default=1000, type=int)
+    args = parser.parse_args()
+
+    ids = list(AnnotationSession.objects.order_by('id').values_list('id', flat=True))
+    if args.id > 0:
+        ids = [args.id]
+
+    total = 0
+    for i in range(0, len(ids), args.batch):
+        total += SearchSessions.refresh(ids[i:i + args.batch])
+    if args.id == 0:
+        # rows of sessions that were deleted
+        SearchSessions.objects.exclude(id__in=AnnotationSession.objects.values('id')).delete()
+    print(f'{total} searchable sessions of {len(ids)}')
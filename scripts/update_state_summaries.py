@@ -0,0 +1,33 @@
+"""Fills the neuroglancer_state_summary table for the existing Neuroglancer states.
+New and updated states get their summary when they are saved from Neuroglancer.
+
+``python scripts/update_state_summaries.py --id 0``
+"""
+import os, sys
+import argparse
+from pathlib import Path
+import django
+
+PATH = Path('.').absolute().as_posix()
+sys.path.append(PATH)
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brainsharer.settings')
+django.setup()
+
+from neuroglancer.models import NeuroglancerState, NeuroglancerStateSummary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the Neuroglancer state summaries')
+    parser.add_argument('--id', help='Enter the ID of one state, or 0 for all states', required=False, default=0, type=int)
+    args = parser.parse_args()
+
+    ids = NeuroglancerState.objects.order_by('id').values_list('id', flat=True)
+    if args.id > 0:
+        ids = ids.filter(pk=args.id)
+
+    for state_id in ids.iterator():
+        # load one state at a time as they can be very large
+        state = NeuroglancerState.objects.get(pk=state_id)
+        summary = NeuroglancerStateSummary.update_summary(state)
+        print(f'{state_id} {summary.annotation_count} annotations in {summary}')
@@ -0,0 +1,73 @@
+-- Summary of the annotations in each Neuroglancer state.
+-- It is maintained by the signals in neuroglancer/signals.py every time a state is saved.
+-- Fill it for the existing states with: python scripts/update_state_summaries.py
+CREATE TABLE neuroglancer_state_summary (
+	FK_neuroglancer_state_id bigint(20) NOT NULL,
+	layers JSON NOT NULL,
+	counts JSON NOT NULL,
+	annotation_count int(11) NOT NULL DEFAULT 0,
+	bounding_box JSON DEFAULT NULL,
+	has_premotor tinyint(1) NOT NULL DEFAULT 0,
+	updated datetime(6) NOT NULL,
+	PRIMARY KEY (FK_neuroglancer_state_id),
+	KEY `K__annotation_count` (annotation_count),
+	KEY `K__has_premotor` (has_premotor)
+);
+
+-- The searchable text of the annotation sessions, replacing the v_search_sessions view.
+-- It is maintained by the signals in neuroglancer/signals.py every time a session or a label is saved.
+-- Refresh all of it with: python scripts/update_search_sessions.py
+DROP VIEW IF EXISTS v_search_sessions;
+CREATE TABLE search_sessions (
+	id bigint(20) NOT NULL,
+	FK_prep_id varchar(20) NOT NULL,
+	labels varchar(2001) NOT NULL,
+	username varchar(150) NOT NULL,
+	animal_abbreviation_username varchar(2001) NOT NULL,
+	label_type varchar(100) NOT NULL,
+	updated datetime(6) NOT NULL,
+	PRIMARY KEY (id),
+	KEY `K__FK_prep_id` (FK_prep_id),
+	KEY `K__label_type_updated` (label_type, updated),
+	KEY `K__animal_abbreviation_username` (animal_abbreviation_username(191))
+);
+
+INSERT INTO search_sessions (id, FK_prep_id, labels, username, animal_abbreviation_username, label_type, updated)
+SELECT AS2.id, AS2.FK_prep_id,
+	GROUP_CONCAT(AL.label ORDER BY AL.label SEPARATOR ','),
+	AU.username,
+	CONCAT(AS2.id, ' ', AS2.FK_prep_id, ' ', GROUP_CONCAT(AL.label ORDER BY AL.label SEPARATOR ','), ' ', AU.username, ' ',
+	JSON_UNQUOTE(JSON_EXTRACT(AS2.annotation, '$.type'))),
+	JSON_UNQUOTE(JSON_EXTRACT(AS2.annotation, '$.type')),
+	AS2.updated
+FROM annotation_session AS2
+INNER JOIN annotation_session_labels ASL ON AS2.id = ASL.annotationsession_id
+INNER JOIN annotation_label AL ON ASL.annotationlabel_id = AL.id
+INNER JOIN auth_user AU ON AS2.FK_user_id = AU.id
+WHERE AS2.active = 1 AND AU.is_active = 1 AND AL.active = 1
+AND AS2.FK_prep_id IS NOT NULL AND JSON_EXTRACT(AS2.annotation, '$.type') IS NOT NULL
+GROUP BY AS2.id;
+
+-- The SHA-256 of the sorted label IDs of a session, so get_session finds the session of
+-- a label set with one equality lookup. Kept up to date by the m2m_changed signal of the labels.
+ALTER TABLE annotation_session ADD COLUMN label_signature char(64) DEFAULT NULL AFTER annotation;
+ALTER TABLE annotation_session ADD KEY `K__AS_prep_user_signature` (FK_prep_id, FK_user_id, label_signature, active, created);
+
+UPDATE annotation_session AS2
+INNER JOIN (
+	SELECT annotationsession_id, SHA2(GROUP_CONCAT(annotationlabel_id ORDER BY annotationlabel_id SEPARATOR ','), 256) AS signature
+	FROM annotation_session_labels
+	GROUP BY annotationsession_id
+) ASL ON AS2.id = ASL.annotationsession_id
+SET AS2.label_signature = ASL.signature;
+
+-- The updated timestamp is the version of a session or state: the response cache, the
+-- points cache, the precomputed annotation folders, the spatial index and the PATCH of an
+-- annotation are keyed by it. With whole seconds two saves in the same second had the same
+-- version, so the microseconds Django writes are kept.
+ALTER TABLE annotation_session MODIFY updated datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6);
+ALTER TABLE neuroglancer_state MODIFY updated datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6);
+
+-- The private Neuroglancer state list is paginated newest first with a cursor on
+-- (updated, id), see brainsharer.pagination.UpdatedKeysetPagination.
+ALTER TABLE neuroglancer_state ADD KEY `K__NS_updated_id` (updated, id);